@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+Measure the encoding and decoding throughput and the size of the messages for
+all the dumpfile codecs, over the single-message and the bulk paths.
+
+By default the messages are synthetic (see gen-synthetic.py); you can also
+provide a dumpfile to take them from. The results are output in JSON.
+"""
+
+# stdlib imports
+import sys, os, platform, json, tempfile
+from time import time
+from os.path import dirname, join, getsize
+from datetime import datetime
+
+# numpy imports
+import numpy as np
+
+# oanda imports
+from oanserv.dumpfile import (opendump, openwriter, packheader, _codecs_names,
+                              _blockcodecs)
+from oanserv.dumparray import encode_block
+from oanserv.synthetic import read_delays, SyntheticGenerator
+
+
+default_delays = join(dirname(__file__), '..', '..', 'doc', 'devel',
+                      'delays.txt')
+
+def timeit(fun, repeat):
+    "Return the best time of 'repeat' calls to 'fun'."
+    best = None
+    for i in xrange(repeat):
+        t1 = time()
+        fun()
+        t = time() - t1
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def bench_codec(codec, arr, rows, fn, repeat):
+    "Run the benchmarks for a codec, using 'fn' as the temporary file."
+    n = len(arr)
+    res = {}
+
+    def encode_single():
+        f = open(fn, 'wb')
+        f.write(packheader(codec))
+        writer = openwriter(f, codec)
+        write = writer.write
+        for row in rows:
+            write(*row)
+        writer.flush()
+        f.close()
+    res['encode_single'] = n / timeit(encode_single, repeat)
+
+    hdrsize = len(packheader(codec))
+    res['bytes_per_msg'] = (getsize(fn) - hdrsize) / float(n)
+
+    if codec in _blockcodecs:
+        res['encode_bulk'] = None
+    else:
+        res['encode_bulk'] = n / timeit(lambda: encode_block(codec, arr),
+                                        repeat)
+
+    def decode_single():
+        for u in opendump(fn):
+            pass
+    res['decode_single'] = n / timeit(decode_single, repeat)
+
+    def decode_bulk():
+        for batch in opendump(fn).iterbatches():
+            pass
+    res['decode_bulk'] = n / timeit(decode_bulk, repeat)
+
+    return res
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(__doc__.strip())
+
+    parser.add_option('-n', '--nmsgs', action='store', type='int',
+                      default=200000,
+                      help="Nb. of messages to benchmark with.")
+
+    parser.add_option('-i', '--input', action='store', default=None,
+                      help=("Dumpfile to take the messages from, instead of "
+                            "generating them."))
+
+    parser.add_option('-c', '--codec', action='append', default=[],
+                      help="Codec to benchmark (default: all of them).")
+
+    parser.add_option('-r', '--repeat', action='store', type='int', default=3,
+                      help="Nb. of runs of each benchmark (the best is kept).")
+
+    parser.add_option('-d', '--delays', action='store', default=default_delays,
+                      help="Table of per-instrument out-of-order statistics.")
+
+    parser.add_option('--seed', action='store', type='int', default=0,
+                      help="Seed for the random number generator.")
+
+    parser.add_option('-o', '--output', action='store', default=None,
+                      help="File to write the JSON results to.")
+
+    opts, args = parser.parse_args()
+    if args:
+        parser.error("No arguments expected.")
+
+    codecs = opts.codec or (list(_codecs_names) + sorted(_blockcodecs))
+
+    # Get the messages.
+    if opts.input:
+        arr = opendump(opts.input).readarray(opts.nmsgs)
+        source = opts.input
+    else:
+        gen = SyntheticGenerator(read_delays(open(opts.delays)),
+                                 seed=opts.seed)
+        arr = gen.generate(opts.nmsgs)
+        source = 'synthetic'
+    rows = arr.tolist()
+
+    results = {
+        'date': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'source': source,
+        'nmsgs': len(arr),
+        'repeat': opts.repeat,
+        'units': {'encode_single': 'msgs/sec', 'encode_bulk': 'msgs/sec',
+                  'decode_single': 'msgs/sec', 'decode_bulk': 'msgs/sec',
+                  'bytes_per_msg': 'bytes'},
+        'codecs': {},
+        }
+
+    fd, fn = tempfile.mkstemp(prefix='bench-codecs.')
+    os.close(fd)
+    try:
+        for codec in codecs:
+            print >> sys.stderr, 'Benchmarking %s...' % codec
+            results['codecs'][codec] = bench_codec(codec, arr, rows, fn,
+                                                   opts.repeat)
+    finally:
+        os.remove(fn)
+
+    outf = open(opts.output, 'w') if opts.output else sys.stdout
+    json.dump(results, outf, indent=2, sort_keys=True)
+    outf.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -7,6 +7,9 @@ Compute the lag between the published time and the actual received time of a
 rate update.
 """
 
+# numpy imports
+import numpy as np
+
 # oanda imports
 from oanserv.dumpfile import opendump
 
@@ -21,13 +24,17 @@ def main():
     fn = args[0]
 
     dumpf = opendump(fn)
-    lsum, lcount = 0, 0
-    for ts_actual, timestamp, venue, symbol, bid, ask in dumpf:
-        lsum += timestamp - ts_actual
-        lcount += 1
-        if lcount % 1000 == 0:
-            print lsum / float(lcount * 1000)
-            lsum, lcount = 0, 0
+
+    # Average the lag over groups of 1000 messages, carrying over the messages
+    # left over from each block into the next one.
+    group = 1000
+    lags = np.empty(0, np.int64)
+    for ts_actual, timestamp in dumpf.iterfields(('ts_actual', 'timestamp')):
+        lags = np.r_[lags, timestamp - ts_actual]
+        n = len(lags) - len(lags) % group
+        for lsum in lags[:n].reshape(-1, group).sum(axis=1).tolist():
+            print lsum / float(group * 1000)
+        lags = lags[n:]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+Generate a dumpfile of synthetic market data, with the instrument mix and the
+out-of-order statistics of doc/devel/delays.txt.
+"""
+
+# stdlib imports
+import sys, os
+from os.path import dirname, join, getsize
+
+# oanda imports
+from oanserv.dumpfile import packheader, getcodec, openwriter, _blockcodecs
+from oanserv.dumparray import encode_block
+from oanserv.synthetic import read_delays, SyntheticGenerator
+
+
+default_delays = join(dirname(__file__), '..', '..', 'doc', 'devel',
+                      'delays.txt')
+
+def parse_size(s):
+    "Parse a size in bytes, with an optional K, M or G suffix."
+    mult = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}.get(s[-1:].upper())
+    if mult:
+        return int(float(s[:-1]) * mult)
+    return int(s)
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(__doc__.strip())
+
+    parser.add_option('-c', '--codec', action='store', default='raw32n',
+                      help="Codec to use for the output file.")
+
+    parser.add_option('-n', '--nmsgs', action='store', type='int',
+                      default=1000000,
+                      help="Nb. of messages to generate.")
+
+    parser.add_option('-s', '--size', action='store', default=None,
+                      help=("Generate messages until the output file reaches "
+                            "this size (e.g. 4G); overrides -n."))
+
+    parser.add_option('-d', '--delays', action='store', default=default_delays,
+                      help="Table of per-instrument out-of-order statistics.")
+
+    parser.add_option('-r', '--rate', action='store', type='float',
+                      default=80.,
+                      help="Average nb. of updates per second.")
+
+    parser.add_option('--seed', action='store', type='int', default=None,
+                      help="Seed for the random number generator.")
+
+    opts, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("You must specify an output dumpfile.")
+    fn, = args
+
+    instruments = read_delays(open(opts.delays))
+    if not instruments:
+        parser.error("No instruments in '%s'." % opts.delays)
+    gen = SyntheticGenerator(instruments, opts.rate, seed=opts.seed)
+
+    maxsize = parse_size(opts.size) if opts.size else None
+    chunksize = 0x40000
+
+    f = open(fn, 'wb')
+    f.write(packheader(opts.codec))
+    if opts.codec in _blockcodecs:
+        writer = openwriter(f, opts.codec)
+        def write(arr):
+            for row in arr.tolist():
+                writer.write(*row)
+    else:
+        getcodec(opts.codec) # Check the codec name.
+        writer = None
+        def write(arr):
+            f.write(encode_block(opts.codec, arr))
+
+    nmsgs = 0
+    while 1:
+        if maxsize is not None:
+            if f.tell() >= maxsize:
+                break
+            n = chunksize
+        else:
+            n = min(chunksize, opts.nmsgs - nmsgs)
+            if n <= 0:
+                break
+        write(gen.generate(n))
+        nmsgs += n
+        print >> sys.stderr, '\r%d messages, %d bytes' % (nmsgs, f.tell()),
+
+    if writer is not None:
+        writer.flush()
+    f.close()
+    print >> sys.stderr
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+Seekable block-compressed files.
+
+A gzip stream has to be decompressed from the start to get to any position in
+it, so random access in gzipped dumpfiles is very slow, and we cannot even know
+their uncompressed size without decompressing them. This module implements a
+simple compressed layout made of independently compressed blocks of a fixed
+uncompressed size, followed by a table of the offsets of the blocks. Reading at
+any position then only requires decompressing the block that contains it.
+
+The contents are the bytes of a dumpfile (header included), so a DumpFile can
+be opened on top of a BlockZipFile like on a plain file.
+
+The data is in the following format:
+
+  Field         Nb. Bytes       Data           Interpretation
+  ------------- --------------- -------------- -----------------
+  magic         8               str            'OANZBLK' + NUL
+  version       2               short          format version
+  blocksize     4               int            uncompressed block size
+  blocks        ...             zlib data      compressed blocks
+  table         8 x (nblocks+1) long           offsets of blocks, and end
+  tableoffset   8               long           offset of table
+  size          8               long           total uncompressed size
+  nblocks       4               int            nb. of blocks
+  endmagic      8               str            'OANZEND' + NUL
+  --------------------------------------------------------------
+
+All the blocks have 'blocksize' uncompressed bytes, except for the last one.
+Files in this format are conventionally named with a '.zblk' suffix.
+"""
+
+# stdlib imports
+import os, struct, zlib
+
+
+__all__ = ('BlockZipFile', 'BlockZipWriter', 'isblockzip',
+           'ZBLK_MAGIC', 'ZBLK_SUFFIX')
+
+
+ZBLK_MAGIC = 'OANZBLK\0'
+ZBLK_ENDMAGIC = 'OANZEND\0'
+ZBLK_VERSION = 1
+ZBLK_SUFFIX = '.zblk'
+ZBLK_BLOCKSIZE = 0x40000
+
+sthead = struct.Struct('! 8s H I')
+sttrail = struct.Struct('! Q Q I 8s')
+
+
+class BlockZipWriter(object):
+    """ A writer for block-compressed files. Write the uncompressed data with
+    write() and call close() to write out the last block and the offset table;
+    the file itself is not closed."""
+
+    def __init__(self, f, blocksize=ZBLK_BLOCKSIZE, level=6):
+        self.f = f
+        self.blocksize = blocksize
+        self.level = level
+
+        self.f.write(sthead.pack(ZBLK_MAGIC, ZBLK_VERSION, blocksize))
+        self.offsets = []
+        self.offset = sthead.size
+        self.size = 0
+        self.pending = []
+        self.npending = 0
+
+    def write(self, data):
+        self.pending.append(data)
+        self.npending += len(data)
+        if self.npending >= self.blocksize:
+            data = ''.join(self.pending)
+            nblocks = len(data) // self.blocksize
+            for i in xrange(nblocks):
+                self.writeblock(data[i*self.blocksize:(i+1)*self.blocksize])
+            rest = data[nblocks*self.blocksize:]
+            self.pending = [rest]
+            self.npending = len(rest)
+
+    def writeblock(self, data):
+        zdata = zlib.compress(data, self.level)
+        self.f.write(zdata)
+        self.offsets.append(self.offset)
+        self.offset += len(zdata)
+        self.size += len(data)
+
+    def close(self):
+        if self.npending:
+            self.writeblock(''.join(self.pending))
+            self.pending, self.npending = [], 0
+        table = self.offsets + [self.offset]
+        self.f.write(struct.pack('!%dQ' % len(table), *table))
+        self.f.write(sttrail.pack(self.offset, self.size, len(self.offsets),
+                                  ZBLK_ENDMAGIC))
+
+
+class BlockZipFile(object):
+    """ A read-only file object over the uncompressed contents of a
+    block-compressed file. 'f' is the underlying file object. The most recently
+    decompressed block is cached."""
+
+    def __init__(self, f):
+        self.f = f
+        f.seek(0)
+        magic, version, self.blocksize = sthead.unpack(f.read(sthead.size))
+        if magic != ZBLK_MAGIC:
+            raise IOError("Not a block-compressed file: '%s'." % f.name)
+        if version != ZBLK_VERSION:
+            raise IOError("Unsupported version %s of block-compressed file." %
+                          version)
+
+        f.seek(-sttrail.size, os.SEEK_END)
+        (tableoff, self.size, self.nblocks,
+         endmagic) = sttrail.unpack(f.read(sttrail.size))
+        if endmagic != ZBLK_ENDMAGIC:
+            raise IOError("Truncated block-compressed file: '%s'." % f.name)
+        f.seek(tableoff)
+        self.offsets = struct.unpack('!%dQ' % (self.nblocks + 1),
+                                     f.read(8 * (self.nblocks + 1)))
+
+        self.pos = 0
+        self.blockno = None
+        self.block = ''
+
+    @property
+    def name(self):
+        return self.f.name
+
+    def getblock(self, i):
+        "Return the uncompressed data of block 'i'."
+        if i != self.blockno:
+            self.f.seek(self.offsets[i])
+            zdata = self.f.read(self.offsets[i+1] - self.offsets[i])
+            self.block = zlib.decompress(zdata)
+            self.blockno = i
+        return self.block
+
+    def read(self, nbytes=-1):
+        if nbytes is None or nbytes < 0:
+            nbytes = self.size - self.pos
+        nbytes = max(min(nbytes, self.size - self.pos), 0)
+        parts = []
+        while nbytes > 0:
+            i, boff = divmod(self.pos, self.blocksize)
+            data = self.getblock(i)[boff:boff + nbytes]
+            parts.append(data)
+            self.pos += len(data)
+            nbytes -= len(data)
+        return ''.join(parts)
+
+    def readinto(self, buf):
+        r = self.read(len(buf))
+        buf[:len(r)] = r
+        return len(r)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == os.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence: %s" % whence)
+        if pos < 0:
+            raise IOError("Invalid offset: %s" % pos)
+        self.pos = pos
+
+    def close(self):
+        self.f.close()
+
+
+def isblockzip(f):
+    """ Return true if the file object 'f' is a block-compressed file. The file
+    is rewound."""
+    f.seek(0)
+    magic = f.read(len(ZBLK_MAGIC))
+    f.seek(0)
+    return magic == ZBLK_MAGIC
+
+
+def test():
+    """ Write block-compressed files of various sizes, and check reading and
+    seeking across the blocks against the uncompressed data."""
+    import tempfile, shutil, random
+    from os.path import join
+    from StringIO import StringIO
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rnd = random.Random(0)
+        bs = 100
+        fn = join(tmpdir, 'test' + ZBLK_SUFFIX)
+        for size in 0, 1, bs - 1, bs, bs + 1, 3 * bs + 7:
+            print 'Testing: %d bytes' % size
+            data = ''.join(chr(rnd.randrange(256)) for _ in xrange(size))
+
+            # Write in pieces of various sizes.
+            f = open(fn, 'wb')
+            writer = BlockZipWriter(f, bs)
+            i = 0
+            while i < size:
+                n = rnd.choice((1, 7, bs, 2 * bs + 1))
+                writer.write(data[i:i+n])
+                i += n
+            writer.close()
+            f.close()
+
+            f = open(fn, 'rb')
+            assert isblockzip(f)
+            zf = BlockZipFile(f)
+            assert zf.size == size
+            assert zf.nblocks == (size + bs - 1) // bs
+            assert zf.read() == data
+            assert zf.read() == '' and zf.read(10) == ''
+
+            # Read at random positions, across the blocks and the end.
+            for _ in xrange(100):
+                pos, n = rnd.randrange(size + 10), rnd.randrange(2 * bs)
+                zf.seek(pos)
+                assert zf.read(n) == data[pos:pos+n], (pos, n)
+                assert zf.tell() == min(pos + n, max(pos, size))
+            if size:
+                zf.seek(-1, os.SEEK_END)
+                assert zf.read() == data[-1:]
+            zf.seek(1)
+            zf.seek(bs - 2, os.SEEK_CUR)
+            buf = bytearray(2)
+            n = zf.readinto(buf)
+            assert str(buf[:n]) == data[bs-1:bs+1]
+            zf.close()
+
+        # Other files are not mistaken for block-compressed ones, and a
+        # truncated file is detected.
+        assert not isblockzip(StringIO(ZBLK_MAGIC[:-1]))
+        open(fn, 'r+b').truncate(os.path.getsize(fn) - 1)
+        try:
+            BlockZipFile(open(fn, 'rb'))
+        except IOError:
+            pass
+        else:
+            raise AssertionError("Truncated file not detected.")
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test()
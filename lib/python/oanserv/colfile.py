@@ -0,0 +1,549 @@
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+zcol: Columnar block-compressed encoding.
+
+Rate updates are stored in blocks of a fixed number of messages (the last block
+of a file may be shorter). Within a block, each column is stored and compressed
+separately:
+
+  Column        Encoding
+  ------------- ------------------------------------------------------------
+  ts_actual     delta from the previous message (first one from ts_first)
+  timestamp     difference with ts_actual of the same message
+  symid         id of the (venue, symbol) pair in the file's symbol table
+  bid           delta from the previous bid of the same symbol in the block
+  ask           delta from (ask - bid) of the previous message of the same
+                symbol in the block, i.e., the change in spread
+  --------------------------------------------------------------------------
+
+The 64-bit integer columns are byte-shuffled before being compressed with zlib:
+since the deltas are small, most of their high-order bytes are zero and end up
+contiguous. Each block starts with a header:
+
+  Field         Nb. Bytes       Data           Interpretation
+  ------------- --------------- -------------- -----------------
+  magic         4               str            'ZCB1'
+  nmsgs         4               int            nb. of messages in block
+  symbase       2               short          id of first new symbol
+  nnewsyms      2               short          nb. of new symbols
+  ts_first      8               long           first ts_actual (msecs)
+  ts_last       8               long           last ts_actual (msecs)
+  sizes         6 x 4           int            sizes of the sections
+  --------------------------------------------------------------
+
+and is followed by the sections: the new entries of the symbol table (8 bytes
+each: venue and symbol), and the five compressed columns. The symbol table is
+per-file; each block declares only the symbols that appear in the file for the
+first time, so a reader has to look at the headers of all the preceding blocks
+in order to seek to a block.
+"""
+
+# stdlib imports
+import os, struct, zlib
+from bisect import bisect_left, bisect_right
+from os.path import getsize
+
+# numpy imports
+import numpy as np
+
+# local imports
+from oanserv.dumpfile import DumpFile, RateUpdate, RateBatch, opendump
+from oanserv.dumparray import rate_dtype
+
+
+__all__ = ('ColumnDumpFile', 'ColumnWriter')
+
+
+MAGIC = 'ZCB1'
+
+blkhdr = struct.Struct('! 4s I H H q q 6I')
+assert blkhdr.size == 52, blkhdr.size
+
+symentry = struct.Struct('! c 7s')
+
+# Default number of messages per block.
+BLOCKSIZE = 4096
+
+# zlib compression level.
+LEVEL = 6
+
+
+
+def shuffle(a):
+    "Compress a 64-bit int array, grouping the bytes by significance first."
+    b = a.astype('<i8').view(np.uint8).reshape(len(a), 8)
+    return zlib.compress(b.T.tostring(), LEVEL)
+
+def unshuffle(s, n):
+    "Reverse of shuffle()."
+    b = np.frombuffer(zlib.decompress(s), np.uint8).reshape(8, n)
+    return b.T.copy().view('<i8').ravel().astype(np.int64)
+
+
+def group_bounds(sids):
+    """ Given an array of sorted ids, return the (starts, counts) of the runs of
+    equal ids."""
+    n = len(sids)
+    isstart = np.empty(n, bool)
+    isstart[:1] = True
+    np.not_equal(sids[1:], sids[:-1], isstart[1:])
+    starts = np.flatnonzero(isstart)
+    counts = np.diff(np.append(starts, n))
+    return starts, counts
+
+def group_diff(values, order, starts):
+    """ Delta-encode 'values' within each group of messages of the same symbol;
+    'order' is the stable sort of the symbol ids and 'starts' the beginning of
+    each group in it."""
+    v = values[order]
+    d = np.empty_like(v)
+    d[1:] = v[1:] - v[:-1]
+    d[starts] = v[starts]
+    r = np.empty_like(d)
+    r[order] = d
+    return r
+
+def group_cumsum(deltas, order, starts, counts):
+    "Reverse of group_diff()."
+    cs = np.cumsum(deltas[order])
+    base = np.zeros(len(starts), np.int64)
+    base[1:] = cs[starts[1:] - 1]
+    cs -= np.repeat(base, counts)
+    r = np.empty_like(cs)
+    r[order] = cs
+    return r
+
+
+
+class ColumnWriter(object):
+    """ A writer for 'zcol' dumpfiles. Messages are accumulated until a block
+    is full. You must call flush() to write out the last partial block. If you
+    append to an existing file, you must provide its symbol table, as a list of
+    (venue, symbol) pairs."""
+
+    def __init__(self, f, symbols=None, blocksize=BLOCKSIZE):
+        self.f = f
+        self.blocksize = blocksize
+
+        # The file's symbol table, as a mapping of (venue, symbol) -> id.
+        self.symids = {}
+        for venue, symbol in symbols or ():
+            self.symids[(venue, symbol)] = len(self.symids)
+        self.nsyms_written = len(self.symids)
+
+        self.clear()
+
+    def clear(self):
+        self.columns = ([], [], [], [], [])
+
+    def write(self, ts_actual, timestamp, venue, symbol, bid, ask):
+        tsacol, tscol, sidcol, bidcol, askcol = self.columns
+        key = (venue, symbol)
+        try:
+            sid = self.symids[key]
+        except KeyError:
+            sid = self.symids[key] = len(self.symids)
+        tsacol.append(ts_actual)
+        tscol.append(timestamp)
+        sidcol.append(sid)
+        bidcol.append(bid)
+        askcol.append(ask)
+        if len(tsacol) >= self.blocksize:
+            self.flush()
+
+    def flush(self):
+        tsacol, tscol, sidcol, bidcol, askcol = self.columns
+        n = len(tsacol)
+        if n == 0:
+            return
+        assert len(self.symids) < 0x10000, "Too many symbols."
+
+        tsa = np.array(tsacol, np.int64)
+        ts = np.array(tscol, np.int64)
+        sids = np.array(sidcol, np.uint16)
+        bids = np.array(bidcol, np.int64)
+        asks = np.array(askcol, np.int64)
+
+        dtsa = np.empty_like(tsa)
+        dtsa[0] = 0
+        dtsa[1:] = tsa[1:] - tsa[:-1]
+
+        order = np.argsort(sids, kind='mergesort')
+        starts, _ = group_bounds(sids[order])
+
+        # New entries for the symbol table.
+        newsyms = sorted((sid, key) for key, sid in self.symids.iteritems()
+                         if sid >= self.nsyms_written)
+        symsec = ''.join(symentry.pack(venue, symbol)
+                         for _, (venue, symbol) in newsyms)
+
+        sections = [symsec,
+                    shuffle(dtsa),
+                    shuffle(ts - tsa),
+                    zlib.compress(sids.astype('<u2').tostring(), LEVEL),
+                    shuffle(group_diff(bids, order, starts)),
+                    shuffle(group_diff(asks - bids, order, starts))]
+
+        self.f.write(blkhdr.pack(MAGIC, n, self.nsyms_written, len(newsyms),
+                                 tsa[0], tsa[-1],
+                                 *map(len, sections)))
+        for sec in sections:
+            self.f.write(sec)
+
+        self.nsyms_written = len(self.symids)
+        self.clear()
+
+
+def decode_block(header, sections, symbols):
+    """ Decode the sections of a block into an array of type 'rate_dtype'.
+    'symbols' is a NumPy array of the symbol table entries, with fields 'venue'
+    and 'symbol'."""
+
+    _, n, _, _, ts_first, _ = header[:6]
+    _, secdtsa, sects, secsids, secbids, secspreads = sections
+
+    out = np.empty(n, rate_dtype)
+    tsa = np.cumsum(unshuffle(secdtsa, n))
+    tsa += ts_first
+    out['ts_actual'] = tsa
+    out['timestamp'] = unshuffle(sects, n) + tsa
+
+    sids = np.frombuffer(zlib.decompress(secsids), '<u2').astype(np.intp)
+    syms = symbols[sids]
+    out['venue'] = syms['venue']
+    out['symbol'] = syms['symbol']
+
+    order = np.argsort(sids, kind='mergesort')
+    starts, counts = group_bounds(sids[order])
+    bids = group_cumsum(unshuffle(secbids, n), order, starts, counts)
+    out['bid'] = bids
+    out['ask'] = group_cumsum(unshuffle(secspreads, n),
+                              order, starts, counts) + bids
+    return out
+
+
+
+class ColumnDumpFile(DumpFile):
+    """ A dumpfile in the 'zcol' encoding. This supports the same interface as
+    DumpFile, with the exception of the raw iterator, since there are no
+    individual records for messages in this format. Seeking requires building a
+    directory of the blocks, which reads all the block headers; this is done on
+    demand."""
+
+    symtype = np.dtype([('venue', 'S1'), ('symbol', 'S7')])
+
+    def __init__(self, f, **kw):
+        DumpFile.__init__(self, f, 'zcol', None, None, None, **kw)
+
+        # The file's table of symbols, as a list of (venue, symbol) pairs and as
+        # an array.
+        self.symentries = []
+        self.symarray = np.empty(0, self.symtype)
+
+        # The directory of blocks, a list of (offset, msgno, nmsgs, ts_first,
+        # ts_last) tuples, and the list of block msgnos, for bisecting.
+        self.blocks = None
+        self.msgnos = None
+
+        # The current block and the position within it.
+        self.barr = np.empty(0, rate_dtype)
+        self.brows = None
+        self.bstart = 0
+        self.bpos = 0
+
+        # Offset of the next block in the file.
+        self.foffset = self.offset
+
+    def readheader(self):
+        """ Read a block header and the new symbols it declares, at the current
+        file position. Return None at the end of the file."""
+        hdr = self.f.read(blkhdr.size)
+        if len(hdr) < blkhdr.size:
+            return None
+        header = blkhdr.unpack(hdr)
+        magic, n, symbase, nnewsyms = header[:4]
+        if magic != MAGIC:
+            raise IOError("Invalid block in '%s'." % self.name)
+        symsec = self.f.read(header[6])
+        if symbase + nnewsyms > len(self.symentries):
+            assert symbase == len(self.symentries), "Missing symbols."
+            for i in xrange(nnewsyms):
+                venue, symbol = symentry.unpack_from(symsec, i * symentry.size)
+                self.symentries.append((venue, symbol))
+                self.symbols.intern(symbol.rstrip('\0'))
+            self.symarray = np.array(self.symentries, self.symtype)
+        return header
+
+    def readblock(self):
+        "Read and decode the next block. Return False at the end of the file."
+        self.f.seek(self.foffset)
+        header = self.readheader()
+        if header is None:
+            return False
+        sizes = header[6:]
+        sections = [None]
+        for size in sizes[1:]:
+            sec = self.f.read(size)
+            if len(sec) < size:
+                # Ignore a truncated block at the end of the file.
+                return False
+            sections.append(sec)
+        self.foffset = self.f.tell()
+        self.bstart += len(self.barr)
+        self.barr = decode_block(header, sections, self.symarray)
+        self.brows = None
+        self.bpos = 0
+        return True
+
+    def getblocks(self):
+        "Build the directory of blocks, if necessary, and return it."
+        if self.blocks is None:
+            try:
+                fsize = self.datasize()
+            except (IOError, OSError, AttributeError):
+                fsize = None
+            blocks = []
+            offset, msgno = self.offset, 0
+            self.f.seek(offset)
+            while 1:
+                header = self.readheader()
+                if header is None:
+                    break
+                n, ts_first, ts_last = header[1], header[4], header[5]
+                sizes = header[6:]
+                end = offset + blkhdr.size + sum(sizes)
+                if fsize is not None and end > fsize:
+                    break
+                blocks.append((offset, msgno, n, ts_first, ts_last))
+                self.f.seek(end)
+                offset, msgno = end, msgno + n
+            self.blocks = blocks
+            self.msgnos = [b[1] for b in blocks]
+            self.nmsgs = msgno
+            self.endoffset = offset
+        return self.blocks
+
+    def validsize(self):
+        """ Return the size of the file without any truncated block at its
+        end."""
+        self.getblocks()
+        return self.endoffset
+
+    def tell(self):
+        return self.bstart + self.bpos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.discard_ts.clear()
+        if whence == os.SEEK_CUR:
+            offset += self.tell()
+        elif whence == os.SEEK_END:
+            offset += len(self)
+        if self.bstart <= offset < self.bstart + len(self.barr):
+            self.bpos = offset - self.bstart
+            return
+        blocks = self.getblocks()
+        i = bisect_right(self.msgnos, offset) - 1
+        if i < 0 or offset >= self.nmsgs:
+            # Position at the end of the file.
+            self.foffset = self.endoffset
+            self.barr = np.empty(0, rate_dtype)
+            self.bstart = self.bpos = self.nmsgs
+            return
+        self.foffset, self.bstart = blocks[i][:2]
+        self.barr = self.barr[:0]
+        self.readblock()
+        self.bpos = offset - self.bstart
+
+    def rewind(self):
+        self.seek(0)
+
+    def __len__(self):
+        self.getblocks()
+        return self.nmsgs
+
+    def findtime(self, timestamp):
+        """ Find msg index to a specific timestamp. The blocks are found from
+        their headers and only one of them is decoded."""
+        orig = self.tell()
+        try:
+            blocks = self.getblocks()
+            if not blocks or timestamp < blocks[0][3]:
+                return 0
+            elif timestamp >= blocks[-1][4]:
+                return self.nmsgs
+            # Find the first block whose last message is at or after the time.
+            i = bisect_left([b[4] for b in blocks], timestamp)
+            self.seek(blocks[i][1])
+            tsa = self.barr['ts_actual']
+            idx = self.bstart + tsa.searchsorted(timestamp, 'left') - 1
+            return max(idx, 0)
+        finally:
+            self.seek(orig)
+
+    def nextmsg(self):
+        if self.bpos >= len(self.barr):
+            if not self.readblock():
+                raise StopIteration
+        if self.brows is None:
+            self.brows = self.barr.tolist()
+        ts_actual, timestamp, venue, symbol, bid, ask = self.brows[self.bpos]
+        self.bpos += 1
+        return RateUpdate(ts_actual, timestamp, venue,
+                          self.symbols.intern(symbol), bid, ask)
+
+    def iterdecode(self):
+        return self
+
+    def next(self):
+        if self.discard_ooo:
+            while 1:
+                e = self.nextmsg()
+                ts, sym = e.timestamp, e.symbol
+                pts = self.discard_ts.get(sym)
+                if pts is not None and ts < pts:
+                    continue
+                self.discard_ts[sym] = ts
+                return e
+        else:
+            return self.nextmsg()
+
+    def rawiter(self):
+        raise NotImplementedError(
+            "There are no raw records in a 'zcol' dumpfile; convert it first.")
+
+    def readarray(self, nmsgs=None):
+        parts = []
+        while nmsgs is None or nmsgs > 0:
+            if self.bpos >= len(self.barr):
+                if not self.readblock():
+                    break
+            end = len(self.barr)
+            if nmsgs is not None:
+                end = min(end, self.bpos + nmsgs)
+                nmsgs -= end - self.bpos
+            parts.append(self.barr[self.bpos:end])
+            self.bpos = end
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts or [self.barr[:0]])
+
+    def iterbatches(self, nmsgs=BLOCKSIZE):
+        while 1:
+            a = self.readarray(nmsgs)
+            if len(a) == 0:
+                break
+            yield RateBatch(a, self.symbols)
+
+
+def opendumpf(f, **kw):
+    return ColumnDumpFile(f, **kw)
+
+def openwriter(f):
+    # Continue the file's symbol table if we're appending to it.
+    try:
+        if getsize(f.name) > 0:
+            dumpf = opendump(f.name)
+            try:
+                dumpf.getblocks()
+                symbols = dumpf.symentries
+            finally:
+                dumpf.f.close()
+        else:
+            symbols = None
+    except (OSError, IOError):
+        symbols = None
+    return ColumnWriter(f, symbols)
+
+
+
+def test():
+    """ Write 'zcol' dumpfiles of various sizes, read them back, and check
+    seeking, findtime() and appending."""
+    import tempfile, shutil, gzip
+    from os.path import join
+    from oanserv.dumpfile import opendump_write, openwriter as dumpwriter
+
+    def messages(n, t):
+        rng = np.random.RandomState(n)
+        symbols = ('EUR/USD', 'USD/JPY', 'XAU/USD')
+        bids = [100000, 200000, 300000]
+        r = []
+        for i in xrange(n):
+            s = rng.randint(3)
+            bids[s] += rng.randint(-5, 6)
+            # Some updates arrive out of order.
+            ts = t + i * 10 - rng.randint(2) * 100
+            r.append((t + i * 10, ts, 'O', symbols[s],
+                      bids[s], bids[s] + rng.randint(1, 10)))
+        return r
+
+    def write(fn, msgs):
+        f, codec = opendump_write(fn, 'zcol')
+        writer = dumpwriter(f, codec)
+        for msg in msgs:
+            writer.write(*msg)
+        writer.flush()
+        f.close()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        t = 1220832000000
+        for n in 0, 1, BLOCKSIZE, BLOCKSIZE + 1, 3 * BLOCKSIZE - 1:
+            print 'Testing: %d messages' % n
+            fn = join(tmpdir, 'test%d.zcol' % n)
+            msgs = messages(n, t)
+            write(fn, msgs)
+
+            dumpf = opendump(fn)
+            assert dumpf.codecname == 'zcol'
+            assert len(dumpf) == n
+            assert [tuple(u) for u in dumpf] == msgs
+            dumpf.rewind()
+            assert sum(len(b) for b in dumpf.iterbatches(1000)) == n
+
+            # Seek around the block boundaries.
+            for i in 0, 1, BLOCKSIZE - 1, BLOCKSIZE, n - 1, n // 2:
+                if not 0 <= i < n:
+                    continue
+                dumpf.seek(i)
+                assert dumpf.tell() == i
+                assert tuple(dumpf.next()) == msgs[i], i
+            dumpf.seek(n)
+            assert list(dumpf) == []
+
+            # findtime() returns the message before the first one at or after
+            # the time.
+            for ts in t - 1, t, t + 5, t + n * 5, t + n * 10:
+                i = dumpf.findtime(ts)
+                assert 0 <= i <= n
+                if 0 < i < n:
+                    assert msgs[i][0] < ts <= msgs[i + 1][0], (ts, i)
+            assert dumpf.findtime(t - 1) == 0
+
+            # The length of a compressed copy is that of its data.
+            if n:
+                gf = gzip.open(fn + '.gz', 'wb')
+                gf.write(open(fn, 'rb').read())
+                gf.close()
+                assert len(opendump(fn + '.gz')) == n
+
+        # Appending continues the symbol table of the file.
+        fn = join(tmpdir, 'append.zcol')
+        msgs = messages(BLOCKSIZE + 10, t)
+        write(fn, msgs[:10])
+        write(fn, msgs[10:])
+        assert [tuple(u) for u in opendump(fn)] == msgs
+
+        # A truncated block at the end of the file is ignored.
+        open(fn, 'r+b').truncate(getsize(fn) - 1)
+        dumpf = opendump(fn)
+        assert len(dumpf) == 10
+        assert [tuple(u) for u in dumpf] == msgs[:10]
+        assert dumpf.validsize() < getsize(fn)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,610 @@
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+zdelta: Streaming delta encoding, for live recording.
+
+Each rate update is stored as the differences of its fields with those of the
+previous update of the same symbol, as zigzag-encoded varints (7 bits per byte,
+with the high bit set on all but the last byte). The encoder is stateful; it
+emits a keyframe periodically, after which all the state is reset, so that a
+reader can start decoding at any keyframe. The stream is a sequence of records,
+each starting with a tag byte:
+
+  Tag           Record          Contents
+  ------------- --------------- ----------------------------------------------
+  0x00 - 0xEF   update          deltas of ts_actual, timestamp, bid, ask for
+                                the symbol whose id is the tag
+  0xF0          update          id (varint), then the same four deltas
+  0xFD          symbol          id (varint), venue (1 byte), symbol (7 bytes)
+  0xFF          keyframe        see below
+  ----------------------------------------------------------------------------
+
+  Keyframe      Nb. Bytes       Data           Interpretation
+  ------------- --------------- -------------- -----------------
+  marker        8               str            KEYMARK
+  msgno         8               long           nb. of the next message
+  ts_actual     8               long           ts_actual of next message
+  crc           4               int            CRC-32 of msgno and ts_actual
+  --------------------------------------------------------------
+
+The symbol ids are only valid until the next keyframe; a symbol record is
+emitted before the first update of each symbol after a keyframe. The deltas of
+the first update of a symbol after a keyframe are computed from the keyframe's
+ts_actual for the timestamps and from zero for the prices. In order to seek,
+the reader binary searches the file by byte offset, scanning for the keyframe
+markers (their CRC protects against false positives in the data).
+
+This encoding is meant for recording: the varints have to be decoded one record
+at a time, so there is no vectorized decoder for it, and the bulk methods of
+the reader (readarray(), iterbatches(), iterfields()) are not any faster than
+iterating. Convert the files to another codec to analyse them.
+"""
+
+# stdlib imports
+import os, struct, logging, zlib
+from os.path import getsize
+
+# local imports
+from oanserv.dumpfile import DumpFile, RateUpdate, RateBatch, opendump
+
+
+__all__ = ('DeltaEncoder', 'DeltaDumpFile')
+
+
+KEYMARK = '\xffOANKEY\x01'
+stkey = struct.Struct('! 8s Q q I')
+assert stkey.size == 28, stkey.size
+stkeycrc = struct.Struct('! Q q')
+
+symentry = struct.Struct('! c 7s')
+
+TAG_EXTENDED = 0xF0
+TAG_SYMBOL = 0xFD
+TAG_KEYFRAME = 0xFF
+
+# Maximum nb. of messages and time (msecs) between keyframes.
+KEY_INTERVAL = 4096
+KEY_MSECS = 60 * 1000
+
+# Size of the chunks the reader reads the file in.
+CHUNKSIZE = 0x10000
+
+
+
+def zigzag(n):
+    "Map a signed int to an unsigned one, small in magnitude to small."
+    return (n << 1) ^ (n >> 63)
+
+def unzigzag(z):
+    "Reverse of zigzag()."
+    return (z >> 1) ^ -(z & 1)
+
+def putvarint(parts, z):
+    "Append the varint encoding of unsigned int 'z' to the list 'parts'."
+    while z >= 0x80:
+        parts.append(chr((z & 0x7f) | 0x80))
+        z >>= 7
+    parts.append(chr(z))
+
+def getvarint(b, i):
+    """ Decode a varint from bytearray 'b' at index 'i'; return the value and
+    the index after it. This raises IndexError if the buffer is too short."""
+    c = b[i]
+    if c < 0x80:
+        return c, i + 1
+    r, shift = c & 0x7f, 7
+    while 1:
+        i += 1
+        c = b[i]
+        r |= (c & 0x7f) << shift
+        if c < 0x80:
+            return r, i + 1
+        shift += 7
+
+def packkey(msgno, ts_actual):
+    crc = zlib.crc32(stkeycrc.pack(msgno, ts_actual)) & 0xffffffff
+    return stkey.pack(KEYMARK, msgno, ts_actual, crc)
+
+def unpackkey(b, i):
+    """ Decode and verify a keyframe at index 'i' of the buffer. Return
+    (msgno, ts_actual), or None if this is not a valid keyframe."""
+    marker, msgno, ts_actual, crc = stkey.unpack_from(b, i)
+    if (marker != KEYMARK or
+        zlib.crc32(stkeycrc.pack(msgno, ts_actual)) & 0xffffffff != crc):
+        return None
+    return msgno, ts_actual
+
+
+
+class DeltaEncoder(object):
+    """ A stateful encoder for 'zdelta'. The first message always gets a
+    keyframe; 'msgno' is the number of messages already in the file."""
+
+    def __init__(self, msgno=0,
+                 key_interval=KEY_INTERVAL, key_msecs=KEY_MSECS):
+        self.msgno = msgno
+        self.key_interval = key_interval
+        self.key_msecs = key_msecs
+        self.nextkey = msgno
+        self.keyts = None
+
+    def keyframe(self, parts, ts_actual):
+        parts.append(packkey(self.msgno, ts_actual))
+        self.nextkey = self.msgno + self.key_interval
+        self.keyts = ts_actual
+
+        # Mapping of (venue, symbol) -> id, and of id -> previous values.
+        self.symids = {}
+        self.prev = []
+
+    def encode(self, ts_actual, timestamp, venue, symbol, bid, ask):
+        parts = []
+        if (self.msgno >= self.nextkey or
+            ts_actual - self.keyts >= self.key_msecs):
+            self.keyframe(parts, ts_actual)
+
+        key = (venue, symbol)
+        try:
+            sid = self.symids[key]
+            prev = self.prev[sid]
+        except KeyError:
+            sid = self.symids[key] = len(self.prev)
+            prev = [self.keyts, self.keyts, 0, 0]
+            self.prev.append(prev)
+            parts.append(chr(TAG_SYMBOL))
+            putvarint(parts, sid)
+            parts.append(symentry.pack(venue, symbol))
+
+        if sid < TAG_EXTENDED:
+            parts.append(chr(sid))
+        else:
+            parts.append(chr(TAG_EXTENDED))
+            putvarint(parts, sid)
+        putvarint(parts, zigzag(ts_actual - prev[0]))
+        putvarint(parts, zigzag(timestamp - prev[1]))
+        putvarint(parts, zigzag(bid - prev[2]))
+        putvarint(parts, zigzag(ask - prev[3]))
+        prev[:] = ts_actual, timestamp, bid, ask
+
+        self.msgno += 1
+        return ''.join(parts)
+
+
+class DeltaWriter(object):
+    "A writer for 'zdelta' dumpfiles."
+
+    def __init__(self, f, msgno=0):
+        self.f = f
+        self.encode = DeltaEncoder(msgno).encode
+
+    def write(self, ts_actual, timestamp, venue, symbol, bid, ask):
+        self.f.write(self.encode(ts_actual, timestamp, venue, symbol, bid, ask))
+
+    def flush(self):
+        pass
+
+
+
+class DeltaDumpFile(DumpFile):
+    """ A dumpfile in the 'zdelta' encoding. This supports the same interface
+    as DumpFile, with the exception of the raw iterator. Seeking goes to the
+    closest keyframe before the desired message and decodes forward from it. A
+    truncated record at the end of the file is ignored."""
+
+    def __init__(self, f, **kw):
+        DumpFile.__init__(self, f, 'zdelta', None, None, None, **kw)
+
+        # The read buffer, the file offset of its first byte, and the position
+        # of the next record in it.
+        self.buf = bytearray()
+        self.bufoff = self.offset
+        self.bufpos = 0
+        self.f.seek(self.offset)
+
+        # The number of the next message, and the decoding state.
+        self.msgno = 0
+        self.keyts = 0
+        self.syms = {}
+        self.prev = {}
+
+    def fill(self):
+        "Read another chunk in the buffer. Return False at the end of file."
+        if self.bufpos > CHUNKSIZE:
+            del self.buf[:self.bufpos]
+            self.bufoff += self.bufpos
+            self.bufpos = 0
+        r = self.f.read(CHUNKSIZE)
+        if not r:
+            return False
+        self.buf.extend(r)
+        return True
+
+    def reset(self, offset):
+        "Position the reader at the given file offset, which has a keyframe."
+        self.f.seek(offset)
+        self.buf = bytearray()
+        self.bufoff = offset
+        self.bufpos = 0
+        self.discard_ts.clear()
+
+    def resync(self):
+        "Skip corrupted data up to the next valid keyframe."
+        logging.warning("Corrupted data in '%s' at offset %s; resyncing." %
+                        (self.name, self.bufoff + self.bufpos))
+        self.bufpos += 1
+        while 1:
+            i = self.buf.find(KEYMARK, self.bufpos)
+            if i == -1 or len(self.buf) - i < stkey.size:
+                self.bufpos = max(self.bufpos, len(self.buf) - stkey.size)
+                if not self.fill():
+                    self.bufpos = len(self.buf)
+                    return
+                continue
+            if unpackkey(self.buf, i) is not None:
+                self.bufpos = i
+                return
+            self.bufpos = i + 1
+
+    def nextmsg(self):
+        while 1:
+            b, i = self.buf, self.bufpos
+            try:
+                tag = b[i]
+                if tag <= TAG_EXTENDED:
+                    if tag == TAG_EXTENDED:
+                        sid, i = getvarint(b, i + 1)
+                    else:
+                        i += 1
+                        sid = tag
+                    z1, i = getvarint(b, i)
+                    z2, i = getvarint(b, i)
+                    z3, i = getvarint(b, i)
+                    z4, i = getvarint(b, i)
+                    prev = self.prev[sid]
+                    venue, symbol = self.syms[sid]
+                    prev[0] += (z1 >> 1) ^ -(z1 & 1)
+                    prev[1] += (z2 >> 1) ^ -(z2 & 1)
+                    prev[2] += (z3 >> 1) ^ -(z3 & 1)
+                    prev[3] += (z4 >> 1) ^ -(z4 & 1)
+                    self.bufpos = i
+                    self.msgno += 1
+                    return RateUpdate(prev[0], prev[1], venue, symbol,
+                                      prev[2], prev[3])
+
+                elif tag == TAG_SYMBOL:
+                    sid, i = getvarint(b, i + 1)
+                    if len(b) < i + symentry.size:
+                        raise IndexError
+                    venue, symbol = symentry.unpack_from(b, i)
+                    self.syms[sid] = (venue,
+                                      self.symbols.intern(symbol.rstrip('\0')))
+                    self.prev[sid] = [self.keyts, self.keyts, 0, 0]
+                    self.bufpos = i + symentry.size
+
+                elif tag == TAG_KEYFRAME:
+                    if len(b) < i + stkey.size:
+                        raise IndexError
+                    key = unpackkey(b, i)
+                    if key is None:
+                        self.resync()
+                        continue
+                    self.msgno, self.keyts = key
+                    self.syms.clear()
+                    self.prev.clear()
+                    self.bufpos = i + stkey.size
+
+                else:
+                    self.resync()
+
+            except IndexError:
+                if not self.fill():
+                    raise StopIteration
+            except KeyError:
+                self.resync()
+
+    def iterdecode(self):
+        return self
+
+    def next(self):
+        if self.discard_ooo:
+            while 1:
+                e = self.nextmsg()
+                ts, sym = e.timestamp, e.symbol
+                pts = self.discard_ts.get(sym)
+                if pts is not None and ts < pts:
+                    continue
+                self.discard_ts[sym] = ts
+                return e
+        else:
+            return self.nextmsg()
+
+    def rawiter(self):
+        raise NotImplementedError(
+            "There are no raw records in a 'zdelta' dumpfile; convert it first.")
+
+    def readarray(self, nmsgs=None):
+        """ Decode up to 'nmsgs' messages into an array of type
+        oanserv.dumparray.rate_dtype. Note that there is no vectorized decoder
+        for this encoding: the messages are decoded one at a time, as by the
+        iterator, so this is not any faster than iterating."""
+        import numpy
+        from itertools import islice
+        from oanserv.dumparray import rate_dtype
+        return numpy.array([tuple(u) for u in islice(self, nmsgs)], rate_dtype)
+
+    def iterbatches(self, nmsgs=KEY_INTERVAL):
+        while 1:
+            a = self.readarray(nmsgs)
+            if len(a) == 0:
+                break
+            yield RateBatch(a, self.symbols)
+
+    # Keyframe search.
+
+    def probe(self, offset, end=None):
+        """ Find the first valid keyframe at or after file offset 'offset' (and
+        before 'end'). Return (offset, msgno, ts_actual), or None."""
+        f = self.f
+        f.seek(offset)
+        data = ''
+        while end is None or offset < end:
+            r = f.read(CHUNKSIZE)
+            if not r:
+                return None
+            data += r
+            i = 0
+            while 1:
+                i = data.find(KEYMARK, i)
+                if i == -1 or len(data) - i < stkey.size:
+                    break
+                if end is not None and offset + i >= end:
+                    return None
+                key = unpackkey(data, i)
+                if key is not None:
+                    return (offset + i,) + key
+                i += 1
+            # Drop the searched data, but keep the beginning of a keyframe that
+            # may straddle the chunks.
+            if i == -1:
+                i = max(0, len(data) - (stkey.size - 1))
+            offset += i
+            data = data[i:]
+        return None
+
+    def findkey(self, toolate):
+        """ Return the last keyframe for which 'toolate(key)' is false, as an
+        (offset, msgno, ts_actual) triple. This assumes the predicate is
+        monotonic over the file; the first keyframe is always returned if there
+        is no such keyframe. This does not change the reader's position."""
+        try:
+            best = self.probe(self.offset)
+            if best is None:
+                return None
+            lo, hi = best[0] + 1, self.datasize()
+            while lo < hi:
+                mid = (lo + hi) // 2
+                key = self.probe(mid, hi)
+                if key is None or toolate(key):
+                    hi = mid
+                else:
+                    best = key
+                    lo = key[0] + 1
+            return best
+        finally:
+            self.f.seek(self.bufoff + len(self.buf))
+
+    def seekkey(self, key):
+        "Position the reader at the given keyframe."
+        self.reset(key[0])
+        self.msgno = key[1]
+
+    def tell(self):
+        return self.msgno
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.tell()
+        elif whence == os.SEEK_END:
+            offset += len(self)
+        if offset < self.msgno:
+            key = self.findkey(lambda key: key[1] > offset)
+            if key is None:
+                return
+            self.seekkey(key)
+        elif offset > self.msgno + KEY_INTERVAL:
+            key = self.findkey(lambda key: key[1] > offset)
+            if key is not None and key[1] > self.msgno:
+                self.seekkey(key)
+        self.discard_ts.clear()
+        try:
+            while self.msgno < offset:
+                self.nextmsg()
+        except StopIteration:
+            pass
+
+    def rewind(self):
+        self.seek(0)
+
+    def __len__(self):
+        orig = self.msgno
+        try:
+            key = self.findkey(lambda key: False)
+            if key is None:
+                return 0
+            self.seekkey(key)
+            try:
+                while 1:
+                    self.nextmsg()
+            except StopIteration:
+                pass
+            return self.msgno
+        finally:
+            self.seek(orig)
+
+    def validsize(self):
+        """ Return the size of the file without any truncated data at its
+        end."""
+        key = self.findkey(lambda key: False)
+        if key is None:
+            return self.offset
+        self.seekkey(key)
+        try:
+            while 1:
+                self.nextmsg()
+        except StopIteration:
+            pass
+        return self.bufoff + self.bufpos
+
+    def findtime(self, timestamp):
+        """ Find msg index to a specific timestamp. We find the last keyframe
+        before it and decode forward from there."""
+        orig = self.tell()
+        try:
+            nmax = len(self)
+            if nmax == 0 or timestamp < self.first().ts_actual:
+                return 0
+            elif timestamp >= self.last().ts_actual:
+                return nmax
+            key = self.findkey(lambda key: key[2] >= timestamp)
+            self.seekkey(key)
+            try:
+                while 1:
+                    if self.nextmsg().ts_actual >= timestamp:
+                        return max(self.msgno - 2, 0)
+            except StopIteration:
+                return nmax
+        finally:
+            self.seek(orig)
+
+
+def opendumpf(f, **kw):
+    return DeltaDumpFile(f, **kw)
+
+def openwriter(f):
+    # Continue the numbering of the messages if we're appending to a file.
+    try:
+        msgno = 0
+        if getsize(f.name) > 0:
+            dumpf = opendump(f.name)
+            try:
+                msgno = len(dumpf)
+            finally:
+                dumpf.f.close()
+    except (OSError, IOError):
+        msgno = 0
+    return DeltaWriter(f, msgno)
+
+
+
+def test():
+    """ Write 'zdelta' dumpfiles of various sizes, read them back, and check
+    seeking, findtime(), appending and recovery from corrupted data."""
+    import tempfile, shutil, gzip, random
+    from os.path import join
+    from oanserv.dumpfile import opendump_write, openwriter as dumpwriter
+
+    def messages(n, t, nsyms=3):
+        rnd = random.Random(n)
+        bids = [100000 * (s + 1) for s in xrange(nsyms)]
+        r = []
+        for i in xrange(n):
+            s = rnd.randrange(nsyms)
+            bids[s] += rnd.randint(-5, 5)
+            # Some updates arrive out of order, and there is a long gap
+            # halfway.
+            tsa = t + i * 10 + (KEY_MSECS if i >= n // 2 else 0)
+            r.append((tsa, tsa - rnd.randrange(2) * 100, 'O', 'S%06d' % s,
+                      bids[s], bids[s] + rnd.randint(1, 10)))
+        return r
+
+    def write(fn, msgs):
+        f, codec = opendump_write(fn, 'zdelta')
+        writer = dumpwriter(f, codec)
+        for msg in msgs:
+            writer.write(*msg)
+        writer.flush()
+        f.close()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        t = 1220832000000
+        for n in 0, 1, KEY_INTERVAL, KEY_INTERVAL + 1, 3 * KEY_INTERVAL - 1:
+            print 'Testing: %d messages' % n
+            fn = join(tmpdir, 'test%d.zdelta' % n)
+            msgs = messages(n, t)
+            write(fn, msgs)
+
+            dumpf = opendump(fn)
+            assert dumpf.codecname == 'zdelta'
+            assert len(dumpf) == n
+            assert [tuple(u) for u in dumpf] == msgs
+
+            # Seek around the keyframes, backwards and forwards.
+            for i in (n - 1, 0, KEY_INTERVAL, KEY_INTERVAL - 1, 1, n // 2,
+                      2 * KEY_INTERVAL + 1):
+                if not 0 <= i < n:
+                    continue
+                dumpf.seek(i)
+                assert dumpf.tell() == i
+                assert tuple(dumpf.next()) == msgs[i], i
+            dumpf.seek(n)
+            assert list(dumpf) == []
+
+            # findtime() returns the message before the first one at or after
+            # the time.
+            for ts in (t - 1, t, t + 5, msgs[n // 2][0] if n else t,
+                       t + n * 10 + KEY_MSECS):
+                i = dumpf.findtime(ts)
+                assert 0 <= i <= n
+                if 0 < i < n:
+                    assert msgs[i][0] < ts <= msgs[i + 1][0], (ts, i)
+            assert dumpf.findtime(t - 1) == 0
+
+            # The length of a compressed copy is that of its data.
+            if n:
+                gf = gzip.open(fn + '.gz', 'wb')
+                gf.write(open(fn, 'rb').read())
+                gf.close()
+                assert len(opendump(fn + '.gz')) == n
+
+        # Many symbols, with extended tags.
+        fn = join(tmpdir, 'symbols.zdelta')
+        msgs = messages(2000, t, TAG_EXTENDED + 100)
+        write(fn, msgs)
+        assert [tuple(u) for u in opendump(fn)] == msgs
+
+        # Appending continues the numbering of the messages.
+        fn = join(tmpdir, 'append.zdelta')
+        msgs = messages(KEY_INTERVAL + 10, t)
+        write(fn, msgs[:10])
+        write(fn, msgs[10:])
+        dumpf = opendump(fn)
+        assert [tuple(u) for u in dumpf] == msgs
+        dumpf.seek(KEY_INTERVAL + 5)
+        assert tuple(dumpf.next()) == msgs[KEY_INTERVAL + 5]
+
+        # A truncated record at the end of the file is ignored.
+        size = getsize(fn)
+        open(fn, 'r+b').truncate(size - 1)
+        dumpf = opendump(fn)
+        assert [tuple(u) for u in dumpf] == msgs[:-1]
+        assert dumpf.validsize() < size - 1
+
+        # Corrupted data is skipped up to the next keyframe.
+        fn = join(tmpdir, 'corrupt.zdelta')
+        msgs = messages(2 * KEY_INTERVAL, t)
+        write(fn, msgs)
+        f = open(fn, 'r+b')
+        f.seek(dumpf.offset + 1000)
+        f.write('\xfe' * 10)
+        f.close()
+        dumpf = opendump(fn)
+        r = [tuple(u) for u in dumpf]
+        assert r[-KEY_INTERVAL:] == msgs[-KEY_INTERVAL:]
+        assert len(r) < len(msgs)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,294 @@
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+Bulk decoding of dumpfile messages into NumPy arrays.
+
+The per-message decoders in oanserv.dumpfile unpack one struct at a time and
+allocate a RateUpdate for each message. Here we map an entire buffer of
+fixed-size records onto a NumPy record type that mirrors the struct layout of
+each codec, and rebuild the 48-bit high/low pairs produced by int2hi() with
+vectorized arithmetic. Decoding a block of many thousands of messages this way
+costs a handful of array operations.
+"""
+
+# numpy imports
+import numpy as np
+
+
+__all__ = ('rate_dtype', 'decode_block', 'decode_fields', 'encode_block',
+           'symbol_keys')
+
+
+# The type of the decoded arrays; the fields are in the same order as those of
+# RateUpdate.
+rate_dtype = np.dtype([('ts_actual', np.int64),
+                       ('timestamp', np.int64),
+                       ('venue', 'S1'),
+                       ('symbol', 'S7'),
+                       ('bid', np.int64),
+                       ('ask', np.int64)])
+
+
+# Record layouts for each codec. These must match the struct formats in
+# oanserv.dumpfile exactly (note that all the structs are in network byte order
+# without any padding).
+_layouts = {
+    'raw24': np.dtype([('tsh', '>u2'), ('tsl', '>u4'),
+                       ('base', 'S3'), ('quote', 'S3'),
+                       ('bidh', '>u2'), ('bidl', '>u4'),
+                       ('askh', '>u2'), ('askl', '>u4')]),
+
+    'raw32': np.dtype([('timestamp', '>i8'),
+                       ('venue', 'S1'), ('symbol', 'S7'),
+                       ('bid', '>i8'), ('ask', '>i8')]),
+
+    'raw40': np.dtype([('ts_actual', '>i8'), ('timestamp', '>i8'),
+                       ('venue', 'S1'), ('symbol', 'S7'),
+                       ('bid', '>i8'), ('ask', '>i8')]),
+
+    'raw32n': np.dtype([('tsah', '>u2'), ('tsal', '>u4'),
+                        ('tsh', '>u2'), ('tsl', '>u4'),
+                        ('venue', 'S1'), ('symbol', 'S7'),
+                        ('bidh', '>u2'), ('bidl', '>u4'),
+                        ('askh', '>u2'), ('askl', '>u4')]),
+    }
+
+def getlayout(codecname):
+    """ Return the NumPy record type for the given codec."""
+    if codecname is None:
+        codecname = 'raw32n' # Default encoder/decoder.
+    try:
+        return _layouts[codecname]
+    except KeyError:
+        raise KeyError("No bulk decoder for codec: %s" % repr(codecname))
+
+
+def hi2int_array(high, low):
+    """ Vectorized version of hi2int(): convert arrays of (short-int, int) pairs
+    into an array of 64-bit ints."""
+    r = high.astype(np.int64)
+    r <<= 32
+    r |= low
+    return r
+
+def int2hi_array(lint):
+    """ Vectorized version of int2hi(): convert an array of 64-bit ints into
+    arrays of (short-int, int) pairs."""
+    lint = np.asarray(lint, np.int64)
+    assert (lint >= 0).all() and (lint < 2**48).all()
+    return lint >> 32, lint & 0xffffffff
+
+
+def decode_block(codecname, buf, out=None):
+    """ Decode a buffer of fixed-size messages encoded with 'codecname' into an
+    array of type 'rate_dtype'. The buffer may be a string or any object that
+    supports the buffer interface; trailing bytes that do not make up a complete
+    message are ignored. If 'out' is provided, it must be an array of type
+    'rate_dtype' large enough to hold all the messages; the returned array is
+    then a slice of it."""
+
+    layout = getlayout(codecname)
+    n = len(buf) // layout.itemsize
+    raw = np.frombuffer(buf, layout, n)
+
+    if out is None:
+        out = np.empty(n, rate_dtype)
+    else:
+        assert out.dtype == rate_dtype, out.dtype
+        assert len(out) >= n, (len(out), n)
+        out = out[:n]
+
+    if codecname == 'raw24':
+        out['timestamp'] = hi2int_array(raw['tsh'], raw['tsl'])
+        out['ts_actual'] = out['timestamp']
+        out['venue'] = 'O' # DEFAULT_VENUE, not encoded in this format.
+
+        # Build the 'BAS/QUO' symbols by moving the bytes around.
+        sym = np.empty((n, 7), np.uint8)
+        size = layout.itemsize
+        braw = np.frombuffer(buf, np.uint8, n * size).reshape(n, size)
+        sym[:,0:3] = braw[:,6:9]
+        sym[:,3] = ord('/')
+        sym[:,4:7] = braw[:,9:12]
+        out['symbol'] = sym.view('S7').ravel()
+
+        out['bid'] = hi2int_array(raw['bidh'], raw['bidl'])
+        out['ask'] = hi2int_array(raw['askh'], raw['askl'])
+
+    elif codecname == 'raw32n':
+        out['ts_actual'] = hi2int_array(raw['tsah'], raw['tsal'])
+        out['timestamp'] = hi2int_array(raw['tsh'], raw['tsl'])
+        out['venue'] = raw['venue']
+        out['symbol'] = raw['symbol']
+        out['bid'] = hi2int_array(raw['bidh'], raw['bidl'])
+        out['ask'] = hi2int_array(raw['askh'], raw['askl'])
+
+    else:
+        # Note: 'raw32' uses the same timestamp to fill in.
+        out['ts_actual'] = raw['ts_actual' if codecname == 'raw40'
+                               else 'timestamp']
+        for field in 'timestamp', 'venue', 'symbol', 'bid', 'ask':
+            out[field] = raw[field]
+
+    return out
+
+
+# The fields encoded as (short-int, int) pairs, per codec.
+_hilo_fields = {
+    'raw24': {'ts_actual': ('tsh', 'tsl'), 'timestamp': ('tsh', 'tsl'),
+              'bid': ('bidh', 'bidl'), 'ask': ('askh', 'askl')},
+    'raw32n': {'ts_actual': ('tsah', 'tsal'), 'timestamp': ('tsh', 'tsl'),
+               'bid': ('bidh', 'bidl'), 'ask': ('askh', 'askl')},
+    }
+
+def decode_fields(codecname, buf, fields):
+    """ Decode only the given fields (names of RateUpdate fields) of a buffer of
+    fixed-size messages, and return a tuple of arrays, one per field. This is
+    cheaper than decode_block() when only a few fields are needed, e.g. the
+    timestamps."""
+
+    layout = getlayout(codecname)
+    n = len(buf) // layout.itemsize
+    raw = np.frombuffer(buf, layout, n)
+    hilo = _hilo_fields.get(codecname, {})
+
+    r = []
+    for field in fields:
+        if field in hilo:
+            high, low = hilo[field]
+            a = hi2int_array(raw[high], raw[low])
+        elif codecname == 'raw24':
+            # The venue is not encoded, and the symbol has to be rebuilt.
+            a = decode_block(codecname, buf)[field]
+        else:
+            # Note: 'raw32' uses the same timestamp to fill in.
+            if field == 'ts_actual' and codecname == 'raw32':
+                field = 'timestamp'
+            a = raw[field]
+            if a.dtype.kind == 'i':
+                a = a.astype(np.int64)
+        r.append(a)
+    return tuple(r)
+
+
+def encode_block(codecname, arr):
+    """ Encode an array of type 'rate_dtype' into a string of fixed-size messages
+    in the 'codecname' encoding. This is the inverse of decode_block()."""
+
+    layout = getlayout(codecname)
+    n = len(arr)
+    raw = np.empty(n, layout)
+
+    if codecname == 'raw24':
+        raw['tsh'], raw['tsl'] = int2hi_array(arr['timestamp'])
+
+        # Split the 'BAS/QUO' symbols.
+        sym = np.frombuffer(arr['symbol'].astype('S7').tostring(),
+                            np.uint8).reshape(n, 7)
+        raw['base'] = np.ascontiguousarray(sym[:,0:3]).view('S3').ravel()
+        raw['quote'] = np.ascontiguousarray(sym[:,4:7]).view('S3').ravel()
+
+        raw['bidh'], raw['bidl'] = int2hi_array(arr['bid'])
+        raw['askh'], raw['askl'] = int2hi_array(arr['ask'])
+
+    elif codecname == 'raw32n':
+        raw['tsah'], raw['tsal'] = int2hi_array(arr['ts_actual'])
+        raw['tsh'], raw['tsl'] = int2hi_array(arr['timestamp'])
+        raw['venue'] = arr['venue']
+        raw['symbol'] = arr['symbol']
+        raw['bidh'], raw['bidl'] = int2hi_array(arr['bid'])
+        raw['askh'], raw['askl'] = int2hi_array(arr['ask'])
+
+    else:
+        if codecname == 'raw40':
+            raw['ts_actual'] = arr['ts_actual']
+        for field in 'timestamp', 'venue', 'symbol', 'bid', 'ask':
+            raw[field] = arr[field]
+
+    return raw.tostring()
+
+
+def symbol_keys(codecname, buf):
+    """ Return the records of a buffer of fixed-size messages as a 2-d array of
+    bytes, one row per record, and an array of integer keys of their venue and
+    symbol, taken from the raw bytes without decoding (the base and quote
+    currencies, for raw24). Records with the same key have the same venue and
+    symbol; decode one of them to find out which."""
+
+    layout = getlayout(codecname)
+    size = layout.itemsize
+    n = len(buf) // size
+    raw = np.frombuffer(buf, np.uint8, n * size).reshape(n, size)
+    if codecname == 'raw24':
+        beg, nbytes = layout.fields['base'][1], 6
+    else:
+        beg, nbytes = layout.fields['venue'][1], 8
+
+    kraw = np.zeros((n, 8), np.uint8)
+    kraw[:,:nbytes] = raw[:,beg:beg + nbytes]
+    return raw, kraw.view(np.uint64).ravel()
+
+
+def test():
+    """ Check that the bulk encoders and decoders round-trip in all the codecs
+    and agree with the per-message decoders, including on empty buffers and
+    trailing partial records."""
+
+    from oanserv.dumpfile import getcodec
+
+    n = 1000
+    rng = np.random.RandomState(0)
+    arr = np.empty(n, rate_dtype)
+    arr['timestamp'] = 1230000000000 + np.arange(n) * 250
+    arr['ts_actual'] = arr['timestamp'] # raw24 and raw32 store a single one.
+    arr['venue'] = 'O'
+    arr['symbol'] = np.array(['EUR/USD', 'USD/JPY', 'XAU/USD'])[
+        rng.randint(0, 3, n)]
+    arr['bid'] = rng.randint(100000, 200000, n)
+    arr['ask'] = arr['bid'] + rng.randint(0, 50, n)
+
+    for codec in sorted(_layouts):
+        print 'Testing: %s' % codec
+        _, decode, msgsize = getcodec(codec)
+        buf = encode_block(codec, arr)
+        assert len(buf) == n * msgsize, (codec, len(buf))
+
+        # Round-trip, and agreement with the per-message decoder.
+        dec = decode_block(codec, buf)
+        assert (dec == arr).all(), codec
+        for i in 0, 1, n-1:
+            assert tuple(dec[i]) == tuple(decode(buf[i*msgsize:(i+1)*msgsize]))
+
+        # Empty buffers, single records and trailing partial records.
+        assert len(decode_block(codec, '')) == 0
+        assert len(decode_block(codec, buf[:msgsize-1])) == 0
+        one = decode_block(codec, buf[:msgsize])
+        assert len(one) == 1 and one[0] == arr[0]
+        assert (decode_block(codec, buf[:-1]) == arr[:-1]).all()
+        assert encode_block(codec, arr[:0]) == ''
+
+        # Decoding into a preallocated array.
+        out = np.empty(n + 10, rate_dtype)
+        assert (decode_block(codec, buf, out) == arr).all()
+
+        # Decoding selected fields.
+        fields = ('ts_actual', 'symbol', 'bid')
+        for field, a in zip(fields, decode_fields(codec, buf, fields)):
+            assert (a == arr[field]).all(), (codec, field)
+        for a in decode_fields(codec, '', fields):
+            assert len(a) == 0
+
+        # Records have the same key if and only if they have the same symbol.
+        raw, keys = symbol_keys(codec, buf)
+        assert raw.shape == (n, msgsize)
+        assert raw.tostring() == buf
+        for sym in np.unique(arr['symbol']):
+            sel = arr['symbol'] == sym
+            assert len(np.unique(keys[sel])) == 1
+            assert not (keys[~sel] == keys[sel][0]).any()
+        raw, keys = symbol_keys(codec, '')
+        assert raw.shape == (0, msgsize) and len(keys) == 0
+
+if __name__ == '__main__':
+    test()
@@ -32,10 +32,14 @@ from subprocess import *
 
 # local imports
 from collections import namedtuple
+from functools import partial
 from oanserv.ext.headfile import HeadFile
+from oanserv.blockzip import BlockZipFile, isblockzip, ZBLK_SUFFIX
 
 
-__all__ = ('getcodec', 'opendump', 'opendump_stdin')
+__all__ = ('getcodec', 'openwriter', 'opendump', 'opendump_stdin',
+           'opendump_write', 'openfile', 'readheader', 'packheader',
+           'RateUpdate', 'RateBatch', 'Symbol', 'SymbolTable')
 
 
 # Constants.
@@ -82,7 +86,10 @@ The data is in the following format:
 st24 = struct.Struct('! HI 3s 3s HI HI')
 assert st24.size == 24, st24.size
 pack24 = st24.pack
-unpack24 = st24.unpack
+unpack24 = st24.unpack_from
+
+# Same, with the symbol as a single field, for lookups in a symbol table.
+unpack24s = struct.Struct('! HI 6s HI HI').unpack_from
 
 def encode_24(ts_actual, timestamp, venue, symbol, lbid, lask):
     # Note: 'ts_actual' and 'venue' are ignored.
@@ -92,12 +99,21 @@ def encode_24(ts_actual, timestamp, venue, symbol, lbid, lask):
     base, quote = symbol.split('/')
     return pack24(tsh, tsl, base, quote, bidh, bidl, askh, askl)
 
-def decode_24(msg):
-    assert len(msg) == 24, "Truncated message: %s bytes only" % len(msg)
-    tsh, tsl, base, quote, bidh, bidl, askh, askl = unpack24(msg)
+def format_24(rawsym):
+    "Convert the 6 bytes of the base and quote instruments into a symbol."
+    return '%s/%s' % (rawsym[:3], rawsym[3:])
+
+def decode_24(msg, symtab=None, offset=0):
+    assert len(msg) - offset >= 24, "Truncated message: %s bytes only" % (
+        len(msg) - offset)
+    if symtab is None:
+        tsh, tsl, base, quote, bidh, bidl, askh, askl = unpack24(msg, offset)
+        symbol = '%s/%s' % (base, quote)
+    else:
+        tsh, tsl, rawsym, bidh, bidl, askh, askl = unpack24s(msg, offset)
+        symbol = symtab[rawsym]
     timestamp = hi2int(tsh, tsl)
     assert timestamp > 0
-    symbol = '%s/%s' % (base, quote)
     ibid = hi2int(bidh, bidl)
     iask = hi2int(askh, askl)
     assert ibid > 0
@@ -127,15 +143,18 @@ The data is in the following format:
 st32 = struct.Struct('! q c 7s q q')
 assert st32.size == 32, st32.size
 pack32 = st32.pack
-unpack32 = st32.unpack
+unpack32 = st32.unpack_from
 
 def encode_32(ts_actual, timestamp, venue, symbol, lbid, lask):
     # Note: 'ts_actual' is ignored.
     return pack32(timestamp, venue, symbol, lbid, lask)
 
-def decode_32(msg):
-    assert len(msg) == 32, "Truncated message: %s bytes only" % len(msg)
-    timestamp, venue, symbol, lbid, lask = unpack32(msg)
+def decode_32(msg, symtab=None, offset=0):
+    assert len(msg) - offset >= 32, "Truncated message: %s bytes only" % (
+        len(msg) - offset)
+    timestamp, venue, symbol, lbid, lask = unpack32(msg, offset)
+    if symtab is not None:
+        symbol = symtab[symbol]
     # Note: use same timestamp to fill in.
     return RateUpdate(timestamp, timestamp, venue, symbol, lbid, lask)
 
@@ -160,15 +179,18 @@ The data is in the following format:
 st40 = struct.Struct('! q q c 7s q q')
 assert st40.size == 40, st40.size
 pack40 = st40.pack
-unpack40 = st40.unpack
+unpack40 = st40.unpack_from
 
 def encode_40(ts_actual, timestamp, venue, symbol, lbid, lask):
     # Note: 'ts_actual' is ignored.
     return pack40(ts_actual, timestamp, venue, symbol, lbid, lask)
 
-def decode_40(msg):
-    assert len(msg) == 40, "Truncated message: %s bytes only" % len(msg)
-    ts_actual, timestamp, venue, symbol, lbid, lask = unpack40(msg)
+def decode_40(msg, symtab=None, offset=0):
+    assert len(msg) - offset >= 40, "Truncated message: %s bytes only" % (
+        len(msg) - offset)
+    ts_actual, timestamp, venue, symbol, lbid, lask = unpack40(msg, offset)
+    if symtab is not None:
+        symbol = symtab[symbol]
     # Note: use same timestamp to fill in.
     return RateUpdate(ts_actual, timestamp, venue, symbol, lbid, lask)
 
@@ -195,7 +217,7 @@ The data is in the following format:
 st32n = struct.Struct('! HI HI c 7s HI HI')
 assert st32n.size == 32, st32n.size
 pack32n = st32n.pack
-unpack32n = st32n.unpack
+unpack32n = st32n.unpack_from
 
 def encode_32n(ts_actual, timestamp, venue, symbol, ibid, iask):
     tsah, tsal = int2hi(ts_actual)
@@ -204,9 +226,13 @@ def encode_32n(ts_actual, timestamp, venue, symbol, ibid, iask):
     askh, askl = int2hi(iask)
     return pack32n(tsah, tsal, tsh, tsl, venue, symbol, bidh, bidl, askh, askl)
 
-def decode_32n(msg):
-    assert len(msg) == 32, "Truncated message: %s bytes only" % len(msg)
-    tsah, tsal, tsh, tsl, venue, symbol, bidh, bidl, askh, askl = unpack32n(msg)
+def decode_32n(msg, symtab=None, offset=0):
+    assert len(msg) - offset >= 32, "Truncated message: %s bytes only" % (
+        len(msg) - offset)
+    (tsah, tsal, tsh, tsl, venue, symbol,
+     bidh, bidl, askh, askl) = unpack32n(msg, offset)
+    if symtab is not None:
+        symbol = symtab[symbol]
     ts_actual = hi2int(tsah, tsal)
     assert ts_actual > 0
     timestamp = hi2int(tsh, tsl)
@@ -228,14 +254,107 @@ if __c_encoders:
         from oanda._oanda import _fast_encode_32n, _fast_decode_32n
         def encode_32n(*args):
             return pack32n(*_fast_encode_32n(*args))
-        def decode_32n(msg):
-            return RateUpdate(*_fast_decode_32n(unpack32n(msg)))
+        def decode_32n(msg, symtab=None, offset=0):
+            return RateUpdate(*_fast_decode_32n(unpack32n(msg, offset)))
     except ImportError:
         logging.warning("Using slow version of 'raw32n' codec.")
 
 
 
 
+#-------------------------------------------------------------------------------
+# Symbol interning.
+
+class Symbol(str):
+    """ An instrument name, interned in a SymbolTable. It behaves like the
+    plain string, and carries a small integer 'id', which is unique within its
+    table; use it for grouping and lookups in per-symbol code."""
+
+    def __new__(cls, name, id):
+        self = str.__new__(cls, name)
+        self.id = id
+        return self
+
+    def __reduce__(self):
+        return (Symbol, (str(self), self.id))
+
+class SymbolTable(dict):
+    """ A mapping of the raw bytes of the symbol field of encoded messages to
+    interned Symbol objects, already stripped of their padding. The decoders
+    accept such a table in order to avoid creating a new string for every
+    message. A table can be initialized with a list of symbol names, e.g. from
+    the header of a file, in order to fix their ids."""
+
+    def __init__(self, names=(), fmt=None):
+        dict.__init__(self)
+        self.fmt = fmt
+
+        # A list of the interned symbols, by id, and a mapping by name.
+        self.symbols = []
+        self.byname = {}
+        for name in names:
+            self.intern(name)
+
+    def intern(self, name):
+        """ Return the Symbol for the given (stripped) name, creating it if
+        necessary. """
+        try:
+            return self.byname[name]
+        except KeyError:
+            sym = self.byname[name] = Symbol(name, len(self.symbols))
+            self.symbols.append(sym)
+            return sym
+
+    def __missing__(self, rawsym):
+        if self.fmt is not None:
+            name = self.fmt(rawsym)
+        else:
+            name = rawsym.strip('\0 ')
+        sym = self[rawsym] = self.intern(name)
+        return sym
+
+# Functions that produce symbol names from the raw symbol bytes, for the codecs
+# where this is not just stripping the padding.
+_symfmts = {
+    'raw24': format_24,
+    }
+
+
+#-------------------------------------------------------------------------------
+# Partial decoding: the searches and statistics on the times of the messages do
+# not need to decode the symbols and prices. These decoders return only the
+# (ts_actual, timestamp) pair of a message. See also the vectorized
+# oanserv.dumparray.decode_fields().
+
+sttimes24 = struct.Struct('! HI')
+sttimes32 = struct.Struct('! q')
+sttimes40 = struct.Struct('! q q')
+sttimes32n = struct.Struct('! HI HI')
+
+def times_24(msg, offset=0):
+    tsh, tsl = sttimes24.unpack_from(msg, offset)
+    timestamp = hi2int(tsh, tsl)
+    return timestamp, timestamp
+
+def times_32(msg, offset=0):
+    timestamp, = sttimes32.unpack_from(msg, offset)
+    return timestamp, timestamp
+
+def times_40(msg, offset=0):
+    return sttimes40.unpack_from(msg, offset)
+
+def times_32n(msg, offset=0):
+    tsah, tsal, tsh, tsl = sttimes32n.unpack_from(msg, offset)
+    return hi2int(tsah, tsal), hi2int(tsh, tsl)
+
+_timedecoders = {
+    'raw32n': times_32n,
+    'raw40': times_40,
+    'raw32': times_32,
+    'raw24': times_24,
+    }
+
+
 #-------------------------------------------------------------------------------
 
 _codecs_names = ('raw32n', 'raw32', 'raw24', 'raw40')
@@ -246,6 +365,14 @@ _codecs = {
     'raw24': (encode_24, decode_24, st24.size)
     }
 
+# Codecs whose messages are not encoded in fixed-size records. These are
+# implemented in their own modules, which provide 'opendumpf(f, **kw)' and
+# 'openwriter(f)' functions. Files in these encodings start with a magic string.
+_blockcodecs = {
+    'zcol': ('ZCB1', 'oanserv.colfile'),
+    'zdelta': ('\xffOANKEY', 'oanserv.deltafile'),
+    }
+
 def getcodec(codecname):
     """ Return appropriate (encoder, decoder, msgsize) triple for the given
     codec."""
@@ -253,11 +380,120 @@ def getcodec(codecname):
         codecname = 'raw32n' # Default encoder/decoder.
     try:
         return _codecs[codecname]
+    except KeyError:
+        if codecname in _blockcodecs:
+            raise KeyError("Codec %s has no per-message encoder/decoder." %
+                           repr(codecname))
+        raise KeyError("Unknown codec: %s" % repr(codecname))
+
+def getblockcodec(codecname):
+    """ Return the module that implements the given block codec."""
+    try:
+        _, modname = _blockcodecs[codecname]
     except KeyError:
         raise KeyError("Unknown codec: %s" % repr(codecname))
+    __import__(modname)
+    return sys.modules[modname]
+
+
+class RecordWriter(object):
+    """ A writer for the fixed-size codecs, which just appends the encoded
+    messages to the file. """
+
+    def __init__(self, f, codecname):
+        self.f = f
+        self.encode, _, _ = getcodec(codecname)
+
+    def write(self, ts_actual, timestamp, venue, symbol, bid, ask):
+        self.f.write(self.encode(ts_actual, timestamp, venue, symbol, bid, ask))
 
+    def flush(self):
+        pass
+
+def openwriter(f, codecname):
+    """ Return a writer object for the given file and codec. A writer has a
+    write() method that accepts the fields of a RateUpdate, and a flush() method
+    that must be called to write out any pending messages (the file itself is
+    not flushed nor closed)."""
+    if codecname in _blockcodecs:
+        return getblockcodec(codecname).openwriter(f)
+    else:
+        return RecordWriter(f, codecname)
+
+
+
+"""
+Dumpfile header: an optional header at the beginning of the file which
+describes its contents. If present, the codec is read from it instead of being
+guessed from the first messages.
+
+The data is in the following format:
+
+  Field         Nb. Bytes       Data           Interpretation
+  ------------- --------------- -------------- -----------------
+  magic         8               str            'OANDUMP' + NUL
+  version       2               short          format version
+  size          4               int            size of header (bytes)
+  codec         8               str            codec name
+  nsymbols      2               short          nb. of symbols in table
+  index         8               long           offset of index (or 0)
+  footer        8               long           offset of footer (or 0)
+  symbols       8 x nsymbols    (c, 7s)        venue/symbol table
+  --------------------------------------------------------------
 
+The messages start at offset 'size' in the file. The index and footer offsets
+are zero if the file does not have them.
+"""
 
+HEADER_MAGIC = 'OANDUMP\0'
+HEADER_VERSION = 1
+
+sthdr = struct.Struct('! 8s H I 8s H q q')
+assert sthdr.size == 40, sthdr.size
+stsym = struct.Struct('! c 7s')
+
+DumpHeader = namedtuple(
+    'DumpHeader',
+    ('version', 'size', 'codec', 'symbols', 'index', 'footer'))
+
+def packheader(codec, symbols=(), index=0, footer=0):
+    """ Create a header for a dumpfile in the given codec. 'symbols' is a
+    sequence of (venue, symbol) pairs."""
+    if codec is None:
+        codec = 'raw32n' # Default encoder/decoder.
+    symbols = list(symbols)
+    size = sthdr.size + len(symbols) * stsym.size
+    return ''.join([sthdr.pack(HEADER_MAGIC, HEADER_VERSION, size, codec,
+                               len(symbols), index, footer)] +
+                   [stsym.pack(venue, symbol) for venue, symbol in symbols])
+
+def readheader(f):
+    """ Read the header at the beginning of the given file. If there is one,
+    return a DumpHeader and leave the file positioned at the first message.
+    Otherwise return None and leave the file at its beginning."""
+    f.seek(0)
+    hdr = f.read(sthdr.size)
+    if len(hdr) < sthdr.size or not hdr.startswith(HEADER_MAGIC):
+        f.seek(0)
+        return None
+    magic, version, size, codec, nsymbols, index, footer = sthdr.unpack(hdr)
+    if version > HEADER_VERSION:
+        raise IOError("Unsupported dumpfile format version: %s" % version)
+    if isinstance(f, HeadFile):
+        # Keep the whole header in the cache of a file from a pipe.
+        f.reserve(size)
+    symbols = []
+    if nsymbols:
+        symdata = f.read(nsymbols * stsym.size)
+        for i in xrange(nsymbols):
+            venue, symbol = stsym.unpack_from(symdata, i * stsym.size)
+            symbols.append((venue, symbol.rstrip('\0')))
+    f.seek(size)
+    return DumpHeader(version, size, codec.rstrip('\0'), symbols, index, footer)
+
+
+
+# Heuristics to guess the codec of files that do not have a header.
 _tsdiff = 3600 * 3 * 1000 # less than 3 hours validates timestamps.
 _tspercspread = .02
 
@@ -277,17 +513,22 @@ def compare_packets(msg1, msg2):
     return True
 
 def detect_encoding(f):
-    """ Automatically detect the encoding of a dumpfile, by looking at the
-    beginning bytes of it. We do this by checking the distance between two
-    timestamps. """
+    """ Automatically detect the encoding of a dumpfile without a header, by
+    looking at the beginning bytes of it. We do this by checking the distance
+    between two timestamps. """
 
     pos = f.tell()
     minhead = 2*64 # 64 is the longest possible packet I can imagine.
     f.seek(0)
     head = f.read(minhead)
+    f.seek(pos)
+
+    for codec, (magic, _) in _blockcodecs.iteritems():
+        if head.startswith(magic):
+            return codec
+
     if len(head) < minhead:
         return None
-    f.seek(pos)
 
     for codec in _codecs_names:
         encode, decode, s = getcodec(codec)
@@ -304,6 +545,78 @@ RateUpdate = namedtuple(
     ('ts_actual', 'timestamp', 'venue', 'symbol', 'bid', 'ask'))
 
 
+class RateBatch(object):
+    """ A batch of decoded rate updates, stored as parallel typed arrays (one
+    per field of RateUpdate) instead of a tuple per message. This wraps a NumPy
+    array of type oanserv.dumparray.rate_dtype; the columns are available as
+    attributes, e.g. 'batch.bid', without copying. Individual RateUpdate rows
+    are only created when they are accessed."""
+
+    __slots__ = ('array', 'symtab', '_symid') + RateUpdate._fields
+
+    def __init__(self, array, symtab=None):
+        self.array = array
+        for field in RateUpdate._fields:
+            setattr(self, field, array[field])
+
+        # The symbol table of the file this batch comes from, if any.
+        self.symtab = symtab
+        self._symid = None
+
+    @property
+    def symid(self):
+        """ An array of the ids of the symbols in the batch's symbol table,
+        computed on first access."""
+        if self._symid is None:
+            import numpy
+            if self.symtab is None:
+                self.symtab = SymbolTable()
+            names, inverse = numpy.unique(self.symbol, return_inverse=True)
+            intern = self.symtab.intern
+            ids = numpy.array([intern(name).id for name in names.tolist()],
+                              numpy.int32)
+            self._symid = ids[inverse]
+        return self._symid
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return RateBatch(self.array[i], self.symtab)
+        return self.makerow(self.array[i].item())
+
+    def __iter__(self):
+        makerow = self.makerow
+        for row in self.array:
+            yield makerow(row.item())
+
+    def makerow(self, row):
+        if self.symtab is not None:
+            ts_actual, timestamp, venue, symbol, bid, ask = row
+            return RateUpdate(ts_actual, timestamp, venue,
+                              self.symtab.intern(symbol), bid, ask)
+        return RateUpdate._make(row)
+
+    def __repr__(self):
+        return '<RateBatch of %d messages>' % len(self)
+
+
+# Size of the blocks read by the iterators, in bytes (rounded down to a multiple
+# of the size of the messages).
+READSIZE = 0x10000
+
+def readinto(f, buf):
+    """ Read from file 'f' into the bytearray 'buf', using the file's
+    readinto() method if it has one. Return the number of bytes read."""
+    try:
+        return f.readinto(buf)
+    except AttributeError:
+        r = f.read(len(buf))
+        buf[:len(r)] = r
+        return len(r)
+
+
 class DumpFile(object):
     """ An abstraction for a dumpfile, which allows iterating over its packets.
     It also supports limited caching for the beginning blocks of the file, so
@@ -318,11 +631,45 @@ class DumpFile(object):
         self.decode = dec
         self.msgsize = sz
 
+        # The header of the file, if it has one, and the offset of the first
+        # message.
+        self.header = kw.get('header', None)
+        self.offset = self.header.size if self.header else 0
+
+        # A table of the interned symbols found in the file; the decoder we
+        # expose returns those instead of new strings.
+        self.symbols = SymbolTable(
+            [sym for _, sym in self.header.symbols] if self.header else (),
+            _symfmts.get(codecname))
+        self.rawdecode = dec
+        if dec is not None:
+            self.decode = partial(dec, symtab=self.symbols)
+        self.decodetimes = _timedecoders.get(codecname)
+
+        # The sparse time index of the file (see oanserv.dumpindex), loaded on
+        # first use. If 'index' is true, it is created if necessary.
+        self.index = None
+        self.index_loaded = False
+        self.index_create = kw.get('index', False)
+
         # If this is true, discard out-of-order packets in the iterator code;
         # this is checked per-instrument.
         self.discard_ooo = kw.get('discard_ooo', False)
         self.discard_ts = {}
 
+        # If this is set, the iterator reorders out-of-order packets within a
+        # window of that many msecs (see oanserv.reorder); the ReorderBuffer of
+        # the last iteration holds its statistics.
+        self.reorder = kw.get('reorder', None)
+        self.reorderbuf = None
+
+        # The read buffer for the iterators: a block of records is read in at
+        # once, and the records between 'rpos' and 'rend' have not been
+        # consumed yet.
+        if sz:
+            self.rbuf = bytearray(READSIZE - READSIZE % sz)
+        self.rpos = self.rend = 0
+
     @property
     def name(self):
         return self.f.name
@@ -332,15 +679,24 @@ class DumpFile(object):
                 not isinstance(self.f, HeadFile))
 
     def tell(self):
-        assert self.f.tell() % self.msgsize == 0, (self.f.tell() % self.msgsize)
-        return self.f.tell() / self.msgsize
+        pos = self.f.tell() - self.offset - (self.rend - self.rpos)
+        assert pos % self.msgsize == 0, (pos % self.msgsize)
+        return pos / self.msgsize
 
     def seek(self, offset, whence=os.SEEK_SET):
-        self.f.seek(offset * self.msgsize, whence)
+        pos = offset * self.msgsize
+        if whence == os.SEEK_SET:
+            pos += self.offset
+        elif whence == os.SEEK_CUR:
+            pos -= self.rend - self.rpos
+        self.f.seek(pos, whence)
+        self.rpos = self.rend = 0
         self.discard_ts.clear()
 
     def rewind(self):
-        self.f.seek(0, os.SEEK_SET)
+        self.f.seek(self.offset, os.SEEK_SET)
+        self.rpos = self.rend = 0
+        self.discard_ts.clear()
 
     def first(self):
         """ Return just the first message, without changing the file pointer.
@@ -368,31 +724,199 @@ class DumpFile(object):
         finally:
             self.seek(orig)
 
+    def getindex(self):
+        """ Return the sparse time index of this file, or None if it does not
+        have a valid one."""
+        if not self.index_loaded:
+            from oanserv.dumpindex import getindex
+            self.index = getindex(self, self.index_create)
+            self.index_loaded = True
+        return self.index
+
     def findtime(self, timestamp):
         """ Find msg xindex to a specific timestamp. We binary search is
-        performed to find the closest message. """
+        performed to find the closest message. If the file has a valid index
+        sidecar, it is used to narrow down the search instead."""
 
         orig = self.tell()
         try:
+            index = self.getindex()
+            if index is not None:
+                return self._findtime_index(index, timestamp)
+
             # Check against the beginning and ends of the file.
-            self.seek(0)
-            pbegin = self.first()
             nmax = len(self)
+            if nmax == 0:
+                return 0
+            self.seek(0)
+            tbegin, _ = self.readtimes()
             self.seek(nmax-1)
-            pend = self.next()
+            tend, _ = self.readtimes()
 
-            if timestamp < pbegin.ts_actual:
+            if timestamp < tbegin:
                 return 0
-            elif timestamp >= pend.ts_actual:
+            elif timestamp >= tend:
                 return nmax
             else:
                 # At this point we know that our point in time lies within the file.
-                return self._findtime(timestamp,
-                                      0, pbegin.ts_actual,
-                                      nmax, pend.ts_actual)
+                return self._findtime(timestamp, 0, tbegin, nmax, tend)
         finally:
             self.seek(orig)
 
+    def _findtime_index(self, index, t):
+        """ Find the message like findtime(), using the sparse index to narrow
+        down the range to scan."""
+        nmax = index.nmsgs
+        if nmax == 0 or t < index.ts_actual[0]:
+            return 0
+        elif t >= index.ts_actual[-1]:
+            return nmax
+        nlo, nhi = index.bounds(t)
+        if isinstance(self.f, (file, BlockZipFile)):
+            # Random access is cheap: binary search within the range.
+            return self._findtime(t, nlo, index.ts_actual[0], nhi, t)
+        else:
+            # Seeking is expensive (e.g. compressed files): scan the range.
+            from oanserv.dumparray import decode_fields
+            self.seek(nlo)
+            tsa, = decode_fields(self.codecname, self.readraw(nhi - nlo + 1),
+                                 ('ts_actual',))
+            return max(nlo + int(tsa.searchsorted(t, 'left')) - 1, 0)
+
+    # The cost of a probe of findtime() relative to that of scanning a message:
+    # findtimes() scans the file when it would be cheaper than probing it.
+    probecost = 256
+
+    def findtimes(self, timestamps):
+        """ Find the message indexes of a sorted sequence of timestamps, as
+        findtime() would for each of them, and return them in a list. The
+        probes of the binary search are shared between the timestamps, and if
+        the timestamps are dense enough (or seeking is expensive), the file is
+        scanned once instead."""
+        from math import log
+
+        timestamps = list(timestamps)
+        if not timestamps:
+            return []
+        assert all(a <= b for a, b in zip(timestamps, timestamps[1:])), (
+            "Timestamps must be sorted.")
+        if self.msgsize is None:
+            return [self.findtime(t) for t in timestamps]
+
+        orig = self.tell()
+        try:
+            index = self.getindex()
+            if index is not None:
+                return self._findtimes_index(index, timestamps)
+
+            nmax = len(self)
+            if nmax == 0:
+                return [0] * len(timestamps)
+            cheap = isinstance(self.f, (file, BlockZipFile))
+            if (not cheap or
+                len(timestamps) * log(nmax, 2) * self.probecost > nmax):
+                r, tend = self._findtimes_scan(timestamps, 0, nmax)
+                return [nmax if (tend is not None and t >= tend)
+                        else max(n - 1, 0)
+                        for t, n in zip(timestamps, r)]
+
+            # Check against the beginning and ends of the file.
+            self.seek(0)
+            tbegin, _ = self.readtimes()
+            self.seek(nmax-1)
+            tend, _ = self.readtimes()
+
+            r = []
+            inside = []
+            for t in timestamps:
+                if t < tbegin:
+                    r.append(0)
+                elif t >= tend:
+                    r.append(nmax)
+                else:
+                    r.append(None)
+                    inside.append(t)
+            found = iter(self._findtimes(inside, 0, nmax))
+            return [found.next() if n is None else n for n in r]
+        finally:
+            self.seek(orig)
+
+    def _findtimes_index(self, index, timestamps):
+        """ Find the messages like findtimes(), using the sparse index to narrow
+        down the ranges to search. The timestamps within the same range of the
+        index share their search."""
+        nmax = index.nmsgs
+        cheap = isinstance(self.f, (file, BlockZipFile))
+
+        # Group the timestamps by range of the index; None for the timestamps
+        # outside of the file.
+        groups = []
+        for t in timestamps:
+            if nmax == 0 or t < index.ts_actual[0]:
+                bounds = (0, None)
+            elif t >= index.ts_actual[-1]:
+                bounds = (nmax, None)
+            else:
+                bounds = index.bounds(t)
+            if groups and groups[-1][0] == bounds:
+                groups[-1][1].append(t)
+            else:
+                groups.append((bounds, [t]))
+
+        r = []
+        for (nlo, nhi), group in groups:
+            if nhi is None:
+                r.extend([nlo] * len(group))
+            elif cheap:
+                r.extend(self._findtimes(group, nlo, nhi))
+            else:
+                found, _ = self._findtimes_scan(group, nlo, nhi + 1)
+                r.extend(max(n - 1, 0) for n in found)
+        return r
+
+    def _findtimes(self, timestamps, nmin, nmax):
+        """ Binary search the sorted timestamps between messages 'nmin' and
+        'nmax', probing the messages in the same order as _findtime() does, but
+        only once for all the timestamps."""
+        if not timestamps:
+            return []
+        if (nmax - nmin) <= 1:
+            return [nmin] * len(timestamps)
+        nmid = (nmax + nmin)/2
+        self.seek(nmid)
+        tmid, _ = self.readtimes()
+        from bisect import bisect_right
+        k = bisect_right(timestamps, tmid)
+        return (self._findtimes(timestamps[:k], nmin, nmid) +
+                self._findtimes(timestamps[k:], nmid, nmax))
+
+    def _findtimes_scan(self, timestamps, nmin, nmax):
+        """ Scan messages 'nmin' to 'nmax' (exclusive) and return the positions
+        where the sorted timestamps would be inserted among them (bisect_left),
+        and the actual time of message 'nmax-1'. The scan stops early if all
+        the timestamps are before a message, in which case that time is None
+        (it is not needed)."""
+        from numpy import array, int64
+
+        ts = array(timestamps, int64)
+        r = []
+        i, n = 0, nmin
+        tlast = None
+        self.seek(nmin)
+        for tsa, in self.iterfields(('ts_actual',)):
+            tsa = tsa[:nmax - n]
+            if len(tsa) == 0:
+                break
+            k = i + int(ts[i:].searchsorted(tsa[-1], 'right'))
+            r.extend((n + tsa.searchsorted(ts[i:k], 'left')).tolist())
+            i, n = k, n + len(tsa)
+            tlast = int(tsa[-1])
+            if i == len(ts) and ts[-1] < tlast:
+                tlast = None
+                break
+        r.extend([n] * (len(ts) - i))
+        return r, tlast
+
     def _findtime(self, t, nmin, tmin, nmax, tmax):
         if (nmax - nmin) <= 1:
             return nmin
@@ -408,8 +932,7 @@ class DumpFile(object):
         # time.
         assert nmin < nmid < nmax, (nmin, nmid, nmax)
         self.seek(nmid)
-        pmid = self.next()
-        tmid = pmid.ts_actual
+        tmid, _ = self.readtimes()
 
         if t <= tmid:
             return self._findtime(t, nmin, tmin, nmid, tmid)
@@ -419,112 +942,489 @@ class DumpFile(object):
     # Decoding iterator.
 
     def __iter__(self):
-        return self
-
-    def next(self):
-        if self.discard_ooo:
-            while 1:
-                r = self.f.read(self.msgsize)
-                if not r:
-                    raise StopIteration
-                e = self.decode(r)
-                try:
+        it = self.iterdecode()
+        if self.reorder is not None:
+            from oanserv.reorder import ReorderBuffer
+            self.reorderbuf = ReorderBuffer(self.reorder)
+            it = self.reorderbuf.reorder(it)
+        return it
+
+    def iterdecode(self):
+        # Note: we walk the records in the read buffer here rather than calling
+        # next() for each message, which is significantly faster.
+        decode, symtab, msgsize = self.rawdecode, self.symbols, self.msgsize
+        discard_ts = self.discard_ts
+        while 1:
+            if self.rend - self.rpos < msgsize and not self.fillbuf():
+                return
+            rbuf, start = self.rbuf, self.rpos
+            end = self.rend - (self.rend - start) % msgsize
+            for pos in xrange(start, end, msgsize):
+                if self.rpos != pos:
+                    break # The file has been moved while iterating.
+                self.rpos = pos + msgsize
+                e = decode(rbuf, symtab, pos)
+                if self.discard_ooo:
                     ts, sym = e.timestamp, e.symbol
-                    pts = self.discard_ts[e.symbol]
-                    if ts < pts:
+                    if ts < discard_ts.get(sym, ts):
                         continue
-                    else:
-                        self.discard_ts[sym] = ts
-                except KeyError:
-                    self.discard_ts[sym] = ts
-                return e
-        else:
-            r = self.f.read(self.msgsize)
-            if not r:
+                    discard_ts[sym] = ts
+                yield e
+
+    def readone(self):
+        """ Read and decode the message at the current position, without
+        reading ahead. This is used for probing around the file."""
+        r = self.f.read(self.msgsize)
+        if len(r) < self.msgsize:
+            raise StopIteration
+        return self.decode(r)
+
+    def readtimes(self):
+        """ Like readone(), but decode only the (ts_actual, timestamp) pair of
+        the message."""
+        r = self.f.read(self.msgsize)
+        if len(r) < self.msgsize:
+            raise StopIteration
+        return self.decodetimes(r)
+
+    def fillbuf(self):
+        """ Refill the read buffer, keeping the bytes not consumed yet. Return
+        False if there isn't a complete record left to read."""
+        rbuf, msgsize = self.rbuf, self.msgsize
+        nleft = self.rend - self.rpos
+        if nleft:
+            rbuf[:nleft] = rbuf[self.rpos:self.rend]
+        self.rpos, self.rend = 0, nleft
+        view = memoryview(rbuf)
+        while self.rend < len(rbuf):
+            nbytes = readinto(self.f, view[self.rend:])
+            if not nbytes:
+                break
+            self.rend += nbytes
+        return self.rend >= msgsize
+
+    def next(self):
+        msgsize = self.msgsize
+        while 1:
+            if self.rend - self.rpos < msgsize and not self.fillbuf():
                 raise StopIteration
-            return self.decode(r)
+            pos = self.rpos
+            self.rpos = pos + msgsize
+            e = self.rawdecode(self.rbuf, self.symbols, pos)
+            if self.discard_ooo:
+                ts, sym = e.timestamp, e.symbol
+                if ts < self.discard_ts.get(sym, ts):
+                    continue
+                self.discard_ts[sym] = ts
+            return e
 
     # Raw iterator.
+
     def rawiter(self):
-        return self.RawIter(self)
+        # IMPORTANT: The raw iterator does not filter OOO packets.
+        msgsize = self.msgsize
+        while 1:
+            if self.rend - self.rpos < msgsize and not self.fillbuf():
+                return
+            start = self.rpos
+            end = self.rend - (self.rend - start) % msgsize
+            data = str(self.rbuf[start:end])
+            for pos in xrange(start, end, msgsize):
+                if self.rpos != pos:
+                    break # The file has been moved while iterating.
+                self.rpos = pos + msgsize
+                i = pos - start
+                yield data[i:i + msgsize]
+
+    # Bulk decoding (requires NumPy).
+
+    def readraw(self, nmsgs=None):
+        """ Read up to 'nmsgs' raw records from the current position (or all the
+        remaining ones if 'nmsgs' is None), and return them concatenated in a
+        string or buffer object."""
+        nleft = self.rend - self.rpos
+        if nmsgs is None:
+            buf = str(self.rbuf[self.rpos:self.rend]) + self.f.read()
+            self.rpos = self.rend = 0
+        else:
+            nbytes = nmsgs * self.msgsize
+            if nleft >= nbytes:
+                buf = buffer(self.rbuf, self.rpos, nbytes)
+                self.rpos += nbytes
+            else:
+                buf = (str(self.rbuf[self.rpos:self.rend]) +
+                       self.f.read(nbytes - nleft))
+                self.rpos = self.rend = 0
+        return buf
+
+    def readarray(self, nmsgs=None):
+        """ Read and decode up to 'nmsgs' messages from the current position
+        (or all the remaining messages if 'nmsgs' is None) into a NumPy array of
+        type oanserv.dumparray.rate_dtype. The array is empty at the end of the
+        file. Note that out-of-order packets are not discarded here."""
+        from oanserv.dumparray import decode_block
+        return decode_block(self.codecname, self.readraw(nmsgs))
+
+    def iterarrays(self, nmsgs=0x10000):
+        """ Iterate over the rest of the file, in arrays of 'nmsgs' messages."""
+        while 1:
+            a = self.readarray(nmsgs)
+            if len(a) == 0:
+                break
+            yield a
+
+    def iterfields(self, fields, nmsgs=0x10000):
+        """ Iterate over the rest of the file, in tuples of arrays of the given
+        fields (names of RateUpdate fields), of up to 'nmsgs' messages each. For
+        the fixed-size codecs, only those fields are decoded."""
+        if self.msgsize is None:
+            for batch in self.iterbatches(nmsgs):
+                yield tuple(getattr(batch, field) for field in fields)
+            return
+        from oanserv.dumparray import decode_fields
+        while 1:
+            buf = self.readraw(nmsgs)
+            if len(buf) < self.msgsize:
+                break
+            yield decode_fields(self.codecname, buf, fields)
+
+    def iterbatches(self, nmsgs=0x10000):
+        """ Iterate over the rest of the file, in RateBatch'es of 'nmsgs'
+        messages. The read buffer and the arrays are reused between batches,
+        so a batch is only valid until the next one is produced; copy its
+        array if you need to keep it."""
+        from numpy import empty
+        from oanserv.dumparray import decode_block, rate_dtype
+
+        msgsize = self.msgsize
+        buf = bytearray(nmsgs * msgsize)
+        view = memoryview(buf)
+        out = empty(nmsgs, rate_dtype)
+
+        # Start with what's left in the read buffer.
+        nleft = self.rend - self.rpos
+        while nleft >= len(buf):
+            yield RateBatch(decode_block(self.codecname,
+                                         buffer(self.rbuf, self.rpos, len(buf)),
+                                         out),
+                            self.symbols)
+            self.rpos += len(buf)
+            nleft -= len(buf)
+        buf[:nleft] = self.rbuf[self.rpos:self.rend]
+        self.rpos = self.rend = 0
+        while 1:
+            nbytes = nleft + readinto(self.f, view[nleft:])
+            if nbytes < msgsize:
+                break
+            batch = RateBatch(decode_block(self.codecname,
+                                           buffer(buf, 0, nbytes), out),
+                              self.symbols)
+
+            # Keep a partial record for the next read.
+            nleft = nbytes % msgsize
+            if nleft:
+                buf[:nleft] = buf[nbytes - nleft:nbytes]
+            yield batch
+
+    def iterselect(self, symbols, nmsgs=0x10000):
+        """ Iterate over the messages of the given symbols, in pairs of (raw
+        records, array) of up to 'nmsgs' messages each; the raw records are
+        concatenated in a string. If the file has an index, only the blocks of
+        messages which contain some of the symbols are read; otherwise the whole
+        file is scanned. This starts from the beginning of the file and leaves
+        its position undefined. Out-of-order packets are not discarded."""
+        from numpy import array, in1d, frombuffer, uint8
+        from oanserv.dumparray import decode_block
+
+        index = self.getindex()
+        if index is not None:
+            ranges = index.ranges(symbols)
+        else:
+            ranges = [(0, None)]
+        symarr = array(list(symbols), 'S7')
+
+        msgsize = self.msgsize
+        for start, stop in ranges:
+            self.seek(start)
+            pos = start
+            while stop is None or pos < stop:
+                n = nmsgs if stop is None else min(nmsgs, stop - pos)
+                buf = self.readraw(n)
+                arr = decode_block(self.codecname, buf)
+                if len(arr) == 0:
+                    break
+                pos += len(arr)
+                sel = in1d(arr['symbol'], symarr)
+                if sel.any():
+                    raw = frombuffer(buf, uint8, len(arr) * msgsize)
+                    yield (raw.reshape(len(arr), msgsize)[sel].tostring(),
+                           arr[sel])
+
+    def select(self, symbols, nmsgs=0x10000):
+        """ Iterate over the messages of the given symbols, in RateBatch'es of
+        up to 'nmsgs' messages. See iterselect()."""
+        for _, arr in self.iterselect(symbols, nmsgs):
+            yield RateBatch(arr, self.symbols)
 
     def __len__(self):
-        if re.match('.*\.(gz|bz2)', self.f.name, re.I):
+        return (self.datasize() - self.offset) / self.msgsize
+
+    def datasize(self):
+        """ Return the size of the data of the file, in bytes. For a compressed
+        file, this is the size of the uncompressed data, not the size of the
+        file on disk."""
+        if isinstance(self.f, BlockZipFile):
+            sz = self.f.size
+        elif re.match('.*\.gz$', self.f.name, re.I):
             # We have to parse it using the C lib (via external process).
             p = Popen(('gzip', '-l', self.f.name), shell=False, stdout=PIPE)
             out, _ = p.communicate()
             mo = re.match('[ \t]*(\d+)[ \t]+(\d+)[ \t]+', out.splitlines()[1])
             sz = int(mo.group(2))
+        elif re.match('.*\.bz2$', self.f.name, re.I):
+            # There is no size in the bzip2 format: decompress to the end.
+            orig = self.f.tell()
+            self.f.seek(0, os.SEEK_END)
+            sz = self.f.tell()
+            self.f.seek(orig)
         else:
             sz = getsize(self.f.name)
-        return sz / self.msgsize
+        return sz
 
-    class RawIter(object):
+    def gettimes(self, msgno):
+        """ Return the (ts_actual, timestamp) pair of message number 'msgno'
+        (negative numbers count from the end), without changing the file
+        pointer."""
+        orig = self.tell()
+        try:
+            if msgno < 0:
+                msgno += len(self)
+            self.seek(msgno)
+            if self.decodetimes is None:
+                u = self.next()
+                return u.ts_actual, u.timestamp
+            return self.readtimes()
+        finally:
+            self.seek(orig)
 
-        def __init__(self, dumpf):
-            self.dumpf = dumpf
-            self.msgsize = dumpf.msgsize
+    def getextents(self):
+        """ Return the (start, end) timestamps. """
+        return (self.gettimes(0)[1], self.gettimes(-1)[1])
 
-        def __iter__(self):
-            return self
 
-        def next(self):
-            # IMPORTANT: The raw iterator does not filter OOO packets.
-            r = self.dumpf.f.read(self.msgsize)
-            if not r:
-                raise StopIteration
-            return r
+class MmapDumpFile(DumpFile):
+    """ A dumpfile of fixed-size records which is mapped in memory. Messages can
+    be accessed in O(1) by number, e.g. dumpf[i] or dumpf[-1], and slicing
+    returns a RateBatch (this requires NumPy). Moving around the file does not
+    issue any system call, and the raw iterator yields buffer objects which
+    refer directly to the mapped records rather than copies of them. The file
+    must be uncompressed; messages appended after it is opened are not seen."""
 
-    def getextents(self):
-        """ Return the (start, end) timestamps. """
-        msg1 = self.first()
-        msg2 = self.last()
-        return (msg1.timestamp, msg2.timestamp)
+    def __init__(self, f, codecname, enc, dec, sz, **kw):
+        from mmap import mmap, ACCESS_READ
+        DumpFile.__init__(self, f, codecname, enc, dec, sz, **kw)
+        self.map = mmap(f.fileno(), 0, access=ACCESS_READ)
+        self.nmsgs = (len(self.map) - self.offset) // self.msgsize
+
+        # The whole mapping serves as the read buffer of the iterators.
+        self.rbuf = self.map
+        self.rpos = self.offset
+        self.rend = self.offset + self.nmsgs * self.msgsize
+
+    def fillbuf(self):
+        return False
+
+    def isseekable(self):
+        return True
+
+    def tell(self):
+        return (self.rpos - self.offset) // self.msgsize
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_SET:
+            pos = offset
+        elif whence == os.SEEK_CUR:
+            pos = self.tell() + offset
+        elif whence == os.SEEK_END:
+            pos = self.nmsgs + offset
+        else:
+            raise ValueError("Invalid whence: %s" % whence)
+        if pos < 0:
+            raise IOError("Invalid message number: %s" % pos)
+        self.rpos = self.offset + min(pos, self.nmsgs) * self.msgsize
+        self.discard_ts.clear()
+
+    def rewind(self):
+        self.rpos = self.offset
+        self.discard_ts.clear()
+
+    def __len__(self):
+        return self.nmsgs
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(self.nmsgs)
+            if step != 1:
+                return self[start:stop][::step]
+            from oanserv.dumparray import decode_block
+            n = max(stop - start, 0)
+            return RateBatch(decode_block(self.codecname,
+                                          self.getbuffer(start, n)),
+                             self.symbols)
+        if i < 0:
+            i += self.nmsgs
+        if not (0 <= i < self.nmsgs):
+            raise IndexError("Message number out of range: %s" % i)
+        return self.rawdecode(self.map, self.symbols,
+                              self.offset + i * self.msgsize)
+
+    def getbuffer(self, start, n):
+        "Return a buffer over the records of 'n' messages from 'start'."
+        return buffer(self.map, self.offset + start * self.msgsize,
+                      n * self.msgsize)
+
+    def first(self):
+        return self[0]
+
+    def last(self):
+        return self[-1]
+
+    def readone(self):
+        if self.rpos >= self.rend:
+            raise StopIteration
+        self.rpos += self.msgsize
+        return self.rawdecode(self.map, self.symbols, self.rpos - self.msgsize)
+
+    def readtimes(self):
+        if self.rpos >= self.rend:
+            raise StopIteration
+        self.rpos += self.msgsize
+        return self.decodetimes(self.map, self.rpos - self.msgsize)
+
+    def rawiter(self):
+        msgsize = self.msgsize
+        while self.rpos < self.rend:
+            pos = self.rpos
+            self.rpos = pos + msgsize
+            yield buffer(self.map, pos, msgsize)
+
+    def readraw(self, nmsgs=None):
+        n = (self.rend - self.rpos) // self.msgsize
+        if nmsgs is not None:
+            n = min(n, nmsgs)
+        buf = buffer(self.map, self.rpos, n * self.msgsize)
+        self.rpos += n * self.msgsize
+        return buf
+
+    def iterbatches(self, nmsgs=0x10000):
+        from numpy import empty
+        from oanserv.dumparray import decode_block, rate_dtype
+
+        out = empty(nmsgs, rate_dtype)
+        while self.rpos < self.rend:
+            nbytes = min(nmsgs * self.msgsize, self.rend - self.rpos)
+            buf = buffer(self.map, self.rpos, nbytes)
+            self.rpos += nbytes
+            yield RateBatch(decode_block(self.codecname, buf, out),
+                            self.symbols)
+
+    def close(self):
+        self.map.close()
+        self.f.close()
 
 
 def opendumpf(f, **kw):
-    codec = detect_encoding(f)
+    header = readheader(f)
+    if header is not None:
+        codec = header.codec
+    else:
+        codec = detect_encoding(f)
+    kw['header'] = header
+    if codec in _blockcodecs:
+        return getblockcodec(codec).opendumpf(f, **kw)
     encode, decode, msgsize = getcodec(codec)
+    if kw.pop('mmap', False) and isinstance(f, file) and getsize(f.name) > 0:
+        return MmapDumpFile(f, codec, encode, decode, msgsize, **kw)
     return DumpFile(f, codec, encode, decode, msgsize, **kw)
 
-def opendump(fn, **kw):
-    """ Open a dumpfile, automatically detecting its encoding. """
-    if fn == '-':
-        return opendump_stdin(**kw)
-    elif fn.endswith('.gz'):
+def openfile(fn, readahead=False):
+    """ Open a file for reading its uncompressed contents. Gzipped and bzipped
+    files are recognized by their suffix, and block-compressed files (see
+    oanserv.blockzip) by their suffix or their header. If 'readahead' is true,
+    gzipped and bzipped files are decompressed ahead of the reader in a
+    background thread (see oanserv.readahead)."""
+    if fn.endswith('.gz'):
         import gzip
         f = gzip.open(fn)
     elif fn.endswith('.bz2'):
-        import bzip2
-        f = bzip2.open(fn)
+        import bz2
+        f = bz2.BZ2File(fn)
+    elif fn.endswith(ZBLK_SUFFIX):
+        return BlockZipFile(open(fn, 'rb'))
     else:
         f = open(fn, 'rb')
-    return opendumpf(f, **kw)
+        if isblockzip(f):
+            f = BlockZipFile(f)
+        return f
+    if readahead:
+        from oanserv.readahead import ReadAheadFile
+        f = ReadAheadFile(f)
+    return f
+
+def opendump(fn, **kw):
+    """ Open a dumpfile, automatically detecting its encoding. If 'mmap' is
+    true and the file is uncompressed and of a fixed-size codec, the file is
+    mapped in memory (see MmapDumpFile). If 'readahead' is true and the file is
+    gzipped or bzipped, it is decompressed in a background thread."""
+    if fn == '-':
+        return opendump_stdin(**kw)
+    return opendumpf(openfile(fn, kw.pop('readahead', False)), **kw)
 
 def opendump_stdin(**kw):
     """ Open stdin as a dumpfile, automatically detecting its encoding. """
     return opendumpf(HeadFile(sys.stdin, 512), **kw)
 
 
-def opendump_write(fn):
-    """ Open a dumpfile for writing, returns (file, detected-codec). 'codec' is
-    None if the file did not exist before calling this function."""
-    if exists(fn):
+def opendump_write(fn, codec=None, header=True):
+    """ Open a dumpfile for appending, returns (file, codec). If the file did
+    not exist before calling this function, it is created for the given codec,
+    with a header unless 'header' is false (e.g. for tools which do not support
+    headers); otherwise, 'codec' is that of the existing file."""
+    if exists(fn) and getsize(fn) > 0:
         f = open(fn, 'rb')
-        codec = detect_encoding(f)
+        header = readheader(f)
+        if header is not None:
+            fcodec, offset = header.codec, header.size
+        else:
+            fcodec, offset = detect_encoding(f), 0
         f.close()
-        _, _, msgsize = getcodec(codec)
-    else:
-        codec = None
+        if fcodec is None:
+            raise IOError("Unknown codec for existing dumpfile '%s'." % fn)
+        if codec is not None and codec != fcodec:
+            logging.warning("Appending to dumpfile with codec %s instead of %s." %
+                            (fcodec, codec))
+        codec = fcodec
+        dfile = file(fn, 'ab', 0)
 
-    dfile = file(fn, 'ab', 0)
-
-    if codec:
         dfilesz = getsize(fn)
-        remain = dfilesz % msgsize
-        if remain != 0:
+        if codec in _blockcodecs:
+            dumpf = opendump(fn)
+            try:
+                validsz = dumpf.validsize()
+            finally:
+                dumpf.f.close()
+        else:
+            _, _, msgsize = getcodec(codec)
+            validsz = dfilesz - (dfilesz - offset) % msgsize
+        if validsz != dfilesz:
             logging.warning("Truncated data present in dumpfile; truncating.")
-            dfile.seek(dfilesz / msgsize)
+            dfile.truncate(validsz)
+    else:
+        if codec is None:
+            codec = 'raw32n' # Default encoder/decoder.
+        dfile = file(fn, 'ab', 0)
+        if header:
+            dfile.write(packheader(codec))
 
     return dfile, codec
 
@@ -544,14 +1444,20 @@ def test():
 
     def ntime(): return int(time()*1000)
 
+    # Note: raw24 stores a single timestamp, so both must be the same.
+    t = ntime()
     messages = [
-        (ntime(), ntime(), 'O', 'EUR/USD', f2i(1.47019), f2i(1.47020)),
-        (ntime(), ntime(), 'O', 'USD/CAD', f2i(1.0602), f2i(1.0606)),
-        (ntime(), ntime(), 'O', 'XAU/USD', f2i(804.03), f2i(804.24)),
-        (ntime(), ntime(), 'O', 'EUR/USD', f2i(1.47010), f2i(1.47012)),
-        (ntime(), ntime(), 'O', 'EUR/USD', f2i(1.47009), f2i(1.47012)),
+        (t, t, 'O', 'EUR/USD', f2i(1.47019), f2i(1.47020)),
+        (t, t, 'O', 'USD/CAD', f2i(1.0602), f2i(1.0606)),
+        (t, t, 'O', 'XAU/USD', f2i(804.03), f2i(804.24)),
+        (t, t, 'O', 'EUR/USD', f2i(1.47010), f2i(1.47012)),
+        (t, t, 'O', 'EUR/USD', f2i(1.47009), f2i(1.47012)),
         ]
 
+    # Note: the codec of a file without a header is detected from its first
+    # 128 bytes, so we need enough messages for the smallest ones.
+    messages = messages * 6
+
     for codec in sorted(_codecs):
         print 'Testing: %s' % codec
         fn = '/tmp/testdump.%s' % codec
@@ -570,6 +1476,96 @@ def test():
         for msg, u in izip(messages, dumpf):
             assert tuple(u) == msg, u
 
+        # Create the same file with a header and check that we find its codec
+        # from the header.
+        os.remove(fn)
+        f, _ = opendump_write(fn, codec)
+        for data in messages:
+            f.write(encode(*data))
+        f.close()
+        hdumpf = opendump(fn)
+        assert hdumpf.header.codec == hdumpf.codecname == codec
+        assert len(hdumpf) == len(messages)
+        for msg, u in izip(messages, hdumpf):
+            assert tuple(u) == msg, u
+
+        # The header is optional.
+        os.remove(fn)
+        f, _ = opendump_write(fn, codec, header=False)
+        for data in messages:
+            f.write(encode(*data))
+        f.close()
+        hdumpf = opendump(fn)
+        assert hdumpf.header is None and hdumpf.codecname == codec
+        assert [tuple(u) for u in hdumpf] == messages
+
+        # Check the bulk decoder against the per-message decoder.
+        try:
+            import numpy
+        except ImportError:
+            continue
+        dumpf.rewind()
+        a = dumpf.readarray()
+        assert len(a) == len(messages), len(a)
+        dumpf.rewind()
+        for row, u in izip(a, dumpf):
+            assert tuple(row) == tuple(u), (row, u)
+        dumpf.rewind()
+        for batch in dumpf.iterbatches(2):
+            for i, u in enumerate(batch):
+                assert u == batch[i] == RateUpdate(*messages[dumpf.tell()-len(batch)+i])
+
+    # Edge cases: empty files, single messages, and files which do not fill
+    # a whole number of read blocks.
+    fn = '/tmp/testdump.edge'
+    for codec in sorted(_codecs):
+        encode, decode, msgsize = getcodec(codec)
+        nblock = READSIZE // msgsize
+        for nmsgs in 0, 1, nblock, nblock + 1, 2 * nblock + 3:
+            print 'Testing: %s, %d messages' % (codec, nmsgs)
+            if os.path.exists(fn):
+                os.remove(fn)
+            f, _ = opendump_write(fn, codec)
+            for i in xrange(nmsgs):
+                f.write(encode(t + i, t + i, 'O', 'EUR/USD', i + 1, i + 2))
+            f.close()
+
+            for mmap in False, True:
+                dumpf = opendump(fn, mmap=mmap)
+                assert len(dumpf) == nmsgs, (len(dumpf), nmsgs)
+                n = 0
+                for i, u in enumerate(dumpf):
+                    assert (u.timestamp, u.bid) == (t + i, i + 1), u
+                    n += 1
+                assert n == nmsgs and dumpf.tell() == nmsgs
+                assert dumpf.findtime(t - 1) == 0
+                assert dumpf.findtime(t + nmsgs) == nmsgs
+                times = [t - 1, t, t + nmsgs // 2, t + nmsgs]
+                assert dumpf.findtimes(times) == map(dumpf.findtime, times)
+                if nmsgs:
+                    assert dumpf.first().bid == 1
+                    assert dumpf.last().bid == nmsgs
+                    dumpf.seek(nmsgs - 1)
+                    assert dumpf.next().bid == nmsgs
+                    assert list(dumpf) == []
+
+                try:
+                    import numpy
+                except ImportError:
+                    continue
+                dumpf.rewind()
+                assert len(dumpf.readarray()) == nmsgs
+                assert len(dumpf.readarray()) == 0
+                dumpf.rewind()
+                sizes = [len(a) for a in dumpf.iterarrays(1000)]
+                assert sum(sizes) == nmsgs and 0 not in sizes, sizes
+                dumpf.rewind()
+                bids = [a.tolist() for a, in dumpf.iterfields(('bid',), 1000)]
+                assert sum(bids, []) == range(1, nmsgs + 1)
+                dumpf.rewind()
+                assert sum(len(b) for b in dumpf.iterbatches(1000)) == nmsgs
+    os.remove(fn)
+
 if __name__ == '__main__':
     test()
 
@@ -0,0 +1,360 @@
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+Sparse time and symbol index for dumpfiles, stored in a sidecar file.
+
+Finding a message by time in a dumpfile of fixed-size records is a binary
+search that seeks and decodes a message at each probe, which is expensive on
+large files, and very expensive on compressed files, where seeking means
+decompressing from the start. The index records the timestamps of every N-th
+message, so that a time lookup becomes a search in memory followed by a short
+scan of at most N messages.
+
+The index also records which instruments appear in each block of M messages,
+so that readers interested in a few instruments only can skip the blocks that
+contain none of them (see ranges()), instead of decoding every message.
+
+The index of 'FILE' is stored in 'FILE.idx'. It records the size and
+modification time of the dumpfile it was built from, and is ignored if they
+don't match anymore. Note that for a compressed dumpfile, this is the size of
+the compressed file, which is only meant to detect changes; the number of
+messages bounds the positions in the data.
+
+The data is in the following format:
+
+  Field         Nb. Bytes       Data           Interpretation
+  ------------- --------------- -------------- -----------------
+  magic         8               str            'OANIDX' + 2 NUL
+  version       2               short          format version
+  stride        4               int            nb. messages between entries
+  size          8               long           size of the dumpfile on disk
+  mtime         8               double         mtime of the dumpfile
+  nmsgs         8               long           nb. of messages in dumpfile
+  nentries      4               int            nb. of entries
+  entries       24 x nentries   (q, q, q)      msgno, ts_actual, timestamp
+  symstride     4               int            nb. messages per symbol block
+  nsymbols      4               int            nb. of distinct symbols
+  nblocks       4               int            nb. of symbol blocks
+  symbols       7 x nsymbols    str            sorted symbol names
+  blockmap      nsymbols x B    bits           blocks containing each symbol
+  --------------------------------------------------------------
+
+There is an entry for every 'stride' messages, and one for the last message.
+Symbol block k holds messages k*symstride to (k+1)*symstride-1; the blockmap
+has a row of B = ceil(nblocks/8) bytes per symbol, one bit per block (most
+significant bit first).
+"""
+
+# stdlib imports
+import os, struct, logging
+from os.path import exists, getsize, getmtime
+
+# numpy imports
+import numpy as np
+
+
+__all__ = ('DumpIndex', 'buildindex', 'loadindex', 'getindex', 'indexname')
+
+
+INDEX_MAGIC = 'OANIDX\0\0'
+INDEX_VERSION = 2
+INDEX_STRIDE = 4096
+SYMBOL_STRIDE = 256
+
+stidx = struct.Struct('! 8s H I q d q I')
+stsym = struct.Struct('! I I I')
+
+entry_dtype = np.dtype([('msgno', '>i8'),
+                        ('ts_actual', '>i8'),
+                        ('timestamp', '>i8')])
+
+
+def indexname(fn):
+    "Return the filename of the index sidecar for dumpfile 'fn'."
+    return fn + '.idx'
+
+
+class DumpIndex(object):
+    """ The sparse index of a dumpfile. 'entries' is an array of type
+    'entry_dtype', sorted by message number. 'symbols' is the sorted array of
+    the symbols in the file, and 'blockmap' a boolean array of (symbol, block)
+    telling if the symbol appears in each block of 'symstride' messages.
+    'size' and 'mtime' are those of the file on disk, and only serve to check
+    that the index is up-to-date; 'nmsgs' bounds the message numbers."""
+
+    def __init__(self, stride, size, mtime, nmsgs, entries,
+                 symstride, symbols, blockmap):
+        self.stride = stride
+        self.size = size
+        self.mtime = mtime
+        self.nmsgs = nmsgs
+        self.entries = entries
+        self.ts_actual = entries['ts_actual'].astype(np.int64)
+        self.symstride = symstride
+        self.symbols = symbols
+        self.blockmap = blockmap
+
+    def isvalid(self, fn):
+        "Return true if the index matches the current state of dumpfile 'fn'."
+        return getsize(fn) == self.size and getmtime(fn) == self.mtime
+
+    def bounds(self, timestamp):
+        """ Return a range of message numbers (nlo, nhi) such that the first
+        message with an actual time at or after 'timestamp' is in nlo..nhi
+        (inclusive). If there isn't any such message, nhi is the number of
+        messages."""
+        msgnos = self.entries['msgno']
+        k = self.ts_actual.searchsorted(timestamp, 'left')
+        if k == 0:
+            return 0, 0
+        elif k == len(msgnos):
+            return self.nmsgs, self.nmsgs
+        return int(msgnos[k-1]), int(msgnos[k])
+
+    def ranges(self, symbols):
+        """ Return a list of ranges of message numbers (start, stop), outside
+        of which there are no messages for any of the given symbols."""
+        isel = np.flatnonzero(np.in1d(self.symbols, np.array(symbols, 'S7')))
+        blocks = self.blockmap[isel].any(axis=0)
+
+        # Find the runs of contiguous selected blocks.
+        edges = np.diff(np.r_[0, blocks.view(np.int8), 0])
+        starts = np.flatnonzero(edges == 1) * self.symstride
+        stops = np.minimum(np.flatnonzero(edges == -1) * self.symstride,
+                           self.nmsgs)
+        return zip(starts.tolist(), stops.tolist())
+
+    def save(self, fn):
+        "Write the index to file 'fn'."
+        f = open(fn, 'wb')
+        try:
+            f.write(stidx.pack(INDEX_MAGIC, INDEX_VERSION, self.stride,
+                               self.size, self.mtime, self.nmsgs,
+                               len(self.entries)))
+            f.write(self.entries.astype(entry_dtype).tostring())
+            nblocks = self.blockmap.shape[1]
+            f.write(stsym.pack(self.symstride, len(self.symbols), nblocks))
+            f.write(self.symbols.astype('S7').tostring())
+            f.write(np.packbits(self.blockmap, axis=1).tostring())
+        finally:
+            f.close()
+
+
+def buildindex(dumpf, stride=INDEX_STRIDE, symstride=SYMBOL_STRIDE):
+    """ Scan the dumpfile and return its index. The position of the dumpfile is
+    changed."""
+    fn = dumpf.name
+    size, mtime = getsize(fn), getmtime(fn)
+
+    dumpf.rewind()
+    parts = []
+    nmsgs = 0
+    last = None
+    symids = {}
+    symparts = []
+    for batch in dumpf.iterbatches():
+        n = len(batch)
+
+        # Find the distinct (symbol, block) pairs of the batch.
+        names, inverse = np.unique(batch.symbol, return_inverse=True)
+        ids = np.array([symids.setdefault(name, len(symids))
+                        for name in names.tolist()], np.int64)
+        blocks = (nmsgs + np.arange(n)) // symstride
+        symparts.append(np.unique((ids[inverse] << 32) | blocks))
+
+        # Pick the messages whose number is a multiple of the stride.
+        first = (-nmsgs) % stride
+        sel = np.arange(first, n, stride)
+        part = np.empty(len(sel), entry_dtype)
+        part['msgno'] = nmsgs + sel
+        part['ts_actual'] = batch.ts_actual[sel]
+        part['timestamp'] = batch.timestamp[sel]
+        parts.append(part)
+        last = (nmsgs + n - 1, batch.ts_actual[-1], batch.timestamp[-1])
+        nmsgs += n
+
+    if last is not None and (nmsgs - 1) % stride != 0:
+        parts.append(np.array([last], entry_dtype))
+    entries = (np.concatenate(parts) if parts
+               else np.empty(0, entry_dtype))
+
+    # Build the map of blocks, with the symbols sorted.
+    names = sorted(symids)
+    order = np.array([symids[name] for name in names], np.int64)
+    rank = np.empty(len(order), np.int64)
+    rank[order] = np.arange(len(order))
+    nblocks = (nmsgs + symstride - 1) // symstride
+    blockmap = np.zeros((len(names), nblocks), np.bool_)
+    if symparts:
+        pairs = np.concatenate(symparts)
+        blockmap[rank[pairs >> 32], pairs & 0xffffffff] = True
+    return DumpIndex(stride, size, mtime, nmsgs, entries,
+                     symstride, np.array(names, 'S7'), blockmap)
+
+
+def loadindex(fn):
+    """ Load the index sidecar of dumpfile 'fn'. Return None if there is none or
+    if it does not match the dumpfile anymore."""
+    ifn = indexname(fn)
+    if not exists(ifn):
+        return None
+    try:
+        data = open(ifn, 'rb').read()
+        (magic, version, stride, size, mtime, nmsgs,
+         nentries) = stidx.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            return None
+        entries = np.frombuffer(data, entry_dtype, nentries, stidx.size)
+        offset = stidx.size + entries.nbytes
+        symstride, nsymbols, nblocks = stsym.unpack_from(data, offset)
+        offset += stsym.size
+        symbols = np.frombuffer(data, 'S7', nsymbols, offset)
+        offset += symbols.nbytes
+        rowsize = (nblocks + 7) // 8
+        bits = np.frombuffer(data, np.uint8, nsymbols * rowsize, offset)
+        blockmap = np.unpackbits(bits.reshape(nsymbols, rowsize),
+                                 axis=1)[:, :nblocks].astype(np.bool_)
+    except (IOError, struct.error, ValueError), e:
+        logging.warning("Invalid index '%s': %s" % (ifn, e))
+        return None
+    index = DumpIndex(stride, size, mtime, nmsgs, entries,
+                      symstride, symbols, blockmap)
+    if not index.isvalid(fn):
+        return None
+    return index
+
+
+def getindex(dumpf, create=False, stride=INDEX_STRIDE,
+             symstride=SYMBOL_STRIDE):
+    """ Return the index of the given dumpfile, or None if it cannot have one.
+    If 'create' is true and there is no valid index, build one and save it in
+    its sidecar; otherwise return None if there isn't any."""
+    if not dumpf.isseekable() or dumpf.msgsize is None:
+        return None
+    fn = dumpf.name
+    index = loadindex(fn)
+    if index is None and create:
+        orig = dumpf.tell()
+        try:
+            index = buildindex(dumpf, stride, symstride)
+        finally:
+            dumpf.seek(orig)
+        try:
+            index.save(indexname(fn))
+        except (IOError, OSError), e:
+            logging.warning("Could not save index for '%s': %s" % (fn, e))
+    return index
+
+
+def test():
+    """ Build, save and load the indexes of dumpfiles of various sizes, and
+    check that searching with them gives the same results as without."""
+    import tempfile, shutil
+    from os.path import join
+    from oanserv.dumpfile import opendump, opendump_write, getcodec
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        t = 1220832000000
+        stride, symstride = 16, 8
+        encode = getcodec('raw32n')[0]
+        for n in 0, 1, stride, stride + 1, 10 * stride + 3:
+            print 'Testing: %d messages' % n
+            fn = join(tmpdir, 'test%d.raw32n' % n)
+            f, _ = opendump_write(fn, 'raw32n')
+            syms = []
+            for i in xrange(n):
+                # A symbol that appears in a single block only.
+                sym = 'XAU/USD' if i == n // 2 else ('EUR/USD', 'USD/JPY')[
+                    (i // symstride) % 2]
+                syms.append(sym)
+                f.write(encode(t + i * 10, t + i * 10, 'O', sym, 100, 101))
+            f.close()
+
+            dumpf = opendump(fn)
+            index = buildindex(dumpf, stride, symstride)
+            assert index.nmsgs == n
+            msgnos = index.entries['msgno'].tolist()
+            expected = range(0, n, stride)
+            if n and (n - 1) % stride:
+                expected.append(n - 1)
+            assert msgnos == expected, msgnos
+            assert index.ts_actual.tolist() == [t + i * 10 for i in msgnos]
+
+            # Save and load the index.
+            assert loadindex(fn) is None
+            index.save(indexname(fn))
+            loaded = loadindex(fn)
+            assert loaded is not None
+            assert (loaded.entries == index.entries).all()
+            assert (loaded.symbols == index.symbols).all()
+            assert (loaded.blockmap == index.blockmap).all()
+
+            # The bounds contain the first message at or after the time.
+            for ts in t - 1, t, t + 5, t + n * 5, t + (n - 1) * 10, t + n * 10:
+                first = min(max(0, (ts - t + 9) // 10), n)
+                nlo, nhi = loaded.bounds(ts)
+                assert nlo <= first <= nhi, (ts, first, nlo, nhi)
+
+            # The ranges contain all the messages of the symbols.
+            for sel in ['EUR/USD'], ['XAU/USD'], ['USD/JPY', 'XAU/USD'], []:
+                ranges = loaded.ranges(sel)
+                for i, sym in enumerate(syms):
+                    if sym in sel:
+                        assert any(a <= i < b for a, b in ranges), (sel, i)
+                assert all(a < b <= n for a, b in ranges), ranges
+            assert loaded.ranges(['GBP/USD']) == []
+
+            # Searching with and without the index gives the same results.
+            times = sorted([t - 1, t, t + 5, t + n * 5, t + n * 10])
+            plain = opendump(fn)
+            plain.index_loaded = True
+            dumpf = opendump(fn)
+            assert dumpf.getindex() is not None
+            assert map(dumpf.findtime, times) == map(plain.findtime, times)
+            assert dumpf.findtimes(times) == plain.findtimes(times)
+            for sel in ['EUR/USD'], ['XAU/USD']:
+                assert (''.join(r for r, _ in dumpf.iterselect(sel)) ==
+                        ''.join(r for r, _ in plain.iterselect(sel)))
+
+            # The index is ignored once the file changes, and getindex()
+            # rebuilds it if asked to.
+            f = open(fn, 'ab')
+            f.write(encode(t + n * 10, t + n * 10, 'O', 'EUR/USD', 100, 101))
+            f.close()
+            os.utime(fn, (0, getmtime(fn) + 10))
+            assert loadindex(fn) is None
+            assert getindex(opendump(fn)) is None
+            assert getindex(opendump(fn), True).nmsgs == n + 1
+            assert loadindex(fn).nmsgs == n + 1
+
+        # An invalid sidecar is ignored.
+        open(indexname(fn), 'wb').write(INDEX_MAGIC)
+        assert loadindex(fn) is None
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main():
+    """ Build the indexes of the dumpfiles given as arguments. This is used to
+    index the segments of the recorder in a separate process."""
+    import optparse
+    from oanserv.dumpfile import opendump
+
+    parser = optparse.OptionParser(main.__doc__.strip())
+    opts, args = parser.parse_args()
+    rval = 0
+    for fn in args:
+        try:
+            if getindex(opendump(fn), create=True) is None:
+                logging.error("Cannot index '%s'." % fn)
+                rval = 1
+        except (IOError, OSError), e:
+            logging.error("Error indexing '%s': %s" % (fn, e))
+            rval = 1
+    return rval
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,316 @@
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+A set of dumpfiles in a directory, such as the archive written by oandog.
+
+oandog writes a new dumpfile for every session and every day, so an analysis
+over a period of time has to find the files which cover it and read them in
+order. A DumpSet catalogs the dumpfiles of a directory with their number of
+messages and their extents in time, and caches this catalog in a manifest file
+in the directory ('.dumpset'), so that it does not have to open every file
+again on the next run; an entry is refreshed when the size or modification time
+of its file changes.
+
+The compressed copies of a dumpfile (e.g. 'FILE.gz' or 'FILE.zblk' next to
+'FILE') hold the same messages, so only one of the copies of each file is
+cataloged, preferring the one that is the cheapest to read (see
+COMPRESSED_SUFFIXES).
+
+The manifest is a JSON object with the version of its format and a list of
+entries, with the fields of DumpSetEntry.
+"""
+
+# stdlib imports
+import os, logging, json, heapq
+from os.path import join, getsize, getmtime, exists
+from fnmatch import fnmatch
+from collections import namedtuple
+
+# local imports
+from oanserv.dumpfile import opendump
+
+
+__all__ = ('DumpSet', 'DumpSetEntry')
+
+
+MANIFEST_NAME = '.dumpset'
+MANIFEST_VERSION = 1
+
+# The suffixes of the compressed copies of a dumpfile, in order of preference
+# (after the uncompressed file).
+COMPRESSED_SUFFIXES = ('.zblk', '.gz', '.bz2')
+
+# The catalog entry of a dumpfile: 'name' is its filename relative to the
+# directory, 'begin' and 'end' the actual timestamps of its first and last
+# messages, and 'tbegin' and 'tend' their update timestamps (all in msecs; None
+# if the file is empty).
+DumpSetEntry = namedtuple(
+    'DumpSetEntry',
+    'name size mtime codec nmsgs begin end tbegin tend')
+
+
+class DumpSet(object):
+    """ The set of the dumpfiles in directory 'dirname' whose names match the
+    glob 'pattern'. The index sidecars of the dumpfiles are ignored. If
+    'manifest' is false, the catalog is not saved."""
+
+    def __init__(self, dirname, pattern='*.dump*', manifest=True):
+        self.dirname = dirname
+        self.pattern = pattern
+        self.manifest = manifest
+        self.entries = []
+        self.refresh()
+
+    def manifestname(self):
+        return join(self.dirname, MANIFEST_NAME)
+
+    def loadmanifest(self):
+        """ Load the cached entries from the manifest, as a dict by name. Return
+        an empty dict if there is no valid manifest."""
+        fn = self.manifestname()
+        if not exists(fn):
+            return {}
+        try:
+            data = json.load(open(fn))
+            if data['version'] != MANIFEST_VERSION:
+                return {}
+            entries = [DumpSetEntry(*e) for e in data['entries']]
+            entries = [e._replace(name=str(e.name), codec=str(e.codec))
+                       for e in entries]
+        except (IOError, ValueError, KeyError, TypeError), e:
+            logging.warning("Invalid manifest '%s': %s" % (fn, e))
+            return {}
+        return dict((e.name, e) for e in entries)
+
+    def savemanifest(self):
+        "Write out the manifest, atomically."
+        fn = self.manifestname()
+        tmpfn = fn + '.tmp'
+        try:
+            f = open(tmpfn, 'w')
+            json.dump({'version': MANIFEST_VERSION,
+                       'entries': [list(e) for e in self.entries]}, f)
+            f.close()
+            os.rename(tmpfn, fn)
+        except (IOError, OSError), e:
+            logging.warning("Could not save manifest '%s': %s" % (fn, e))
+
+    def refresh(self):
+        """ Update the catalog from the contents of the directory, scanning the
+        files which are new or have changed since the manifest was saved."""
+        cached = self.loadmanifest()
+        entries = []
+        changed = False
+        for name in self.listnames():
+            fn = join(self.dirname, name)
+            entry = cached.pop(name, None)
+            if (entry is None or entry.size != getsize(fn) or
+                entry.mtime != getmtime(fn)):
+                entry = self.scan(name)
+                if entry is None:
+                    continue
+                changed = True
+            entries.append(entry)
+        if cached:
+            changed = True # Some files have disappeared.
+
+        entries.sort(key=lambda e: (e.begin is None, e.begin, e.name))
+        self.entries = entries
+        if changed and self.manifest:
+            self.savemanifest()
+
+    def listnames(self):
+        """ Return the names of the dumpfiles of the directory, keeping only one
+        of the copies of each file."""
+        copies = {} # stem -> (preference, name)
+        for name in os.listdir(self.dirname):
+            if (not fnmatch(name, self.pattern) or name.endswith('.idx') or
+                name.startswith(MANIFEST_NAME)):
+                continue
+            stem, pref = name, 0
+            for i, suffix in enumerate(COMPRESSED_SUFFIXES):
+                if name.endswith(suffix):
+                    stem, pref = name[:-len(suffix)], i + 1
+                    break
+            copies[stem] = min(copies.get(stem, (pref, name)), (pref, name))
+        return sorted(name for _, name in copies.itervalues())
+
+    def scan(self, name):
+        """ Open the dumpfile 'name' and return its catalog entry, or None if it
+        is not a valid dumpfile."""
+        fn = join(self.dirname, name)
+        size, mtime = getsize(fn), getmtime(fn)
+        try:
+            dumpf = opendump(fn)
+            if dumpf.codecname is None:
+                raise IOError("Unknown codec.")
+            nmsgs = len(dumpf)
+            if nmsgs > 0:
+                (begin, tbegin), (end, tend) = (dumpf.gettimes(0),
+                                                dumpf.gettimes(-1))
+                times = (begin, end, tbegin, tend)
+            else:
+                times = (None, None, None, None)
+        except (IOError, OSError, StopIteration), e:
+            logging.warning("Skipping '%s': %s" % (fn, e))
+            return None
+        return DumpSetEntry(name, size, mtime, dumpf.codecname, nmsgs, *times)
+
+    def __len__(self):
+        "Return the total number of messages."
+        return sum(e.nmsgs for e in self.entries)
+
+    def filename(self, entry):
+        return join(self.dirname, entry.name)
+
+    def getextents(self):
+        """ Return the (start, end) update timestamps of the first and last
+        messages of the set, or None if it is empty."""
+        entries = [e for e in self.entries if e.nmsgs > 0]
+        if not entries:
+            return None
+        return (entries[0].tbegin, max(e.tend for e in entries))
+
+    def select(self, start=None, end=None):
+        """ Return the entries of the non-empty files which have messages with
+        an actual time in [start, end), in order of time."""
+        return [e for e in self.entries
+                if (e.nmsgs > 0 and
+                    (start is None or e.end >= start) and
+                    (end is None or e.begin < end))]
+
+    def iterrange(self, start=None, end=None, **kw):
+        """ Iterate over the messages with an actual time in [start, end), in
+        order of actual time, opening only the files which overlap that range.
+        Files are read one after the other, except for files overlapping in
+        time, which are merged. The keyword arguments are passed to opendump()
+        (e.g. 'discard_ooo'; note that it then applies to each file
+        separately)."""
+        for group in self.groups(self.select(start, end)):
+            iters = [self.iterfile(e, start, end, **kw) for e in group]
+            if len(iters) == 1:
+                it = iters[0]
+            else:
+                it = heapq.merge(*iters)
+            for msg in it:
+                yield msg
+
+    def __iter__(self):
+        return self.iterrange()
+
+    def groups(self, entries):
+        """ Split the given time-ordered entries into groups of files which
+        overlap in time."""
+        group, gend = [], None
+        for e in entries:
+            if group and e.begin > gend:
+                yield group
+                group, gend = [], None
+            group.append(e)
+            gend = e.end if gend is None else max(gend, e.end)
+        if group:
+            yield group
+
+    def iterfile(self, entry, start, end, **kw):
+        """ Iterate over the messages of a file with an actual time in
+        [start, end)."""
+        dumpf = opendump(self.filename(entry), **kw)
+        if start is not None and start > entry.begin:
+            # Note: findtime() returns the end of the file if the time is that
+            # of the last message.
+            dumpf.seek(min(dumpf.findtime(start), entry.nmsgs - 1))
+        for msg in dumpf:
+            if end is not None and msg.ts_actual >= end:
+                break
+            if start is not None and msg.ts_actual < start:
+                continue
+            yield msg
+
+
+def test():
+    """ Catalog a directory of dumpfiles, and check the manifest, the
+    collapsing of the compressed copies and iterating over ranges of time."""
+    import tempfile, shutil, gzip
+    from oanserv.dumpfile import opendump_write, getcodec
+    from oanserv.dumpindex import getindex
+
+    encode = getcodec('raw32n')[0]
+    def write(name, times):
+        f, _ = opendump_write(join(tmpdir, name), 'raw32n')
+        for i, t in enumerate(times):
+            f.write(encode(t, t, 'O', ('EUR/USD', 'USD/JPY')[i % 2],
+                           100 + i, 101 + i))
+        f.close()
+        return [(t, t, 'O', ('EUR/USD', 'USD/JPY')[i % 2], 100 + i, 101 + i)
+                for i, t in enumerate(times)]
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # An empty directory.
+        dset = DumpSet(tmpdir)
+        assert len(dset) == 0 and dset.entries == []
+        assert dset.getextents() is None and list(dset) == []
+
+        t = 1220832000000
+        msgs = (write('a.dump', range(t, t + 1000, 10)) +
+                write('b.dump', range(t + 500, t + 1500, 20)) +
+                write('c.dump', [t + 2000]))
+        write('empty.dump', [])
+        write('other.txt', [t])
+        msgs.sort()
+
+        # A compressed copy, an index sidecar and a file which is not a
+        # dumpfile.
+        gf = gzip.open(join(tmpdir, 'a.dump.gz'), 'wb')
+        gf.write(open(join(tmpdir, 'a.dump'), 'rb').read())
+        gf.close()
+        getindex(opendump(join(tmpdir, 'a.dump')), create=True)
+        open(join(tmpdir, 'bad.dump'), 'wb').write('')
+
+        dset = DumpSet(tmpdir)
+        names = [e.name for e in dset.entries]
+        assert names == ['a.dump', 'b.dump', 'c.dump', 'empty.dump'], names
+        assert len(dset) == len(msgs)
+        assert dset.getextents() == (t, t + 2000)
+        assert exists(dset.manifestname())
+
+        # Iterating over ranges of time, across overlapping files.
+        assert [tuple(u) for u in dset] == msgs
+        for start, end in ((None, None), (t + 505, t + 1200), (t + 990, None),
+                           (None, t), (t + 2000, t + 2001), (t + 3000, None)):
+            r = [tuple(u) for u in dset.iterrange(start, end)]
+            assert r == [m for m in msgs
+                         if (start is None or m[0] >= start) and
+                         (end is None or m[0] < end)], (start, end)
+        assert [e.name for e in dset.select(t + 1200, t + 2000)] == ['b.dump']
+
+        # The manifest is used on the next run; only the files that changed
+        # are scanned again.
+        scanned = []
+        class TestDumpSet(DumpSet):
+            def scan(self, name):
+                scanned.append(name)
+                return DumpSet.scan(self, name)
+        assert TestDumpSet(tmpdir).entries == dset.entries
+        assert scanned == ['bad.dump']
+        del scanned[:]
+        write('c.dump', [t + 2010]) # Appended.
+        os.utime(join(tmpdir, 'c.dump'), (0, getmtime(join(tmpdir, 'c.dump'))
+                                          + 10))
+        os.remove(join(tmpdir, 'a.dump'))
+        dset = TestDumpSet(tmpdir)
+        assert scanned == ['a.dump.gz', 'bad.dump', 'c.dump'], scanned
+        assert [e.name for e in dset.entries][:2] == ['a.dump.gz', 'b.dump']
+        assert len(dset) == len(msgs) + 1
+
+        # Without a manifest.
+        os.remove(dset.manifestname())
+        dset = DumpSet(tmpdir, 'b.dump*', manifest=False)
+        assert [e.name for e in dset.entries] == ['b.dump']
+        assert not exists(dset.manifestname())
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test()
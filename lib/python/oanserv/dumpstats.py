@@ -0,0 +1,362 @@
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+Per-instrument statistics over dumpfiles.
+
+The statistics are accumulated over blocks of messages decoded into arrays
+(see DumpFile.iterfields()): each block is grouped by instrument, and the
+counters of each instrument are updated with a few array operations per group.
+The memory used is bounded by the size of a block and the number of
+instruments, whatever the size of the files:
+
+- the spreads are kept as a histogram of their distinct values (spreads are
+  multiples of the pip, so there are few of them), from which the minimum,
+  mean and percentiles are computed exactly;
+- the ticks are counted per hour of the day (UTC);
+- only the largest gaps between consecutive ticks are kept.
+
+All the times are actual times, in msecs.
+
+OrderingStats analyses the out-of-order updates in the same way: an update is
+out-of-order if its update timestamp is older than that of a previous update of
+the same instrument, and its delay is the difference between the two. The
+statistics of separate files can be computed independently (e.g. in a pool of
+processes, see ordering_stats()) and merged.
+"""
+
+# numpy imports
+import numpy as np
+
+
+__all__ = ('InstrumentStats', 'DumpStats', 'OrderingStats', 'ordering_stats')
+
+
+MSECS_PER_HOUR = 3600 * 1000
+
+# The upper bounds of the bins of the histogram of delays, in msecs; the last
+# bin holds the larger delays.
+DELAY_BINS = (1000, 2000, 5000, 10000, 30000, 60000)
+
+
+class InstrumentStats(object):
+    """ The statistics of a single instrument. 'ngaps' is the nb. of largest
+    gaps to keep."""
+
+    def __init__(self, symbol, ngaps=5):
+        self.symbol = symbol
+        self.ngaps = ngaps
+
+        self.count = 0
+        self.first = self.last = None
+
+        # Histogram of spreads, as a mapping (spread -> nb. of ticks).
+        self.spreads = {}
+
+        # Nb. of ticks per hour of the day.
+        self.hours = np.zeros(24, np.int64)
+
+        # The largest gaps, as a list of (gap, time of the tick that ends it),
+        # largest first.
+        self.gaps = []
+
+    def update(self, ts, spreads):
+        """ Update the statistics with arrays of the actual times and spreads of
+        a sequence of ticks, in order of arrival."""
+        if len(ts) == 0:
+            return
+        self.count += len(ts)
+
+        if self.first is None:
+            self.first = int(ts[0])
+            prev = ts[:-1]
+            ends = ts[1:]
+        else:
+            prev = np.r_[self.last, ts[:-1]]
+            ends = ts
+        self.last = int(ts[-1])
+
+        values, counts = np.unique(spreads, return_counts=True)
+        hist = self.spreads
+        for value, count in zip(values.tolist(), counts.tolist()):
+            hist[value] = hist.get(value, 0) + count
+
+        self.hours += np.bincount((ts // MSECS_PER_HOUR) % 24, minlength=24)
+
+        gaps = ends - prev
+        if len(gaps) > self.ngaps:
+            sel = np.argpartition(gaps, -self.ngaps)[-self.ngaps:]
+            gaps, ends = gaps[sel], ends[sel]
+        largest = self.gaps + zip(gaps.tolist(), ends.tolist())
+        largest.sort(reverse=True)
+        self.gaps = largest[:self.ngaps]
+
+    def spread_min(self):
+        return min(self.spreads) if self.spreads else None
+
+    def spread_max(self):
+        return max(self.spreads) if self.spreads else None
+
+    def spread_mean(self):
+        if not self.count:
+            return None
+        return sum(v * c for v, c in self.spreads.iteritems()) / float(self.count)
+
+    def spread_percentiles(self, percentiles):
+        """ Return the spreads at the given percentiles (from 0 to 100), using
+        the nearest-rank method."""
+        if not self.count:
+            return [None] * len(percentiles)
+        values = sorted(self.spreads)
+        cumcounts = np.cumsum([self.spreads[v] for v in values])
+        r = []
+        for p in percentiles:
+            rank = max(int(np.ceil(p / 100.0 * self.count)), 1)
+            r.append(values[int(cumcounts.searchsorted(rank))])
+        return r
+
+
+class DumpStats(object):
+    """ The statistics of all the instruments of some dumpfiles, accumulated
+    with update(). 'ngaps' is the nb. of largest gaps to keep per
+    instrument."""
+
+    fields = ('ts_actual', 'symbol', 'bid', 'ask')
+
+    def __init__(self, ngaps=5):
+        self.ngaps = ngaps
+        self.instruments = {} # symbol -> InstrumentStats
+
+    def update(self, dumpf, nmsgs=0x10000):
+        "Accumulate the statistics of the rest of dumpfile 'dumpf'."
+        instruments = self.instruments
+        for ts, symbols, bid, ask in dumpf.iterfields(self.fields, nmsgs):
+            if len(ts) == 0:
+                continue
+
+            # Group the ticks by symbol, keeping their order.
+            usyms, inv = np.unique(symbols, return_inverse=True)
+            order = inv.argsort(kind='mergesort')
+            bounds = np.r_[0, np.bincount(inv).cumsum()]
+            ts, spreads = ts[order], (ask - bid)[order]
+            for i, sym in enumerate(usyms.tolist()):
+                try:
+                    istats = instruments[sym]
+                except KeyError:
+                    istats = instruments[sym] = InstrumentStats(sym,
+                                                                self.ngaps)
+                beg, end = bounds[i], bounds[i+1]
+                istats.update(ts[beg:end], spreads[beg:end])
+
+    def __iter__(self):
+        "Iterate over the statistics of the instruments, by symbol."
+        for sym in sorted(self.instruments):
+            yield self.instruments[sym]
+
+
+class OrderingStats(object):
+    """ The statistics of the out-of-order updates per instrument: nb. of
+    updates, nb. of out-of-order updates, their maximum and total delay, and a
+    histogram of their delays (see DELAY_BINS). These are kept in arrays
+    indexed by the position of the symbols in 'symbols'."""
+
+    fields = ('timestamp', 'symbol')
+
+    def __init__(self):
+        self.symbols = []
+        self.symids = {}
+
+        self.total = np.zeros(0, np.int64)
+        self.nooo = np.zeros(0, np.int64)
+        self.maxdelay = np.zeros(0, np.int64)
+        self.sumdelay = np.zeros(0, np.int64)
+        self.hist = np.zeros((0, len(DELAY_BINS) + 1), np.int64)
+
+    def resize(self, n):
+        "Grow the arrays to hold 'n' symbols."
+        grow = n - len(self.total)
+        for name in 'total', 'nooo', 'maxdelay', 'sumdelay', 'hist':
+            a = getattr(self, name)
+            setattr(self, name, np.r_[a, np.zeros((grow,) + a.shape[1:],
+                                                  np.int64)])
+
+    def getids(self, symbols):
+        "Return an array of the ids of the given symbols, adding the new ones."
+        symids = self.symids
+        for sym in symbols:
+            if sym not in symids:
+                symids[sym] = len(self.symbols)
+                self.symbols.append(sym)
+        if len(self.symbols) > len(self.total):
+            self.resize(len(self.symbols))
+        return np.array([symids[sym] for sym in symbols], np.int64)
+
+    def update(self, dumpf, nmsgs=0x10000):
+        "Accumulate the statistics of the rest of dumpfile 'dumpf'."
+        # The latest timestamp seen per symbol id (-1 if none yet).
+        latest = np.zeros(0, np.int64)
+
+        for ts, symbols in dumpf.iterfields(self.fields, nmsgs):
+            if len(ts) == 0:
+                continue
+            usyms, inv = np.unique(symbols, return_inverse=True)
+            ids = self.getids(usyms.tolist())
+            if len(latest) < len(self.symbols):
+                latest = np.r_[latest, np.zeros(len(self.symbols) - len(latest),
+                                                np.int64) - 1]
+
+            # Group the updates by symbol, keeping their order, and compute the
+            # latest timestamp before each update within its group: offsetting
+            # the groups makes a single running maximum restart at each group.
+            order = inv.argsort(kind='mergesort')
+            grp = inv[order]
+            ts = ts[order].astype(np.int64)
+            offset = grp.astype(np.int64) << 42
+            runmax = np.maximum.accumulate(ts + offset) - offset
+            before = np.empty_like(ts)
+            before[0] = -1
+            before[1:] = runmax[:-1]
+            starts = np.r_[True, grp[1:] != grp[:-1]]
+            before[starts] = -1
+            gids = ids[grp]
+            before = np.maximum(before, latest[gids])
+
+            ooo = ts < before
+            delays = (before - ts)[ooo]
+            oids = gids[ooo]
+            np.add.at(self.total, gids, 1)
+            np.add.at(self.nooo, oids, 1)
+            np.add.at(self.sumdelay, oids, delays)
+            np.maximum.at(self.maxdelay, oids, delays)
+            bins = np.searchsorted(DELAY_BINS, delays, 'right')
+            np.add.at(self.hist, (oids, bins), 1)
+
+            ends = np.r_[starts[1:], True]
+            np.maximum.at(latest, gids[ends], runmax[ends])
+
+    def merge(self, other):
+        "Add the statistics of 'other' to these."
+        ids = self.getids(other.symbols)
+        self.total[ids] += other.total
+        self.nooo[ids] += other.nooo
+        self.sumdelay[ids] += other.sumdelay
+        self.maxdelay[ids] = np.maximum(self.maxdelay[ids], other.maxdelay)
+        self.hist[ids] += other.hist
+
+    def __iter__(self):
+        """ Iterate over (symbol, total, nooo, maxdelay, avgdelay, hist) tuples,
+        by symbol. The delays are in msecs."""
+        for sym in sorted(self.symbols):
+            i = self.symids[sym]
+            nooo = int(self.nooo[i])
+            yield (sym, int(self.total[i]), nooo, int(self.maxdelay[i]),
+                   self.sumdelay[i] / float(nooo or 1), self.hist[i].tolist())
+
+
+def ordering_stats(fn):
+    """ Compute the OrderingStats of the dumpfile 'fn'. This runs in the worker
+    processes of 'oandump ooostats'."""
+    from oanserv.dumpfile import opendump
+    stats = OrderingStats()
+    stats.update(opendump(fn))
+    return stats
+
+
+def test():
+    """ Compute the statistics of some dumpfiles in small blocks, and check
+    them against a direct computation."""
+    import tempfile, shutil, random
+    from os.path import join
+    from oanserv.dumpfile import opendump, opendump_write, getcodec
+
+    encode = getcodec('raw32n')[0]
+    def write(fn, msgs):
+        f, _ = opendump_write(fn, 'raw32n')
+        for msg in msgs:
+            f.write(encode(*msg))
+        f.close()
+
+    def ooo(parts):
+        "Compute the statistics of the out-of-order updates directly."
+        r = {}
+        for msgs in parts:
+            latest = {}
+            for _, ts, _, sym, _, _ in msgs:
+                total, nooo, maxdelay, sumdelay = r.get(sym, (0, 0, 0, 0))
+                if ts < latest.get(sym, ts):
+                    delay = latest[sym] - ts
+                    nooo, sumdelay = nooo + 1, sumdelay + delay
+                    maxdelay = max(maxdelay, delay)
+                r[sym] = (total + 1, nooo, maxdelay, sumdelay)
+                latest[sym] = max(latest.get(sym, ts), ts)
+        return [(sym,) + r[sym][:3] for sym in sorted(r)]
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        rnd = random.Random(0)
+        t = 1220832000000
+        for n in 0, 1, 1000:
+            print 'Testing: %d messages' % n
+            msgs = []
+            for i in xrange(n):
+                tsa = t + i * 60000 + rnd.randrange(60000)
+                ts = tsa - rnd.choice((0, 0, 0, 500, 1500, 70000, 200000))
+                bid = rnd.randrange(100000, 200000)
+                msgs.append((tsa, ts, 'O', rnd.choice(('EUR/USD', 'USD/JPY')),
+                             bid, bid + rnd.randrange(1, 4)))
+            fn = join(tmpdir, 'test%d.raw32n' % n)
+            write(fn, msgs)
+
+            # The statistics of the instruments.
+            stats = DumpStats(ngaps=3)
+            stats.update(opendump(fn), nmsgs=7)
+            assert ([istats.symbol for istats in stats] ==
+                    sorted(set(m[3] for m in msgs)))
+            for istats in stats:
+                smsgs = [m for m in msgs if m[3] == istats.symbol]
+                tsa = [m[0] for m in smsgs]
+                spreads = sorted(m[5] - m[4] for m in smsgs)
+                assert istats.count == len(smsgs)
+                assert (istats.first, istats.last) == (tsa[0], tsa[-1])
+                assert istats.spread_min() == spreads[0]
+                assert istats.spread_max() == spreads[-1]
+                assert abs(istats.spread_mean() -
+                           sum(spreads) / float(len(spreads))) < 1e-9
+                assert istats.spread_percentiles([0, 50, 100]) == [
+                    spreads[0], spreads[(len(spreads) + 1) // 2 - 1],
+                    spreads[-1]]
+                hours = [0] * 24
+                for ts in tsa:
+                    hours[(ts // MSECS_PER_HOUR) % 24] += 1
+                assert istats.hours.tolist() == hours
+                gaps = sorted(zip([b - a for a, b in zip(tsa, tsa[1:])],
+                                  tsa[1:]), reverse=True)[:3]
+                assert istats.gaps == gaps, (istats.gaps, gaps)
+
+            # The statistics of the out-of-order updates, of the whole file and
+            # of its two halves merged.
+            ostats = OrderingStats()
+            ostats.update(opendump(fn), nmsgs=7)
+            assert [r[:4] for r in ostats] == ooo([msgs])
+            for r in ostats:
+                assert sum(r[5]) == r[2]
+            write(fn + '.1', msgs[:n // 2])
+            write(fn + '.2', msgs[n // 2:])
+            ostats = ordering_stats(fn + '.1')
+            ostats.merge(ordering_stats(fn + '.2'))
+            assert ([r[:4] for r in ostats] ==
+                    ooo([msgs[:n // 2], msgs[n // 2:]]))
+
+        # The histogram of the delays.
+        fn = join(tmpdir, 'delays.raw32n')
+        delays = (0, 1, 999, 1000, 1001, 60000, 60001)
+        write(fn, sum([[(t, t, 'O', 'EUR/USD', 1, 2),
+                        (t, t - d, 'O', 'EUR/USD', 1, 2)] for d in delays], []))
+        (_, total, nooo, maxdelay, avgdelay, hist), = ordering_stats(fn)
+        assert (total, nooo, maxdelay) == (14, 6, 60001)
+        assert hist == [2, 2, 0, 0, 0, 0, 2], hist
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,243 @@
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+A group-commit writer for recording dumpfiles.
+
+The dumpfile opened by opendump_write() is unbuffered, so writing each message
+as it arrives costs one system call per tick on the thread that dispatches the
+rates to the clients. A DumpWriter instead hands the messages over to a
+background thread, which encodes them and accumulates the encoded records,
+writing them out in a single call when enough bytes have been collected or
+enough time has elapsed since the last write. A slow disk then only delays the
+writer thread, up to a bounded number of queued messages, after which the
+dispatching thread blocks. When the time has elapsed, the partial block of the
+block codecs is written out too, so that at most about 'interval' seconds of
+data are ever at risk (at the cost of smaller blocks for a slow feed).
+
+The encoded output is only ever cut between records, so if the process dies
+in the middle of a write the file contains at most one partial record at the
+end, which opendump_write() truncates when the file is reopened.
+
+The fsync policy determines how often the file is synced to disk:
+
+  'never'   Leave it to the operating system;
+  'write'   After every group of records written;
+  'close'   Once, when the writer is closed.
+
+"""
+
+# stdlib imports
+import os, logging
+from time import time
+from threading import Thread, Event
+from Queue import Queue, Empty
+
+# local imports
+from oanserv.dumpfile import openwriter
+
+
+__all__ = ('DumpWriter',)
+
+
+FSYNC_POLICIES = ('never', 'write', 'close')
+
+
+class RecordCollector(object):
+    """ A file-like object which accumulates the records written to it by a
+    codec writer. Each call to write() receives whole records. 'name' is that
+    of the underlying file, which the block codec writers look at to continue an
+    existing file."""
+
+    def __init__(self, name):
+        self.name = name
+        self.chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def take(self):
+        "Return and clear the accumulated data."
+        data = ''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+# Markers for the writer thread.
+_FLUSH, _CLOSE = object(), object()
+
+class DumpWriter(object):
+    """ A writer that encodes and writes messages to the dumpfile 'f' from a
+    background thread. Messages are written out when at least 'bufsize' bytes of
+    encoded data are pending, or after 'interval' seconds. At most 'maxqueue'
+    messages are queued for the writer thread. This has the same write() and
+    flush() interface as the codec writers returned by openwriter(), but you
+    must call close() to stop the thread and write out all pending messages
+    (the file itself is not closed)."""
+
+    def __init__(self, f, codecname, bufsize=0x10000, interval=1.0,
+                 fsync='never', maxqueue=0x100000):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError("Invalid fsync policy: %s" % repr(fsync))
+        self.f = f
+        self.bufsize = bufsize
+        self.interval = interval
+        self.fsync = fsync
+
+        self.collector = RecordCollector(f.name)
+        self.writer = openwriter(self.collector, codecname)
+
+        # The exception that stopped the writer thread, if any.
+        self.error = None
+
+        self.queue = Queue(maxqueue)
+        self.thread = Thread(target=self.run, name='DumpWriter')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def check(self):
+        "Raise the error that occurred in the writer thread, if any."
+        if self.error is not None:
+            raise IOError("Error writing dumpfile: %s" % self.error)
+
+    def write(self, ts_actual, timestamp, venue, symbol, bid, ask):
+        self.check()
+        if not self.thread.isAlive():
+            raise IOError("Error writing dumpfile: writer thread has stopped.")
+        self.queue.put((ts_actual, timestamp, venue, symbol, bid, ask))
+
+    def flush(self):
+        """ Wait until all the messages queued so far have been written to the
+        file, including the current partial block of the block codecs."""
+        self.check()
+        done = Event()
+        self.queue.put((_FLUSH, done))
+        while not done.isSet() and self.thread.isAlive():
+            done.wait(0.5)
+        self.check()
+
+    def close(self):
+        "Write out all pending messages and stop the writer thread."
+        if self.thread.isAlive():
+            self.queue.put((_CLOSE, None))
+            self.thread.join()
+        self.check()
+
+    def run(self):
+        "The main loop of the writer thread."
+        write = self.writer.write
+        collector = self.collector
+        lastwrite = time()
+        try:
+            while 1:
+                timeout = max(lastwrite + self.interval - time(), 0)
+                try:
+                    msg = self.queue.get(True, timeout)
+                except Empty:
+                    msg = None
+
+                if msg is None or msg[0] is _FLUSH:
+                    self.writer.flush()
+                    self.commit()
+                    lastwrite = time()
+                    if msg is not None:
+                        msg[1].set()
+                elif msg[0] is _CLOSE:
+                    self.writer.flush()
+                    self.commit()
+                    if self.fsync == 'close':
+                        os.fsync(self.f.fileno())
+                    break
+                else:
+                    write(*msg)
+                    if collector.size >= self.bufsize:
+                        self.commit()
+                    elif time() >= lastwrite + self.interval:
+                        self.writer.flush()
+                        self.commit()
+                        lastwrite = time()
+
+        except Exception, e:
+            # Note: this includes the errors of the encoders, which would
+            # otherwise stop the thread silently.
+            logging.error("Error writing dumpfile: %s" % e)
+            self.error = e
+
+            # Release any thread waiting on a flush.
+            while 1:
+                try:
+                    msg = self.queue.get(False)
+                except Empty:
+                    break
+                if msg[0] is _FLUSH:
+                    msg[1].set()
+
+    def commit(self):
+        "Write out the records accumulated so far."
+        if self.collector.size == 0:
+            return
+        self.f.write(self.collector.take())
+        if self.fsync == 'write':
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+
+
+def test():
+    "Write dumpfiles through a DumpWriter and read them back."
+    import tempfile, shutil
+    from time import sleep
+    from os.path import join
+    from oanserv.dumpfile import opendump, opendump_write
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        t = 1220832000000
+        # Note: raw24 stores a single timestamp.
+        messages = [(t + i, t + i, 'O', ('EUR/USD', 'USD/JPY')[i % 2],
+                     147019000 + i, 147020000 + i) for i in xrange(1000)]
+        for codec in 'raw24', 'raw32n', 'raw40', 'zcol', 'zdelta':
+            fn = join(tmpdir, 'test.%s' % codec)
+
+            # Nothing written.
+            f, codec = opendump_write(fn, codec)
+            DumpWriter(f, codec).close()
+            f.close()
+            assert len(list(opendump(fn))) == 0
+
+            # The messages, including a partial block, are on disk after the
+            # interval, without closing the writer.
+            f, codec = opendump_write(fn, codec)
+            writer = DumpWriter(f, codec, interval=0.05)
+            for msg in messages:
+                writer.write(*msg)
+            sleep(0.5)
+            assert len(list(opendump(fn))) == len(messages), codec
+            writer.write(*messages[0])
+            writer.flush()
+            writer.close()
+            f.close()
+            r = [tuple(u) for u in opendump(fn)]
+            assert r == messages + messages[:1], codec
+
+        # An error in the encoder stops the writer and is reported.
+        f, codec = opendump_write(join(tmpdir, 'error.raw32n'), 'raw32n')
+        writer = DumpWriter(f, codec)
+        writer.write(t, t, 'O', 'EUR/USD', -1, -1)
+        writer.thread.join(5)
+        try:
+            writer.write(*messages[0])
+        except IOError:
+            pass
+        else:
+            raise AssertionError("Error not reported.")
+        f.close()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    test()
@@ -27,6 +27,13 @@ class HeadFile(object):
     def tell(self):
         return self.pos
 
+    def reserve(self, nbytes):
+        """ Grow the cache to hold the first 'nbytes' bytes of the file, e.g.
+        for a header whose size is only known once its beginning has been read.
+        This is only possible while the cache is still being filled."""
+        if nbytes > self.headsize and self.realpos < self.headsize:
+            self.headsize = nbytes
+
     def realread(self, nbytes):
         assert self.realpos < self.headsize, (self.realpos, self.headsize)
         r = self.f.read(nbytes)
@@ -53,21 +60,31 @@ class HeadFile(object):
             assert self.pos < self.realpos, (self.pos, self.realpos)
             beg = self.pos
             end = beg + nbytes
+            if end > lenhead and self.realpos == lenhead:
+                # Return the rest of the cache and read on from the file.
+                r = self.head[beg:] + self.realread(end - lenhead)
+                self.pos += len(r)
+                return r
             if end > self.headsize:
                 raise OSError("Head overflow of non-seekable file.")
             if end > lenhead:
                 # Make sure we read all needed unread bytes.
-                ebytes = lenhead - end
+                ebytes = end - lenhead
                 self.realread(ebytes)
+                lenhead = len(self.head)
             # Return the part of the cache we need to read.
             r = self.head[beg:end]
             self.pos += len(r)
         return r
 
+    def readinto(self, buf):
+        r = self.read(len(buf))
+        buf[:len(r)] = r
+        return len(r)
+
     def seek(self, offset, whence=os.SEEK_SET):
         if (whence != os.SEEK_SET or
-            (offset > len(self.head) and offset != self.realpos)): 
-            trace(offset, len(self.head), self.realpos)
+            (offset > len(self.head) and offset != self.realpos)):
             raise OSError("File is not seekable.")
         else:
             assert offset <= len(self.head) or offset == self.realpos
@@ -78,6 +95,8 @@ class HeadFile(object):
 def test():
     "Cat a file larger than 2048 bytes in stdin and this should succeed."
 
+    from StringIO import StringIO
+
     f = HeadFile(sys.stdin, 1024)
 
     f.seek(0)
@@ -89,8 +108,16 @@ def test():
     f.seek(1000)
     f.seek(2048+128)
     f.read(128)
-    f.seek(1024)
+    f.seek(1014)
     f.read(10)
+
+    # The cache can grow while it is being filled.
+    f = HeadFile(StringIO('x' * 4096), 16)
+    f.read(8)
+    f.reserve(1024)
+    f.read(2048)
+    f.seek(0)
+    assert f.read(1024) == 'x' * 1024
     
 
 if __name__ == '__main__':
@@ -6,11 +6,13 @@ FX exchange rates market data server.
 """
 
 # stdlib imports
-import sys, os, logging, grp
+import sys, os, re, logging, grp, shlex, threading
 from random import randint, random
 from time import time
-from os.path import getsize
+from os.path import getsize, exists, splitext
+from glob import glob
 from datetime import datetime, timedelta
+from subprocess import Popen
 
 # oanda imports
 import oanda
@@ -21,10 +23,11 @@ from oanda.utils import normalize_pair
 from oanda.prices import f2i
 
 # twisted imports
-from twisted.internet import reactor
+from twisted.internet import reactor, task
 
 # local imports
-from oanserv.dumpfile import getcodec, opendump_write
+from oanserv.dumpfile import opendump, opendump_write, readheader
+from oanserv.dumpwriter import DumpWriter, FSYNC_POLICIES
 from oanserv.rateserv import RateServerFactory
 from oanserv.times import sec2milli
 
@@ -72,21 +75,17 @@ class RateDispatch(object):
     implements the dumpfile storage and tells the server factory about the new
     event, which in turns dispatches to the clients."""
 
-    def __init__(self, factory, dumpfile=None, codec=None):
+    def __init__(self, factory, recorder=None):
         self.factory = factory
-        self.dumpfile = dumpfile
-        if self.dumpfile is not None:
-            encode, decode, msgsize = getcodec(codec)
-            self.encode = encode
+        self.recorder = recorder
         self.status = 0
 
     def event(self, ts, pair, bid, ask):
 
         # Store the event in the dumpfile.
-        if self.dumpfile is not None:
+        if self.recorder is not None:
             ntime = sec2milli(time())
-            msg = self.encode(ntime, ts, VENUE, pair.pair, bid, ask)
-            self.dumpfile.write(msg)
+            self.recorder.write(ntime, ts, VENUE, pair.pair, bid, ask)
 
         # Notify the listeners.
         self.factory.notify_subscribers(ts, VENUE, pair.pair, bid, ask)
@@ -101,6 +100,226 @@ class RateDispatch(object):
         return self.status
 
 
+#-------------------------------------------------------------------------------
+# Recording of the dumpfile in segments.
+
+# Rotation periods, in seconds. Segments start on multiples of the period from
+# local midnight.
+ROTATE_PERIODS = {'hourly': 60*60,
+                  'daily': 24*60*60}
+
+def next_boundary(dt, period):
+    "Return the datetime of the first multiple of 'period' secs after 'dt'."
+    midnight = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    nperiods = timedelta_seconds(dt - midnight) // period + 1
+    return midnight + timedelta(seconds=nperiods * period)
+
+def segment_name(pattern, dt):
+    """ Return the filename of a segment starting at 'dt'. The pattern is
+    expanded with strftime(); if it does not contain any format directive, the
+    start time is inserted before its extension."""
+    if '%' not in pattern:
+        root, ext = splitext(pattern)
+        pattern = root + '.%Y-%m-%d.%H%M%S' + ext
+    return dt.strftime(pattern)
+
+def segment_glob(pattern):
+    """ Return a glob pattern matching the filenames of all the segments of
+    'pattern', including those renamed by DumpRecorder.newname()."""
+    if '%' not in pattern:
+        root, ext = splitext(pattern)
+        return root + '.*' + ext
+    return re.sub('%.', '*', pattern.replace('%%', '%'))
+
+
+class Segment(object):
+    "An open dumpfile segment and its writer."
+
+    def __init__(self, fn, codec, gid=None, **kw):
+        self.dfile, self.codec = opendump_write(fn, codec)
+        self.name = fn
+        if gid is not None:
+            os.chown(fn, -1, gid)
+        self.writer = DumpWriter(self.dfile, self.codec, **kw)
+
+    def size(self):
+        return os.fstat(self.dfile.fileno()).st_size
+
+    def close(self):
+        """ Close the segment, removing the file if it does not contain any
+        message. Returns True if the file was kept."""
+        try:
+            self.writer.close()
+        finally:
+            self.dfile.close()
+        if len(opendump(self.name)) == 0:
+            os.remove(self.name)
+            return False
+        return True
+
+
+class DumpRecorder(object):
+    """ A writer that stores the messages in a sequence of dumpfile segments,
+    switching to a new segment at the rotation period boundaries and/or when
+    the current segment exceeds 'maxsize' bytes. The next segment is opened in
+    advance, so that switching only replaces the writer in use; the previous
+    segment is closed in a separate thread, indexed in a child process (see
+    oanserv.dumpindex), and then handed over to the 'hook' command (which is
+    run with the segment's filename as its last argument). Segments left
+    without any message by a previous run that did not stop cleanly are
+    removed at startup.
+
+    If there is neither a period nor a maximum size, 'pattern' is used as is
+    for a single dumpfile."""
+
+    # Interval at which we check if it is time to rotate, in seconds.
+    check_interval = 1.0
+
+    def __init__(self, pattern, codec=None, period=None, maxsize=None,
+                 hook=None, gid=None, **kw):
+        self.pattern = pattern
+        self.period = period
+        self.maxsize = maxsize
+        self.hook = shlex.split(hook) if hook else None
+        self.segkw = dict(kw, gid=gid)
+
+        self.rotating = bool(period or maxsize)
+        now = datetime.now()
+        if self.rotating:
+            self.cleanup()
+            fn = segment_name(pattern, now)
+        else:
+            fn = pattern
+        self.current = Segment(fn, codec, **self.segkw)
+        self.codec = self.current.codec
+        logging.info("Recording to '%s'." % fn)
+
+        self.boundary = None
+        self.next = None
+        self.closers = []
+        if self.rotating:
+            self.prepare(now)
+            self.loop = task.LoopingCall(self.check)
+            self.loop.start(self.check_interval, now=False)
+
+    def write(self, ts_actual, timestamp, venue, symbol, bid, ask):
+        self.current.writer.write(ts_actual, timestamp, venue, symbol, bid, ask)
+
+    def cleanup(self):
+        """ Remove the segments which contain a header but no message. Files
+        without a header are left alone, they were not written by us."""
+        for fn in sorted(glob(segment_glob(self.pattern))):
+            try:
+                f = open(fn, 'rb')
+                try:
+                    header = readheader(f)
+                finally:
+                    f.close()
+                if header is None:
+                    continue
+                dumpf = opendump(fn)
+                try:
+                    empty = len(dumpf) == 0
+                finally:
+                    dumpf.f.close()
+                if empty:
+                    os.remove(fn)
+                    logging.info("Removed empty dumpfile '%s'." % fn)
+            except (IOError, OSError), e:
+                logging.warning("Could not check dumpfile '%s': %s" % (fn, e))
+
+    def newname(self, dt):
+        "Return a filename for a new segment starting at 'dt'."
+        fn = segment_name(self.pattern, dt)
+        root, ext = splitext(fn)
+        i = 0
+        while exists(fn):
+            i += 1
+            fn = '%s.%d%s' % (root, i, ext)
+        return fn
+
+    def prepare(self, now):
+        "Open the segment that follows the current one."
+        if self.period:
+            self.boundary = next_boundary(now, self.period)
+            start = self.boundary
+        else:
+            start = now
+        self.nextstart = start
+        self.next = Segment(self.newname(start), self.codec, **self.segkw)
+
+    def check(self):
+        "Rotate to the next segment if it is time to."
+        now = datetime.now()
+        if self.boundary is not None and now >= self.boundary:
+            self.rotate(now)
+        elif self.maxsize and self.current.size() >= self.maxsize:
+            # The next segment was named for the period boundary; rename it for
+            # the time at which it actually starts.
+            if (segment_name(self.pattern, now) !=
+                segment_name(self.pattern, self.nextstart)):
+                fn = self.newname(now)
+                os.rename(self.next.name, fn)
+                self.next.name = fn
+            self.rotate(now)
+
+    def rotate(self, now):
+        "Switch to the next segment and close the previous one."
+        prev, self.current = self.current, self.next
+        logging.info("Rotating dumpfile to '%s'." % self.current.name)
+        self.prepare(now)
+
+        closer = threading.Thread(target=self.finish, args=(prev,),
+                                  name='DumpRecorder')
+        closer.start()
+        self.closers = [t for t in self.closers if t.isAlive()] + [closer]
+
+    def finish(self, segment, wait=True):
+        "Close the given segment and run the post-close hook on it."
+        try:
+            if not segment.close():
+                logging.info("Removed empty dumpfile '%s'." % segment.name)
+                return
+        except (IOError, OSError), e:
+            logging.error("Error closing dumpfile '%s': %s" % (segment.name, e))
+            return
+
+        # Build the index in a child process, so that decoding the whole
+        # segment does not hold up the reactor of this one.
+        cmd = [sys.executable, '-m', 'oanserv.dumpindex', segment.name]
+        try:
+            rval = Popen(cmd).wait()
+            if rval != 0:
+                logging.error("Indexing '%s' returned %s." %
+                              (segment.name, rval))
+        except OSError, e:
+            logging.error("Could not index '%s': %s" % (segment.name, e))
+
+        if self.hook:
+            cmd = self.hook + [segment.name]
+            logging.info("Running: %s" % ' '.join(cmd))
+            try:
+                p = Popen(cmd)
+            except OSError, e:
+                logging.error("Could not run post-close hook: %s" % e)
+                return
+            if wait:
+                rval = p.wait()
+                if rval != 0:
+                    logging.error("Post-close hook for '%s' returned %s." %
+                                  (segment.name, rval))
+
+    def close(self):
+        "Close all the segments."
+        if self.rotating and self.loop.running:
+            self.loop.stop()
+        for t in self.closers:
+            t.join()
+        if self.next is not None:
+            self.next.close()
+        self.finish(self.current, wait=False)
+
+
 #-------------------------------------------------------------------------------
 
 class RatesMonitor(RateEvent):
@@ -234,7 +453,38 @@ def main():
                       help="Port for the server to listen on.")
 
     parser.add_option('-o', '-d', '--dumpfile', action='store',
-                      help="Name of a dumpfile to use to store messages.")
+                      help=("Name of a dumpfile to use to store messages. When "
+                            "rotating, this is a strftime() pattern expanded "
+                            "with the start time of each segment."))
+
+    parser.add_option('--rotate', action='store', type='choice',
+                      choices=sorted(ROTATE_PERIODS),
+                      help=("Start a new dumpfile segment periodically (%s)." %
+                            ', '.join(sorted(ROTATE_PERIODS))))
+
+    parser.add_option('--rotate-size', action='store', type='int',
+                      help=("Start a new dumpfile segment when the current one "
+                            "exceeds this many bytes."))
+
+    parser.add_option('--post-close', action='store', metavar='CMD',
+                      help=("Command to run on each dumpfile segment after it "
+                            "is closed, with its filename as last argument "
+                            "(e.g. to compress or index it)."))
+
+    parser.add_option('--flush-interval', action='store', type='float',
+                      default=1.0,
+                      help=("Maximum delay in seconds before received messages "
+                            "are written to the dumpfile."))
+
+    parser.add_option('--flush-size', action='store', type='int',
+                      default=0x10000,
+                      help=("Write to the dumpfile when at least this many "
+                            "bytes of messages are pending."))
+
+    parser.add_option('--fsync', action='store', type='choice',
+                      choices=FSYNC_POLICIES, default='never',
+                      help=("When to sync the dumpfile to disk: %s." %
+                            ', '.join(FSYNC_POLICIES)))
 
     parser.add_option('-g', '--group', action='store',
                       help=("Set the group for the output files "
@@ -270,6 +520,7 @@ def main():
     else:
         fxclient = None
 
+    recorder = None
     try:
         # Open a dumpfile for writing.
         if opts.dumpfile is not None:
@@ -277,14 +528,14 @@ def main():
             # to the group. Note that UNIX lets use write to the file, despite
             # us not having the right to do that once the file is closed.
             os.umask(0226)
-            dfile, codec = opendump_write(opts.dumpfile)
-
-            # Set the appropriate group for the dumpfile.
-            if opts.group:
-                os.chown(opts.dumpfile, -1, opts.gid)
-        else:
-            dfile, codec = None, None
-
+            recorder = DumpRecorder(opts.dumpfile, opts.codec,
+                                    period=ROTATE_PERIODS.get(opts.rotate),
+                                    maxsize=opts.rotate_size,
+                                    hook=opts.post_close,
+                                    gid=opts.gid if opts.group else None,
+                                    bufsize=opts.flush_size,
+                                    interval=opts.flush_interval,
+                                    fsync=opts.fsync)
         
         # Create a server.
         setup_twisted_oanda(reactor)
@@ -292,7 +543,7 @@ def main():
         reactor.listenTCP(opts.port, factory)
 
         # Create event monitoring/generating objects.
-        dispatch = RateDispatch(factory, dfile, codec or opts.codec)
+        dispatch = RateDispatch(factory, recorder)
         if opts.online:
             logging.info("Enabling rate event monitoring.")
             event = RatesMonitor(dispatch, fxclient)
@@ -317,11 +568,9 @@ def main():
 
         return status
     finally:
-        if dfile is not None:
-            dfile.close()
-            # Remove empty dumpfiles.
-            if getsize(dfile.name) == 0:
-                os.remove(dfile.name)
+        # Write out pending messages and remove dumpfiles without any messages.
+        if recorder is not None:
+            recorder.close()
 
         
 if __name__ == '__main__':
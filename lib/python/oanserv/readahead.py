@@ -0,0 +1,216 @@
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+Background read-ahead for compressed dumpfiles.
+
+Reading a gzipped or bzipped dumpfile decompresses it on the thread that
+decodes and processes the messages, so the two never overlap. A ReadAheadFile
+reads (and so decompresses) the upcoming blocks of the file in a helper thread,
+while the reader consumes the previous ones: with two buffers in flight, one is
+being filled while the other is being read. The decompressors release the
+interpreter lock while they work, so a scan uses two cores.
+
+Seeking is supported, by stopping the helper thread and restarting it from the
+new position; this is expensive, so only wrap files that are read mostly
+sequentially.
+"""
+
+# stdlib imports
+import os, atexit, weakref
+from threading import Thread
+from Queue import Queue
+
+
+__all__ = ('ReadAheadFile',)
+
+
+# The readers whose helper thread may be running. The threads are stopped on
+# exit, before the interpreter tears down the modules they use.
+_readers = weakref.WeakSet()
+
+def _stopall():
+    for reader in list(_readers):
+        reader.stop()
+
+atexit.register(_stopall)
+
+
+class ReadAheadFile(object):
+    """ A read-only file object which reads ahead from file 'f' in a background
+    thread, in blocks of 'bufsize' bytes, keeping up to 'nbufs' blocks ready.
+    The underlying file must not be used directly while this is in use."""
+
+    def __init__(self, f, bufsize=0x100000, nbufs=2):
+        self.f = f
+        self.bufsize = bufsize
+        self.nbufs = nbufs
+
+        # The block being consumed, and the position of the reader.
+        self.buf = ''
+        self.bufpos = 0
+        self.pos = f.tell()
+        self.eof = False
+
+        self.thread = None
+        self.queue = None
+        self.stopping = False
+
+    @property
+    def name(self):
+        return self.f.name
+
+    def start(self):
+        "Start the helper thread from the current position of the file."
+        self.queue = Queue(self.nbufs)
+        self.stopping = False
+        self.thread = Thread(target=self.run, name='ReadAhead')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        _readers.add(self)
+
+    def stop(self):
+        "Stop the helper thread and discard the blocks it has read ahead."
+        if self.thread is None:
+            return
+        self.stopping = True
+        while self.thread.isAlive():
+            # Make room for the helper thread to finish its last put().
+            while not self.queue.empty():
+                self.queue.get()
+            self.thread.join(0.01)
+        self.thread = self.queue = None
+
+    def run(self):
+        "The main loop of the helper thread."
+        read, put = self.f.read, self.queue.put
+        try:
+            while not self.stopping:
+                data = read(self.bufsize)
+                put((data, None))
+                if not data:
+                    break
+        except Exception, e:
+            put(('', e))
+
+    def nextbuf(self):
+        """ Get the next block read ahead. Return False at the end of the
+        file."""
+        if self.eof:
+            return False
+        if self.thread is None:
+            self.start()
+        data, error = self.queue.get()
+        if error is not None:
+            self.stop()
+            raise error
+        if not data:
+            self.eof = True
+            self.stop()
+            return False
+        self.buf, self.bufpos = data, 0
+        return True
+
+    def read(self, nbytes=-1):
+        parts = []
+        while nbytes is None or nbytes < 0 or nbytes > 0:
+            if self.bufpos >= len(self.buf) and not self.nextbuf():
+                break
+            if nbytes is None or nbytes < 0:
+                data = self.buf[self.bufpos:]
+            else:
+                data = self.buf[self.bufpos:self.bufpos + nbytes]
+                nbytes -= len(data)
+            self.bufpos += len(data)
+            parts.append(data)
+        r = ''.join(parts)
+        self.pos += len(r)
+        return r
+
+    def readinto(self, buf):
+        r = self.read(len(buf))
+        buf[:len(r)] = r
+        return len(r)
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset, whence = self.pos + offset, os.SEEK_SET
+        start = self.pos - self.bufpos
+        if whence == os.SEEK_SET and start <= offset <= start + len(self.buf):
+            # Move within the current block.
+            self.bufpos = offset - start
+            self.pos = offset
+            return
+        self.stop()
+        self.f.seek(offset, whence)
+        self.pos = self.f.tell()
+        self.buf, self.bufpos = '', 0
+        self.eof = False
+
+    def close(self):
+        self.stop()
+        self.f.close()
+
+
+def test():
+    """ Read files of various sizes through a ReadAheadFile, and check reading
+    and seeking against the data."""
+    import random
+    from StringIO import StringIO
+
+    rnd = random.Random(0)
+    bs = 100
+    for size in 0, 1, bs, bs + 1, 10 * bs:
+        print 'Testing: %d bytes' % size
+        data = ''.join(chr(rnd.randrange(256)) for _ in xrange(size))
+
+        f = ReadAheadFile(StringIO(data), bs)
+        assert f.read() == data
+        assert f.read() == '' and f.read(10) == ''
+        assert f.tell() == size
+
+        # Read in pieces, seeking within and outside of the current block.
+        f.seek(0)
+        pos = 0
+        for _ in xrange(200):
+            n = rnd.randrange(2 * bs)
+            if rnd.random() < 0.3:
+                pos = rnd.randrange(size + 10)
+                f.seek(pos)
+            elif rnd.random() < 0.3:
+                off = rnd.randint(-bs, bs)
+                pos = max(pos + off, 0)
+                f.seek(pos)
+            assert f.tell() == pos
+            assert f.read(n) == data[pos:pos+n], (pos, n)
+            pos = min(pos + n, max(pos, size))
+        f.seek(0, os.SEEK_END)
+        assert f.tell() == size and f.read() == ''
+        buf = bytearray(bs)
+        f.seek(0)
+        assert f.readinto(buf) == min(size, bs)
+        assert str(buf[:min(size, bs)]) == data[:bs]
+        f.close()
+        assert f.thread is None
+
+    # Errors in the helper thread are raised in the reader.
+    class BadFile(StringIO):
+        def read(self, n=-1):
+            if self.tell() >= bs:
+                raise IOError("Bad file.")
+            return StringIO.read(self, n)
+    f = ReadAheadFile(BadFile('x' * 10 * bs), bs)
+    assert f.read(bs) == 'x' * bs
+    try:
+        f.read(1)
+    except IOError:
+        pass
+    else:
+        raise AssertionError("Error not raised.")
+    assert f.thread is None
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,135 @@
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+Reordering of out-of-order rate updates.
+
+About 0.5% to 1.5% of the updates we receive have an update timestamp older than
+that of a previous update for the same instrument. Discarding them (see the
+'discard_ooo' option of the dumpfiles) loses data; instead, a ReorderBuffer
+holds the updates for a time window in a heap keyed on their update timestamp,
+and releases them in order of timestamp once they are older than the most
+recent timestamp seen by more than the window. An update that arrives after
+updates of the same instrument with a later timestamp have already been released
+is late beyond the window: it is counted, and passed through or dropped.
+
+Each update costs O(log w), where w is the number of updates in the window,
+which is also the bound on the memory used.
+"""
+
+# stdlib imports
+from heapq import heappush, heappop
+
+
+__all__ = ('ReorderBuffer',)
+
+
+class ReorderBuffer(object):
+    """ A reordering stage for a stream of RateUpdate's, holding them for
+    'window' msecs. If 'drop_late' is true, the updates late beyond the window
+    are dropped rather than passed through out-of-order. The counters are
+    updated when the stream is exhausted or closed."""
+
+    def __init__(self, window, drop_late=False):
+        self.window = window
+        self.drop_late = drop_late
+
+        # Nb. of updates seen, updates late beyond the window, and the largest
+        # nb. of updates held at once.
+        self.nmsgs = 0
+        self.nlate = 0
+        self.maxheld = 0
+
+    def reorder(self, iterable):
+        "Iterate over the updates of 'iterable', reordered."
+        window, drop_late = self.window, self.drop_late
+        heap = []
+        released = {} # The timestamp of the last update released, per symbol.
+        maxts = None
+        seq = nlate = maxheld = 0
+        try:
+            for msg in iterable:
+                ts, sym = msg.timestamp, msg.symbol
+                if ts < released.get(sym, ts):
+                    nlate += 1
+                    if not drop_late:
+                        yield msg
+                    continue
+                if maxts is None or ts > maxts:
+                    maxts = ts
+
+                # Note: the sequence number keeps the order of arrival for
+                # equal timestamps, and avoids comparing the updates.
+                heappush(heap, (ts, seq, msg))
+                seq += 1
+                if len(heap) > maxheld:
+                    maxheld = len(heap)
+
+                limit = maxts - window
+                while heap[0][0] <= limit:
+                    ts, _, msg = heappop(heap)
+                    released[msg.symbol] = ts
+                    yield msg
+                    if not heap:
+                        break
+
+            while heap:
+                yield heappop(heap)[2]
+        finally:
+            self.nmsgs += seq + nlate
+            self.nlate += nlate
+            self.maxheld = max(self.maxheld, maxheld)
+
+
+def test():
+    "Reorder some streams of updates and check the output and the counters."
+    import random
+    from oanserv.dumpfile import RateUpdate
+
+    def upd(ts, sym='EUR/USD', bid=100):
+        return RateUpdate(ts, ts, 'O', sym, bid, bid + 1)
+
+    # Empty input and a single update.
+    rbuf = ReorderBuffer(100)
+    assert list(rbuf.reorder([])) == []
+    assert (rbuf.nmsgs, rbuf.nlate, rbuf.maxheld) == (0, 0, 0)
+    assert list(rbuf.reorder([upd(1)])) == [upd(1)]
+    assert (rbuf.nmsgs, rbuf.nlate, rbuf.maxheld) == (1, 0, 1)
+
+    # Updates out of order within the window come out in order; equal
+    # timestamps keep their order of arrival.
+    msgs = [upd(0), upd(50, bid=1), upd(20), upd(50, bid=2), upd(10),
+            upd(300), upd(250), upd(1000)]
+    rbuf = ReorderBuffer(100)
+    r = list(rbuf.reorder(msgs))
+    assert r == sorted(msgs, key=lambda u: u.timestamp), r
+    assert [u.bid for u in r if u.timestamp == 50] == [1, 2]
+    assert (rbuf.nmsgs, rbuf.nlate) == (len(msgs), 0)
+
+    # Updates late beyond the window are passed through or dropped, and only
+    # updates of the same instrument make them late.
+    msgs = [upd(0), upd(200), upd(500), upd(100), upd(50, 'USD/JPY')]
+    for drop_late in False, True:
+        rbuf = ReorderBuffer(100, drop_late)
+        r = list(rbuf.reorder(msgs))
+        assert (rbuf.nmsgs, rbuf.nlate) == (5, 1)
+        assert (upd(100) in r) != drop_late
+        assert upd(50, 'USD/JPY') in r
+
+    # A random stream with bounded delays is fully reordered, and the counters
+    # accumulate over streams, including a stream which is not exhausted.
+    rnd = random.Random(0)
+    msgs = [upd(i * 10 - rnd.randrange(10) * 10, rnd.choice(('A', 'B')))
+            for i in xrange(1000)]
+    rbuf = ReorderBuffer(100)
+    r = list(rbuf.reorder(msgs))
+    assert r == sorted(msgs, key=lambda u: u.timestamp)
+    assert rbuf.nlate == 0 and 1 < rbuf.maxheld <= 20, rbuf.maxheld
+    it = rbuf.reorder(msgs)
+    for i in xrange(10):
+        it.next()
+    it.close()
+    assert 1000 < rbuf.nmsgs < 1100, rbuf.nmsgs
+
+if __name__ == '__main__':
+    test()
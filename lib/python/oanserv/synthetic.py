@@ -0,0 +1,197 @@
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+Generation of synthetic market data, for testing and benchmarking.
+
+Our recordings cannot be distributed, so we generate data whose statistical
+properties resemble them, from the per-instrument analysis of out-of-order
+updates in doc/devel/delays.txt:
+
+- the instruments are those of the table, and each is updated with a frequency
+  proportional to its number of updates;
+
+- the actual timestamps follow a Poisson process, and the update timestamps
+  precede them by a small random latency;
+
+- each instrument has a proportion of updates whose timestamp is older than the
+  latest timestamp seen for that instrument, by a delay with the same maximum
+  and (approximately) the same average as in the table.
+
+The prices follow a geometric random walk with a fixed spread per instrument.
+"""
+
+# stdlib imports
+import re
+from collections import namedtuple
+
+# numpy imports
+import numpy as np
+
+# local imports
+from oanserv.dumpfile import DEFAULT_VENUE
+from oanserv.dumparray import rate_dtype
+
+
+__all__ = ('Instrument', 'read_delays', 'SyntheticGenerator')
+
+
+Instrument = namedtuple('Instrument',
+                        'symbol weight ooo_rate max_delay avg_delay')
+
+_delays_re = re.compile(
+    '^\s+([A-Z]{3}/[A-Z]{3})\s+(\d+)/(\d+) \([\d.]+%\)'
+    '\s+([\d.]+) secs\s+([\d.]+) secs\s*$')
+
+def read_delays(f):
+    """ Parse the per-instrument table of out-of-order statistics from the given
+    file object (in the format of doc/devel/delays.txt) and return a list of
+    Instrument objects. The weights are the total number of updates, and the
+    delays are in milliseconds."""
+    instruments = []
+    for line in f:
+        mo = _delays_re.match(line)
+        if mo is None:
+            continue
+        symbol, nooo, ntotal, maxd, avgd = mo.groups()
+        nooo, ntotal = int(nooo), int(ntotal)
+        instruments.append(
+            Instrument(symbol, ntotal,
+                       float(nooo) / ntotal if ntotal else 0.,
+                       int(float(maxd) * 1000), int(float(avgd) * 1000)))
+    return instruments
+
+
+class SyntheticGenerator(object):
+    """ A generator of synthetic rate updates for the given instruments. 'rate'
+    is the average number of updates per second over all the instruments,
+    'latency' the average delay in milliseconds between the update and actual
+    timestamps, and 'start' the actual time of the first update (in msecs). The
+    state of the instruments carries over from one call of generate() to the
+    next, so the data can be generated in chunks."""
+
+    def __init__(self, instruments, rate=80., latency=150, start=None,
+                 seed=None):
+        self.instruments = instruments
+        self.rate = rate
+        self.latency = latency
+        self.random = np.random.RandomState(seed)
+        rnd = self.random
+
+        self.symbols = np.array([x.symbol for x in instruments], 'S7')
+        weights = np.array([x.weight for x in instruments], np.float64)
+        self.cumweights = np.cumsum(weights / weights.sum())
+        self.cumweights[-1] = 1.
+
+        # Initial prices and spreads, and the volatility of a single update.
+        nins = len(instruments)
+        self.logmid = rnd.uniform(np.log(0.1), np.log(1000.), nins)
+        self.spread = np.exp(self.logmid) * rnd.uniform(1e-4, 1e-3, nins)
+        self.sigma = 1e-4
+
+        # The latest update timestamp of each instrument. No timestamp is
+        # generated before the start time.
+        if start is None:
+            start = 1220832000000 # 2008-09-08 00:00 UTC.
+        self.start = self.ts_actual = start
+        self.lastmax = np.zeros(nins, np.int64) + start
+
+    def generate(self, n):
+        "Generate the next 'n' updates, as an array of type 'rate_dtype'."
+        rnd = self.random
+        out = np.empty(n, rate_dtype)
+        if n == 0:
+            return out
+
+        # Actual times and instruments.
+        gaps = rnd.exponential(1000. / self.rate, n)
+        ts_actual = self.ts_actual + np.cumsum(gaps).astype(np.int64)
+        self.ts_actual = int(ts_actual[-1])
+        insts = np.searchsorted(self.cumweights, rnd.random_sample(n))
+        timestamp = ts_actual - rnd.exponential(self.latency,
+                                                n).astype(np.int64)
+        bid = np.empty(n, np.int64)
+        ask = np.empty(n, np.int64)
+
+        # Process the updates of each instrument in order.
+        order = np.argsort(insts, kind='mergesort')
+        sinsts = insts[order]
+        bounds = np.flatnonzero(np.diff(sinsts)) + 1
+        for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, n]):
+            i = sinsts[lo]
+            inst = self.instruments[i]
+            sel = order[lo:hi]
+            m = hi - lo
+
+            # Make the timestamps increasing, and then move some of them back
+            # before the latest timestamp seen.
+            ts = np.maximum.accumulate(
+                np.maximum(timestamp[sel], self.lastmax[i]))
+            if inst.ooo_rate > 0 and inst.avg_delay > 0:
+                prev = np.r_[self.lastmax[i], ts[:-1]]
+                late = rnd.random_sample(m) < inst.ooo_rate
+                delays = np.minimum(
+                    rnd.geometric(min(1000. / inst.avg_delay, 1.), m) * 1000,
+                    max(inst.max_delay, 1000))
+                ts = np.where(late, np.maximum(prev - delays, self.start), ts)
+                self.lastmax[i] = max(self.lastmax[i], ts.max())
+            else:
+                self.lastmax[i] = ts[-1]
+            timestamp[sel] = ts
+
+            # Prices.
+            logmid = self.logmid[i] + np.cumsum(rnd.normal(0, self.sigma, m))
+            self.logmid[i] = logmid[-1]
+            halfspread = self.spread[i] / 2
+            mid = np.exp(logmid)
+            bid[sel] = np.round((mid - halfspread) * 1e8).astype(np.int64)
+            ask[sel] = np.round((mid + halfspread) * 1e8).astype(np.int64)
+
+        out['ts_actual'] = ts_actual
+        out['timestamp'] = timestamp
+        out['venue'] = DEFAULT_VENUE
+        out['symbol'] = self.symbols[insts]
+        out['bid'] = bid
+        out['ask'] = ask
+        return out
+
+
+def test():
+    "Generate data in chunks and check its invariants."
+    from os.path import dirname, join
+    from oanserv.dumparray import encode_block, decode_block
+
+    fn = join(dirname(__file__), '..', '..', '..', 'doc', 'devel', 'delays.txt')
+    instruments = read_delays(open(fn))
+    assert instruments
+
+    start = 1220832000000
+    for seed in xrange(5):
+        gen = SyntheticGenerator(instruments, start=start, seed=seed)
+        assert len(gen.generate(0)) == 0
+        arr = np.concatenate([gen.generate(n) for n in (1, 100000, 7)])
+        assert len(arr) == 100008
+        assert (arr['timestamp'] >= start).all(), seed
+        assert (arr['ts_actual'] >= start).all(), seed
+        assert (np.diff(arr['ts_actual']) >= 0).all()
+        assert (arr['timestamp'] <= arr['ts_actual']).all()
+        assert (arr['bid'] <= arr['ask']).all()
+        assert set(arr['symbol']) <= set(x.symbol for x in instruments)
+
+        # The same seed generates the same data, and it can be stored in a
+        # dumpfile.
+        again = SyntheticGenerator(instruments, start=start, seed=seed)
+        assert (np.concatenate([again.generate(n) for n in (1, 100000, 7)])
+                == arr).all()
+        buf = encode_block('raw32n', arr)
+        assert (decode_block('raw32n', buf) == arr).all()
+
+    # A single instrument, without any out-of-order update.
+    gen = SyntheticGenerator([Instrument('EUR/USD', 1, 0., 0, 0)], seed=0)
+    arr = gen.generate(1000)
+    assert (arr['symbol'] == 'EUR/USD').all()
+    assert (np.diff(arr['timestamp']) >= 0).all()
+
+
+if __name__ == '__main__':
+    test()
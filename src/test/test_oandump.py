@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# Copyright (C) 2009  Furius Enterprise / 6114750 Canada Inc.
+# Licensed under the terms of the GNU Lesser General Public License, version 3.
+# See http://furius.ca/oanpy/LICENSE for details.
+"""
+Run the subcommands of oandump on small dumpfiles and check their output.
+These tests do not need a connection.
+"""
+
+# stdlib imports
+import sys, os, re, random, tempfile, shutil
+from os.path import join, dirname, abspath
+from subprocess import Popen, PIPE
+
+# oanserv imports
+from oanserv.dumpfile import opendump, opendump_write, openwriter
+
+
+oandump_fn = abspath(join(dirname(__file__), '..', '..', 'bin', 'oandump'))
+
+def oandump(*args, **kw):
+    """ Run oandump with the given arguments and return its output. 'status' is
+    its expected exit status."""
+    p = Popen((sys.executable, oandump_fn) + args, stdout=PIPE, stderr=PIPE)
+    out, err = p.communicate()
+    assert p.returncode == kw.get('status', 0), err
+    return out
+
+def messages(n, seed, venues=('O',), t=1220832000000):
+    "Generate 'n' messages in order of actual time, after time 't'."
+    rnd = random.Random(seed)
+    r = []
+    for i in xrange(n):
+        t += rnd.randrange(100)
+        bid = rnd.randrange(100000, 200000)
+        r.append((t, t - rnd.randrange(2) * 500, rnd.choice(venues),
+                  rnd.choice(('EUR/USD', 'USD/JPY', 'XAU/USD')),
+                  bid, bid + rnd.randrange(1, 10)))
+    return r
+
+def readall(fn):
+    return [tuple(u) for u in opendump(fn)]
+
+
+
+class TestOandump(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, msgs, codec='raw32n'):
+        "Write the messages in a new dumpfile and return its filename."
+        fn = join(self.tmpdir, name)
+        f, codec = opendump_write(fn, codec)
+        writer = openwriter(f, codec)
+        for msg in msgs:
+            writer.write(*msg)
+        writer.flush()
+        f.close()
+        return fn
+
+    def test_merge(self):
+        inputs = [messages(5000, 0), messages(3000, 1), [], messages(1, 2)]
+        fns = [self.write('in%d.dump' % i, msgs)
+               for i, msgs in enumerate(inputs)]
+
+        # The merge is stable, and the empty inputs are ignored.
+        expected = sorted(sum(inputs, []), key=lambda msg: msg[0])
+        outfn = join(self.tmpdir, 'out.dump')
+        oandump('merge', '-o', outfn, *fns)
+        assert readall(outfn) == expected
+
+        # Converting the records to another codec, from a block codec.
+        fns[1] = self.write('in1.zcol', inputs[1], 'zcol')
+        oandump('merge', '-c', 'raw40', '-o', outfn, *fns)
+        dumpf = opendump(outfn)
+        assert dumpf.codecname == 'raw40'
+        assert [tuple(u) for u in dumpf] == expected
+        oandump('merge', '-c', 'zdelta', '-o', outfn, *fns)
+        assert readall(outfn) == expected
+
+        # To stdout.
+        open(outfn, 'wb').write(oandump('merge', *fns))
+        assert readall(outfn) == expected
+
+        # Empty and single inputs.
+        oandump('merge', '-o', outfn, fns[2])
+        assert readall(outfn) == []
+        oandump('merge', '-o', outfn, fns[3])
+        assert readall(outfn) == inputs[3]
+
+    def test_split(self):
+        inputs = [messages(5000, 0, ('O', 'X')), [], messages(1000, 1)]
+        fns = [self.write('in%d.dump' % i, msgs)
+               for i, msgs in enumerate(inputs)]
+        msgs = sum(inputs, [])
+
+        # The updates of each venue and symbol go into a file of their own,
+        # whatever the nb. of files open at once and the size of the buffers.
+        for opts in (), ('-n', '1', '-B', '100'):
+            outdir = join(self.tmpdir, 'split%d' % len(opts))
+            oandump('split', '-o', outdir, *(opts + tuple(fns)))
+            names = sorted(os.listdir(outdir))
+            assert names == ['EUR-USD.X.dump', 'EUR-USD.dump',
+                             'USD-JPY.X.dump', 'USD-JPY.dump',
+                             'XAU-USD.X.dump', 'XAU-USD.dump'], names
+            for name in names:
+                parts = name.split('.')
+                venue = parts[1] if len(parts) == 3 else 'O'
+                symbol = parts[0].replace('-', '/')
+                assert readall(join(outdir, name)) == [
+                    msg for msg in msgs if msg[2:4] == (venue, symbol)], name
+
+        # An empty input.
+        outdir = join(self.tmpdir, 'empty')
+        oandump('split', '-o', outdir, fns[1])
+        assert os.listdir(outdir) == []
+
+    def test_grep(self):
+        from oanserv.dumpindex import getindex
+
+        inputs = [messages(5000, 0), [], messages(1, 1)]
+        fns = [self.write('in%d.dump' % i, msgs)
+               for i, msgs in enumerate(inputs)]
+        msgs = sum(inputs, [])
+        outfn = join(self.tmpdir, 'out.dump')
+
+        # Without an index, with an index, and from a block-compressed file.
+        for variant in 'plain', 'index', 'zblk':
+            if variant == 'index':
+                getindex(opendump(fns[0]), create=True)
+            elif variant == 'zblk':
+                oandump('compress', '-b', '1000', fns[0])
+                fns[0] += '.zblk'
+            for exps in ['EUR'], ['^USD', 'XAU/USD$'], ['GBP'], []:
+                args = sum([['-e', e] for e in exps], [])
+                open(outfn, 'wb').write(oandump('grep', *(args + fns)))
+                assert readall(outfn) == [
+                    msg for msg in msgs
+                    if any(re.search(e, msg[3]) for e in exps)], (variant, exps)
+
+        # Inputs of different codecs cannot be copied to the same output.
+        fn = self.write('in.raw40', inputs[0], 'raw40')
+        assert oandump('grep', '-e', 'EUR', fns[2], fn, status=2) == ''
+
+    def test_stats(self):
+        inputs = [messages(5000, 0), [], messages(1, 1, t=1220900000000)]
+        fns = [self.write('in%d.dump' % i, msgs)
+               for i, msgs in enumerate(inputs)]
+        msgs = sum(inputs, [])
+
+        # The nb. of ticks of each instrument, and the gaps requested.
+        out = oandump('stats', '-g', '2', '-p', '10,50', *fns)
+        symbols = sorted(set(msg[3] for msg in msgs))
+        blocks = out.strip().split('\n\n')
+        assert [b.splitlines()[0] for b in blocks] == symbols
+        for symbol, block in zip(symbols, blocks):
+            lines = block.splitlines()
+            assert 'Ticks:    %d' % len([msg for msg in msgs
+                                         if msg[3] == symbol]) in lines[1]
+            assert ' p10 ' in block and ' p50 ' in block
+            assert len([l for l in lines if 'Gap:' in l]) == 2
+
+        # A directory stands for the dumpfiles it contains, in order of time.
+        assert oandump('stats', '-g', '2', '-p', '10,50', self.tmpdir) == out
+
+        # No messages.
+        assert oandump('stats', fns[1]) == ''
+
+    def test_ooostats(self):
+        inputs = [messages(5000, 0), [], messages(1000, 1)]
+        fns = [self.write('in%d.dump' % i, msgs)
+               for i, msgs in enumerate(inputs)]
+
+        # The nb. of out-of-order updates of each instrument, counted in each
+        # file separately.
+        expected = {}
+        for msgs in inputs:
+            latest = {}
+            for _, ts, _, sym, _, _ in msgs:
+                nooo, total = expected.get(sym, (0, 0))
+                if ts < latest.get(sym, ts):
+                    nooo += 1
+                expected[sym] = (nooo, total + 1)
+                latest[sym] = max(latest.get(sym, ts), ts)
+
+        # In a single process or in a pool.
+        out = oandump('ooostats', '-j', '1', *fns)
+        assert oandump('ooostats', '-j', '2', *fns) == out
+        lines = out.splitlines()[2:]
+        assert [l.split()[0] for l in lines] == sorted(expected)
+        for l in lines:
+            sym, counts = l.split()[:2]
+            assert counts == '%d/%d' % expected[sym], l
+
+        # The histogram of the delays.
+        out = oandump('ooostats', '-H', *fns)
+        hist = out.split('\n\n')[-1].splitlines()
+        assert [l.split()[0] for l in hist] == sorted(expected)
+        for l in hist:
+            sym = l.split()[0]
+            assert sum(map(int, l.split()[1:])) == expected[sym][0], l
+
+        # No messages.
+        assert len(oandump('ooostats', fns[1]).splitlines()) == 2
+
+    def test_convert(self):
+        import gzip
+
+        # Enough messages for two ranges converted in parallel.
+        inputs = [messages(140000, 0), [], messages(1, 1, t=1220900000000)]
+        fns = [self.write('in%d.dump' % i, msgs)
+               for i, msgs in enumerate(inputs)]
+        msgs = sum(inputs, [])
+        outfn = join(self.tmpdir, 'out.dump')
+
+        # In a single process, in a pool, and to stdout.
+        for jobs in '1', '2':
+            oandump('convert', '-j', jobs, '-o', outfn, 'raw32n', 'raw40', *fns)
+            dumpf = opendump(outfn)
+            assert dumpf.codecname == 'raw40'
+            assert [tuple(u) for u in dumpf] == msgs
+        open(outfn, 'wb').write(oandump('convert', 'raw32n', 'raw40', *fns))
+        assert readall(outfn) == msgs
+
+        # From a gzipped file, and to and from a block codec.
+        msgs = messages(5000, 2)
+        fn = self.write('small.dump', msgs)
+        gf = gzip.open(fn + '.gz', 'wb')
+        gf.write(open(fn, 'rb').read())
+        gf.close()
+        oandump('convert', '-o', outfn, 'raw32n', 'zcol', fn + '.gz')
+        assert readall(outfn) == msgs
+        zfn = join(self.tmpdir, 'out.zcol')
+        os.rename(outfn, zfn)
+        oandump('convert', '-o', outfn, 'zcol', 'raw32n', zfn)
+        assert readall(outfn) == msgs
+
+        # No messages.
+        oandump('convert', '-o', outfn, 'raw32n', 'raw40', fns[1])
+        assert readall(outfn) == []
+
+    def test_index(self):
+        from oanserv.dumpindex import loadindex, indexname
+
+        inputs = [messages(1000, 0), [], messages(1, 1)]
+        fns = [self.write('in%d.dump' % i, msgs)
+               for i, msgs in enumerate(inputs)]
+        oandump('index', '-s', '16', '-S', '8', *fns)
+        for fn, msgs in zip(fns, inputs):
+            index = loadindex(fn)
+            assert (index.stride, index.symstride) == (16, 8)
+            assert index.nmsgs == len(msgs)
+
+        # An up-to-date index is kept unless forced.
+        oandump('index', fns[0])
+        assert loadindex(fns[0]).stride == 16
+        oandump('index', '-f', fns[0])
+        assert loadindex(fns[0]).stride != 16
+
+        # Files of a block codec cannot be indexed.
+        fn = self.write('in.zcol', inputs[0], 'zcol')
+        oandump('index', fn)
+        assert not os.path.exists(indexname(fn))
+
+    def test_compress(self):
+        import gzip
+
+        inputs = [messages(1000, 0), [], messages(1, 1)]
+        fns = [self.write('in%d.dump' % i, msgs)
+               for i, msgs in enumerate(inputs)]
+
+        # Next to the inputs, in blocks smaller than the files.
+        oandump('compress', '-b', '1000', *fns)
+        for fn, msgs in zip(fns, inputs):
+            assert readall(fn + '.zblk') == msgs
+            dumpf = opendump(fn + '.zblk')
+            assert len(dumpf) == len(msgs)
+            if msgs:
+                dumpf.seek(len(msgs) - 1)
+                assert tuple(dumpf.next()) == msgs[-1]
+
+        # From a gzipped file, and to a given output.
+        gf = gzip.open(fns[0] + '.gz', 'wb')
+        gf.write(open(fns[0], 'rb').read())
+        gf.close()
+        os.remove(fns[0] + '.zblk')
+        oandump('compress', fns[0] + '.gz')
+        assert readall(fns[0] + '.zblk') == inputs[0]
+        outfn = join(self.tmpdir, 'out.zblk')
+        oandump('compress', '-o', outfn, fns[2])
+        assert readall(outfn) == inputs[2]
+
+    def test_clamp(self):
+        from datetime import datetime
+        from time import mktime
+
+        # The messages span about 50 secs.
+        msgs = messages(1000, 0)
+        fns = [self.write('in.dump', msgs), self.write('in.zcol', msgs, 'zcol'),
+               self.write('in.zdelta', msgs, 'zdelta')]
+        outfn = join(self.tmpdir, 'out.dump')
+
+        def spec(t):
+            "Convert a time in msecs to a spec, in local time, like oandump."
+            return datetime.fromtimestamp(t // 1000).isoformat(' ')
+        tlow, thigh = msgs[200][0], msgs[800][0]
+        for opts in (('-L', spec(tlow), '-H', spec(thigh)),
+                     ('-L', spec(tlow)), ('-H', spec(thigh)), ()):
+            # The messages of a block codec are encoded again, the others are
+            # copied.
+            outputs = []
+            for fn in fns:
+                open(outfn, 'wb').write(oandump('clamp', *(opts + (fn,))))
+                dumpf = opendump(outfn)
+                assert dumpf.codecname == opendump(fn).codecname
+                outputs.append([tuple(u) for u in dumpf])
+            r = outputs[0]
+            assert all(rr == r for rr in outputs[1:]), opts
+
+            # The output starts and ends with the messages just before the
+            # times (see findtime()).
+            beg = msgs.index(r[0])
+            end = beg + len(r)
+            assert r == msgs[beg:end], opts
+            if '-L' in opts:
+                assert r[0][0] < tlow // 1000 * 1000 <= r[1][0], opts
+            else:
+                assert beg == 0
+            if '-H' in opts:
+                assert r[-1][0] < thigh // 1000 * 1000 <= msgs[end][0], opts
+            else:
+                assert end == len(msgs)